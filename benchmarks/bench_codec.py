@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+"""
+Benchmark the encode/decode cost of the job message codecs.
+
+Usage:
+  $ python bench_codec.py [-n NUM]
+
+For each available codec and a range of job sizes, prints the mean time
+to encode and decode one job and the encoded size in bytes.
+"""
+import sys
+import timeit
+from argparse import ArgumentParser
+
+from datasink import codec
+from datasink.transfer import TransferRequest
+
+
+def make_job(nkeys):
+    req = TransferRequest('/data/somedata/someinst/INSA00000001.fits',
+                          './INS/INSA00000001.fits', 'someuser',
+                          'somehost.example.org', 'ftps', size=7777,
+                          md5sum='d41d8cd98f00b204e9800998ecf8427e',
+                          priority=1)
+    job = dict(req.as_dict())
+    job.update(action='transfer', time_origin=1718000000.123456,
+               source_origin='bench')
+    # pad out with FITS-header-like metadata
+    job['header'] = {'KEY%05d' % i: 'value of keyword %d' % i
+                     for i in range(nkeys)}
+    return job
+
+
+def main(options, args):
+    names = ['stdjson']
+    if codec.have_orjson:
+        names.append('orjson')
+    if codec.have_msgpack:
+        names.append('msgpack')
+
+    print("%-8s %7s %8s %12s %12s" % ('codec', 'nkeys', 'bytes',
+                                      'encode(us)', 'decode(us)'))
+    for nkeys in (0, 10, 100, 1000, 10000):
+        job = make_job(nkeys)
+        num = max(10, options.num // max(1, nkeys // 10))
+        for name in names:
+            cdc = codec.get_codec(name)
+            buf = cdc.encode(job)
+            t_enc = timeit.timeit(lambda: cdc.encode(job), number=num)
+            t_dec = timeit.timeit(lambda: cdc.decode(buf), number=num)
+            print("%-8s %7d %8d %12.2f %12.2f" % (
+                name, nkeys, len(buf), t_enc / num * 1e6, t_dec / num * 1e6))
+
+
+if __name__ == '__main__':
+
+    argprs = ArgumentParser("codec benchmark")
+
+    argprs.add_argument("-n", "--num", dest="num", type=int, default=20000,
+                        help="Number of iterations for the smallest job")
+
+    (options, args) = argprs.parse_known_args(sys.argv[1:])
+
+    main(options, args)
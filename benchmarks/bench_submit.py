@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+"""
+Benchmark publishing jobs with a JobSource.
+
+Usage:
+  $ python bench_submit.py -f PUB_CFG [-n NUM] [-b BATCH] [-t TOPIC]
+                          [-p POOL_SIZES]
+
+Publishes NUM small transfer jobs to the realm in PUB_CFG, first one at a
+time with `submit` and then in batches of BATCH with `submit_many`, and
+prints the jobs/s for each.  If the configuration has
+`publisher_confirms: true`, the time includes waiting for all the
+confirms.
+
+With -p (e.g. -p 1,2,4,8) it also runs a PooledJobSource of each of the
+given sizes, with as many producer threads as channels, to show how
+throughput scales with the number of channels.
+
+NOTE: this really sends the jobs, so use a scratch realm or a topic that
+is bound only to a scratch queue (with confirms, jobs to a topic that is
+bound to no queue are returned as unroutable and retried).
+"""
+import sys
+import time
+import logging
+import threading
+from argparse import ArgumentParser
+
+from datasink.client import JobSource, PooledJobSource
+from datasink.transfer import TransferRequest
+
+
+def make_jobs(num):
+    jobs = []
+    for i in range(num):
+        filename = 'INSA%08d.fits' % i
+        req = TransferRequest('/data/somedata/someinst/' + filename,
+                              './INS/' + filename, 'someuser',
+                              'somehost.example.org', 'ftps', size=7777,
+                              md5sum='d41d8cd98f00b204e9800998ecf8427e',
+                              priority=1)
+        job = dict(req.as_dict())
+        job.update(action='transfer', id=filename)
+        jobs.append(job)
+    return jobs
+
+
+def wait_confirms(jobsrc, results):
+    if jobsrc.use_confirms:
+        for res in results:
+            res.result()
+
+
+def main(options, args):
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.WARNING)
+
+    jobsrc = JobSource(logger, 'bench')
+    jobsrc.read_config(options.configfile)
+    jobsrc.connect()
+
+    jobs = make_jobs(options.num)
+
+    t1 = time.time()
+    results = [jobsrc.submit(job, topic=options.topic) for job in jobs]
+    wait_confirms(jobsrc, results)
+    t_single = time.time() - t1
+
+    t1 = time.time()
+    results = []
+    for i in range(0, len(jobs), options.batch):
+        res = jobsrc.submit_many(jobs[i:i + options.batch],
+                                 topic=options.topic)
+        if res is not None:
+            results.extend(res)
+    wait_confirms(jobsrc, results)
+    t_batch = time.time() - t1
+
+    confirms = 'on' if jobsrc.use_confirms else 'off'
+    jobsrc.shutdown()
+
+    print("%-24s %10s %10s" % ('mode', 'jobs', 'jobs/s'))
+    print("%-24s %10d %10.0f" % ('submit (confirms %s)' % confirms,
+                                  options.num, options.num / t_single))
+    print("%-24s %10d %10.0f" % ('submit_many/%d' % options.batch,
+                                  options.num, options.num / t_batch))
+
+    if options.pool is None:
+        return
+    for pool_size in [int(n) for n in options.pool.split(',')]:
+        t_pool = bench_pool(options, logger, jobs, pool_size)
+        print("%-24s %10d %10.0f" % ('pool/%d' % pool_size,
+                                      options.num, options.num / t_pool))
+
+
+def bench_pool(options, logger, jobs, pool_size):
+    jobsrc = PooledJobSource(logger, 'bench', pool_size=pool_size)
+    jobsrc.read_config(options.configfile)
+    jobsrc.connect()
+
+    # one producer thread per channel
+    chunk = (len(jobs) + pool_size - 1) // pool_size
+    results = [[] for i in range(pool_size)]
+
+    def produce(i):
+        for job in jobs[i * chunk:(i + 1) * chunk]:
+            results[i].append(jobsrc.submit(job, topic=options.topic))
+        wait_confirms(jobsrc, results[i])
+
+    threads = [threading.Thread(target=produce, args=[i])
+               for i in range(pool_size)]
+    t1 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if not jobsrc.use_confirms:
+        # wait for the I/O threads to write out the jobs
+        for publisher in jobsrc.publishers:
+            publisher.flush()
+    t_pool = time.time() - t1
+
+    jobsrc.shutdown()
+    return t_pool
+
+
+if __name__ == '__main__':
+
+    argprs = ArgumentParser("submit benchmark")
+
+    argprs.add_argument("-f", "--config", dest="configfile",
+                        help="Specify the job source configuration file")
+    argprs.add_argument("-n", "--num", dest="num", type=int, default=10000,
+                        help="Number of jobs to send in each mode")
+    argprs.add_argument("-b", "--batch", dest="batch", type=int, default=500,
+                        help="Batch size for submit_many")
+    argprs.add_argument("-t", "--topic", dest="topic", default='bench',
+                        metavar="TOPIC",
+                        help="Dot separated topic to send to")
+    argprs.add_argument("-p", "--pool", dest="pool", default=None,
+                        metavar="SIZES",
+                        help="Comma separated pool sizes to benchmark")
+
+    (options, args) = argprs.parse_known_args(sys.argv[1:])
+
+    if options.configfile is None:
+        argprs.error("Please specify a config file with -f")
+
+    main(options, args)
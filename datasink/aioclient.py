@@ -0,0 +1,154 @@
+#
+# aioclient.py -- asyncio job source
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`AsyncJobSource` is a job source for asyncio programs, built on pika's
+asyncio connection adapter, so jobs can be submitted without blocking the
+event loop or going through an executor:
+
+    jobsrc = AsyncJobSource(logger, 'controller')
+    jobsrc.read_config('pub.yml')
+    await jobsrc.connect()
+    await jobsrc.submit(job)
+    await jobsrc.submit_many(jobs, topic='foo.bar')
+    await jobsrc.shutdown()
+
+Jobs are encoded, given topics and message properties exactly as by
+`JobSource.submit`.  With 'publisher_confirms' configured, `submit`
+returns when the broker has confirmed the job (raising `PublishError` if
+it could not be published); `submit_many` returns when all of the jobs
+are confirmed.  The connection is re-established automatically if it
+drops, and unconfirmed jobs are republished.
+"""
+import asyncio
+
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from datasink.client import JobSource
+from datasink.publisher import ConfirmPublisher
+
+
+class AsyncPublisher(ConfirmPublisher):
+    """A ConfirmPublisher that runs on an asyncio event loop instead of
+    in its own I/O thread.  Its futures are asyncio futures.
+    """
+
+    def __init__(self, logger, params, config, name='publisher',
+                 confirm=True, limiter=None, loop=None):
+        super().__init__(logger, params, config, name=name, confirm=confirm,
+                         limiter=limiter)
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.ev_open = asyncio.Event()
+
+    def _make_future(self):
+        return self.loop.create_future()
+
+    def _call_later(self, delay, callback):
+        self.loop.call_later(delay, callback)
+
+    def _wake(self):
+        if not self._wakeup:
+            self._wakeup = True
+            self.loop.call_soon(self._pump)
+
+    def _connect(self):
+        if self.ev_quit.is_set():
+            return
+        try:
+            self.connection = AsyncioConnection(
+                self.params, on_open_callback=self._on_open,
+                on_open_error_callback=self._on_open_error,
+                on_close_callback=self._on_closed, custom_ioloop=self.loop)
+
+        except Exception as e:
+            self.logger.error(f"publisher error: {e}", exc_info=True)
+            self._reconnect()
+
+    def _reconnect(self):
+        if not self.ev_quit.is_set():
+            self.logger.info(f"reconnecting publisher in {self.recover_interval} sec")
+            self.loop.call_later(self.recover_interval, self._connect)
+
+    def _on_channel_open(self, channel):
+        super()._on_channel_open(channel)
+        self.ev_open.set()
+
+    def _on_open_error(self, connection, err):
+        self.logger.error(f"publisher connection failed: {err}")
+        self._reconnect()
+
+    def _on_closed(self, connection, reason):
+        self.channel = None
+        self.ev_open.clear()
+        self._wakeup = False
+        self._requeue_outstanding()
+        if not self.ev_quit.is_set():
+            self.logger.warning(f"publisher connection closed: {reason}")
+            self._reconnect()
+
+    def start(self):
+        self._connect()
+
+    async def flush(self, timeout=None):
+        if len(self.unresolved) > 0:
+            await asyncio.wait(list(self.unresolved), timeout=timeout)
+        return len(self.unresolved) == 0
+
+    async def stop(self, timeout=10.0):
+        if not await self.flush(timeout=timeout):
+            self.logger.warning("{} messages unconfirmed at shutdown".format(
+                len(self.unresolved)))
+        self.ev_quit.set()
+        connection = self.connection
+        if connection is not None and connection.is_open:
+            connection.close()
+
+
+class AsyncJobSource(JobSource):
+    """A JobSource for asyncio programs.  `connect`, `submit`,
+    `submit_many` and `shutdown` are coroutines.  The thread-based
+    `start_publish` and `publish_loop` are not available: they raise
+    TypeError.
+    """
+
+    async def connect(self, timeout=None):
+        """Connect to the realm.  Waits up to `timeout` seconds (forever
+        if None) for the connection to come up; jobs submitted before
+        then are published once it does.
+        """
+        if self.publisher is None:
+            self.publisher = AsyncPublisher(self.logger,
+                                            self.get_connection_params(),
+                                            self.config, name=self.name,
+                                            confirm=self.use_confirms,
+                                            limiter=self.limiter)
+            self.publisher.start()
+        await asyncio.wait_for(self.publisher.ev_open.wait(), timeout)
+
+    async def shutdown(self):
+        if self.publisher is not None:
+            await self.publisher.stop(timeout=self.config.get('confirm_timeout', 10.0))
+            self.publisher = None
+
+    async def submit(self, job, topic=None):
+        res = JobSource.submit(self, job, topic=topic)
+        if self.use_confirms:
+            # the publisher resolves the future, so it must not be
+            # cancelled if the caller is
+            await asyncio.shield(res)
+
+    async def submit_many(self, jobs, topic=None):
+        results = JobSource.submit_many(self, jobs, topic=topic)
+        if self.use_confirms and len(results) > 0:
+            await asyncio.gather(*[asyncio.shield(res) for res in results])
+
+    def start_publish(self, job_queue=None, ev_quit=None):
+        raise TypeError("AsyncJobSource has no publishing thread; use submit() or submit_many()")
+
+    def publish_loop(self, job_queue, ev_quit):
+        raise TypeError("AsyncJobSource has no publishing thread; use submit() or submit_many()")
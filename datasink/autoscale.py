@@ -0,0 +1,163 @@
+#
+# autoscale.py -- grow and shrink a JobSink's worker pool
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Periodically resizes the worker pool of a `JobSink` between
+'min_workers' and 'max_workers', based on the depth of the local work
+queue, the depth of the broker queue(s) (via a passive `queue_declare`)
+and the utilization of the workers since the last check (including the
+time spent so far on jobs still running).
+
+The pool grows by 'autoscale_step' workers when the workers are busy and
+there is a backlog, and shrinks by the same step when they are mostly idle
+and there is no backlog.  Cooldowns keep the pool from flapping.  The
+prefetch window of the channel is kept in step with the pool size.
+
+The autoscaler runs in the connection's thread (via `call_later`), so it
+can use the connection directly.  The queues are probed on a channel of
+its own, since the broker closes the channel on which a queue that does
+not exist (e.g. a shard not yet created by the hub) is declared.  Its
+parameters are read from the sink's config each time, so they can be
+changed with a config reload.
+"""
+import time
+
+import pika
+
+from datasink import metrics
+
+_m_workers = metrics.registry.gauge(
+    'datasink_workers', "Number of workers in the pool")
+_m_broker_depth = metrics.registry.gauge(
+    'datasink_broker_queue_depth', "Messages ready in the broker queue",
+    ['queue'])
+_m_scale_events = metrics.registry.counter(
+    'datasink_autoscale_events_total', "Worker pool resize events",
+    ['direction'])
+
+
+class Autoscaler:
+
+    def __init__(self, logger, jobsink):
+        self.logger = logger
+        self.jobsink = jobsink
+
+        self.last_change = 0.0
+        self.last_time = time.time()
+        self.last_busy_time = jobsink.get_busy_time(self.last_time)
+        # channel for probing the broker queues
+        self.connection = None
+        self.probe_channel = None
+        # set by stop(), e.g. when a reload disables autoscaling
+        self.stopped = False
+
+        _m_workers.set_function(lambda: len(self.jobsink.workers))
+
+    @staticmethod
+    def is_enabled(config):
+        return 'max_workers' in config
+
+    def get_params(self):
+        config = self.jobsink.config
+        min_workers = config.get('min_workers', 1)
+        return dict(min_workers=min_workers,
+                    max_workers=max(min_workers,
+                                    config.get('max_workers', min_workers)),
+                    interval=config.get('autoscale_interval', 5.0),
+                    step=config.get('autoscale_step', 2),
+                    high_util=config.get('autoscale_high_util', 0.8),
+                    low_util=config.get('autoscale_low_util', 0.3),
+                    up_cooldown=config.get('autoscale_up_cooldown', 15.0),
+                    down_cooldown=config.get('autoscale_down_cooldown', 120.0))
+
+    def schedule(self, connection, channel):
+        """Start checking the pool on `connection` every interval."""
+        interval = self.get_params()['interval']
+        self.connection, self.probe_channel = connection, None
+
+        def _tick():
+            if self.stopped or not (connection.is_open and channel.is_open):
+                return
+            try:
+                self.check(channel)
+                interval = self.get_params()['interval']
+
+            except Exception as e:
+                self.logger.error(f"autoscaler error: {e}", exc_info=True)
+                interval = 5.0
+            connection.call_later(interval, _tick)
+
+        connection.call_later(interval, _tick)
+
+    def stop(self):
+        """Stop checking the pool; a pending check does nothing."""
+        self.stopped = True
+
+    def _get_probe_channel(self):
+        if self.probe_channel is None or not self.probe_channel.is_open:
+            self.probe_channel = self.connection.channel()
+        return self.probe_channel
+
+    def get_broker_depth(self):
+        depth = 0
+        for queue_name in self.jobsink.get_queue_names():
+            channel = self._get_probe_channel()
+            try:
+                res = channel.queue_declare(queue=queue_name, passive=True)
+
+            except pika.exceptions.ChannelClosedByBroker as e:
+                if e.reply_code != 404:
+                    raise
+                # the channel is closed; another is opened for the next one
+                self.logger.warning(f"autoscaler: no queue '{queue_name}'")
+                continue
+
+            count = res.method.message_count
+            _m_broker_depth.labels(queue_name).set(count)
+            depth += count
+        return depth
+
+    def get_utilization(self):
+        """Fraction of worker time spent on jobs since the last call."""
+        now = time.time()
+        busy_time = self.jobsink.get_busy_time(now)
+        elapsed = now - self.last_time
+        num = max(1, len(self.jobsink.workers))
+        util = 0.0
+        if elapsed > 0:
+            util = (busy_time - self.last_busy_time) / (elapsed * num)
+        self.last_time, self.last_busy_time = now, busy_time
+        return min(1.0, util)
+
+    def check(self, channel):
+        p = self.get_params()
+        util = self.get_utilization()
+        local_depth = self.jobsink.work_queue.qsize()
+        broker_depth = self.get_broker_depth()
+        num = len(self.jobsink.workers)
+        now = time.time()
+
+        target = num
+        backlog = local_depth > 0 or broker_depth > 0
+        if util >= p['high_util'] and backlog:
+            if now - self.last_change >= p['up_cooldown']:
+                target = min(p['max_workers'], num + p['step'])
+        elif util <= p['low_util'] and not backlog:
+            if now - self.last_change >= p['down_cooldown']:
+                target = max(p['min_workers'], num - p['step'])
+        # keep within limits if they were changed by a reload
+        target = min(p['max_workers'], max(p['min_workers'], target))
+
+        if target == num:
+            return
+
+        direction = 'up' if target > num else 'down'
+        self.logger.info("autoscale {}: {} -> {} workers (util={:.2f} local={} broker={})".format(
+            direction, num, target, util, local_depth, broker_depth))
+        _m_scale_events.labels(direction).inc()
+        self.last_change = now
+        self.jobsink.set_num_workers(target)
+        channel.basic_qos(prefetch_count=self.jobsink.get_prefetch_count())
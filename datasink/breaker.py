@@ -0,0 +1,150 @@
+#
+# breaker.py -- circuit breakers for transfer source hosts
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+A circuit breaker per (host, transfer method), so that when a source host
+goes down, jobs for it are deferred quickly instead of each one tying up a
+worker for the full lftp retry cycle.
+
+A breaker is CLOSED (jobs run) until the failure rate over the last
+`window` transfers reaches `failure_rate` (with at least `min_calls`
+transfers seen).  It then OPENs and jobs are rejected for `open_sec`
+seconds, after which it goes HALF_OPEN and lets up to `probes` jobs
+through to test the host.  A successful probe closes the breaker again;
+a failed one re-opens it.
+"""
+import time
+import threading
+from collections import deque
+
+from datasink import metrics
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+_state_value = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_m_state = metrics.registry.gauge(
+    'datasink_breaker_state',
+    "Circuit breaker state (0=closed, 1=half-open, 2=open)",
+    ['host', 'method'])
+_m_rejected = metrics.registry.counter(
+    'datasink_breaker_rejected_total',
+    "Jobs deferred because their circuit breaker was open",
+    ['host', 'method'])
+_m_opened = metrics.registry.counter(
+    'datasink_breaker_opened_total', "Times a circuit breaker opened",
+    ['host', 'method'])
+
+
+class CircuitBreaker:
+
+    def __init__(self, logger, key, window=20, min_calls=5,
+                 failure_rate=0.5, open_sec=60.0, probes=1):
+        self.logger = logger
+        self.key = key
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_sec = open_sec
+        self.probes = probes
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        # True for each success, False for each failure
+        self.results = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probes_out = 0
+
+        self._m_state = _m_state.labels(*key)
+        self._m_state.set(_state_value[CLOSED])
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.logger.warning("circuit breaker for {}: {} -> {}".format(
+                self.key, self.state, state))
+            self.state = state
+            self._m_state.set(_state_value[state])
+            if state == OPEN:
+                self.opened_at = time.time()
+                _m_opened.labels(*self.key).inc()
+
+    def allow(self):
+        """Return True if a job for this key may run now."""
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.open_sec:
+                    _m_rejected.labels(*self.key).inc()
+                    return False
+                self._set_state(HALF_OPEN)
+                self.probes_out = 0
+
+            if self.state == HALF_OPEN:
+                if self.probes_out >= self.probes:
+                    _m_rejected.labels(*self.key).inc()
+                    return False
+                self.probes_out += 1
+
+            return True
+
+    def record(self, success):
+        """Record the outcome of a job that was allowed to run.  `success`
+        is None if the job failed before it reached the host, which says
+        nothing about the host but frees a probe.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes_out = max(0, self.probes_out - 1)
+                if success is None:
+                    return
+                if success:
+                    self.results.clear()
+                    self._set_state(CLOSED)
+                else:
+                    self._set_state(OPEN)
+                return
+
+            if success is None:
+                return
+            self.results.append(success)
+            if self.state == CLOSED and len(self.results) >= self.min_calls:
+                failures = self.results.count(False)
+                if failures / len(self.results) >= self.failure_rate:
+                    self.results.clear()
+                    self._set_state(OPEN)
+
+
+class BreakerRegistry:
+    """Holds a CircuitBreaker for each (host, method) key."""
+
+    def __init__(self, logger, **kwargs):
+        self.logger = logger
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self.breakers = dict()
+
+    @classmethod
+    def from_config(cls, logger, config):
+        """Make a BreakerRegistry from config, or None if disabled."""
+        if not config.get('breaker_enable', False):
+            return None
+        return cls(logger, window=config.get('breaker_window', 20),
+                   min_calls=config.get('breaker_min_calls', 5),
+                   failure_rate=config.get('breaker_failure_rate', 0.5),
+                   open_sec=config.get('breaker_open_sec', 60.0),
+                   probes=config.get('breaker_probes', 1))
+
+    def get(self, key):
+        with self._lock:
+            breaker = self.breakers.get(key, None)
+            if breaker is None:
+                breaker = CircuitBreaker(self.logger, key, **self.kwargs)
+                self.breakers[key] = breaker
+            return breaker
+
+    def allow(self, key):
+        return self.get(key).allow()
+
+    def record(self, key, success):
+        self.get(key).record(success)
@@ -7,14 +7,27 @@
 #
 
 import sys
+import copy
 import time
-import json
+import logging
 import queue as Queue
 import threading
+from concurrent import futures
 
 import pika
 
-from datasink.initialize import read_config, default_topic
+from datasink.initialize import read_config, default_topic, shard_header
+from datasink import metrics, codec
+from datasink.publisher import ConfirmPublisher, PublishError
+from datasink.outbox import Outbox, OutboxFull
+from datasink.flowcontrol import FlowControl, TokenBucket, BrokerBlocked
+
+_m_published = metrics.registry.counter(
+    'datasink_jobs_published_total', "Jobs published", ['realm'])
+_m_publish_errors = metrics.registry.counter(
+    'datasink_publish_errors_total', "Errors publishing jobs", ['realm'])
+_m_job_queue_depth = metrics.registry.gauge(
+    'datasink_publish_queue_depth', "Jobs waiting to be published")
 
 
 class JobSource:
@@ -26,15 +39,59 @@ class JobSource:
 
         self.connection = None
         self.channel = None
+        self.publisher = None
+        self.outbox = None
+        self.use_confirms = False
+        self.limiter = None
+        self.flow = FlowControl(logger)
+        # job field that sharded sinks' queues are chosen by
+        self.shard_key = 'srcpath'
         self.recover_interval = 60.0
+        self.codec = codec.get_codec('json')
 
     def read_config(self, configfile):
         self.config = read_config(configfile)
 
         self.realm = self.config['realm']
         self.realm_host = self.config['realm_host']
+        self.codec = codec.get_codec(self.config.get('codec', 'json'))
+        self.default_topic = self.config.get('topic', default_topic)
+        self.properties = self.make_properties()
+        self.shard_key = self.config.get('shard_key', 'srcpath')
+        self.batch_size = self.config.get('publish_batch_size', 1)
+        # the outbox is only committed on broker confirms
+        self.use_confirms = (self.config.get('publisher_confirms', False) or
+                             self.config.get('outbox_file', None) is not None)
+        self.limiter = TokenBucket.from_config(self.config)
+
+    def get_connection_params(self):
+        auth = pika.PlainCredentials(username=self.config['realm_username'],
+                                     password=self.config['realm_password'])
+        params = pika.ConnectionParameters(host=self.realm_host,
+                                           port=self.config.get('realm_port', 5672),
+                                           # NOTE: 0 is necessary to keep
+                                           # RMQ from disconnecting us if
+                                           # we don't send anything for a
+                                           # while
+                                           heartbeat=self.config.get('realm_heartbeat', 0),
+                                           # give up on a connection that
+                                           # the broker keeps blocked
+                                           blocked_connection_timeout=self.config.get('blocked_connection_timeout', 300.0),
+                                           credentials=auth)
+        return params
 
     def connect(self):
+        if self.use_confirms:
+            # the confirming publisher manages (and recovers) its own
+            # connection in its own thread
+            if self.publisher is None:
+                self.publisher = ConfirmPublisher(self.logger,
+                                                  self.get_connection_params(),
+                                                  self.config, name=self.name,
+                                                  limiter=self.limiter)
+                self.publisher.start()
+            return
+
         # closures to avoid too many open files failures
         if self.channel is not None:
             try:
@@ -50,60 +107,159 @@ class JobSource:
                 pass
         self.connection = None
 
-        auth = pika.PlainCredentials(username=self.config['realm_username'],
-                                     password=self.config['realm_password'])
-        params = pika.ConnectionParameters(host=self.realm_host,
-                                           port=self.config.get('realm_port', 5672),
-                                           # NOTE: necessary to keep RMQ
-                                           # from disconnecting us if we
-                                           # don't send anything for a while
-                                           heartbeat=0,
-                                           credentials=auth)
+        params = self.get_connection_params()
+        self.flow.reset()
         self.connection = pika.BlockingConnection(params)
+        self.flow.register(self.connection)
         self.channel = self.connection.channel()
 
     def shutdown(self):
-        self.connection.close()
+        if self.publisher is not None:
+            # waits for outstanding confirms
+            self.publisher.stop(timeout=self.config.get('confirm_timeout', 10.0))
+            self.publisher = None
+        if self.connection is not None:
+            self.connection.close()
+        if self.outbox is not None:
+            self.outbox.close()
+            self.outbox = None
+
+    def make_properties(self):
+        """Make the message properties used for every job published."""
+        # set up message properties
+        kwargs = dict(content_type=self.codec.content_type)
+
+        persist = self.config.get('message_persist', False)
+        if persist:
+            kwargs['delivery_mode'] = 2
+
+        msg_ttl_sec = self.config.get('ttl_sec', None)
+        if msg_ttl_sec is not None:
+            # message TTL is in msec
+            message_ttl = int(msg_ttl_sec * 1000)
+            kwargs['expiration'] = str(message_ttl)
+
+        return pika.BasicProperties(**kwargs)
+
+    def make_message(self, job, topic=None):
+        """Return (topic, packet, encoded message) for `job`."""
+        pkt = dict()
+        pkt.update(job)
+        pkt.update(time_origin=time.time(),
+                   source_origin=self.name)
+
+        message = self.codec.encode(pkt)
+        # look for topic in following order: 1) submit call kwarg,
+        # 2) job dict, 3) job source config, 4) default topic
+        if topic is None:
+            topic = job.get('topic', self.default_topic)
+        return topic, pkt, message
+
+    def get_properties(self, pkt):
+        """Return the message properties for job packet `pkt`.  The job's
+        'shard_key' field goes in a header, so that sinks with sharded
+        queues get all the jobs with the same key on the same shard, in
+        order.  Jobs without that field (or with 'shard_key' set to null)
+        get the shared properties as they are.
+        """
+        if self.shard_key is None:
+            return self.properties
+        key = pkt.get(self.shard_key, None)
+        if key is None:
+            return self.properties
+        props = copy.copy(self.properties)
+        props.headers = dict(props.headers or {})
+        props.headers[shard_header] = str(key)
+        return props
+
+    def get_publisher(self):
+        """Return the confirming publisher (if configured)."""
+        return self.publisher
+
+    def _publish(self, topic, message, props):
+        if self.publisher is not None:
+            return self.publisher.publish(self.realm, topic, message, props)
+        if self.flow.is_blocked:
+            # basic_publish would stall until the broker unblocks us (or
+            # blocked_connection_timeout expires)
+            raise BrokerBlocked(f"connection to '{self.realm}' is blocked by the broker")
+        if self.limiter is not None:
+            self.limiter.take()
+        self.channel.basic_publish(exchange=self.realm,
+                                   routing_key=topic,
+                                   body=message,
+                                   properties=props)
+        return None
 
     def submit(self, job, topic=None):
+        """Publish `job`.  If 'publisher_confirms' is configured, returns a
+        Future that is resolved when the broker confirms the job.
+        """
 
         try:
-            pkt = dict()
-            pkt.update(job)
-            pkt.update(time_origin=time.time(),
-                       source_origin=self.name)
-
-            message = json.dumps(pkt)
-            # look for topic in following order: 1) submit call kwarg,
-            # 2) job dict, 3) job source config, 4) default topic
-            if topic is None:
-                topic = job.get('topic',
-                                self.config.get('topic', default_topic))
-
-            # set up message properties
-            kwargs = dict(content_type='application/json')
-
-            persist = self.config.get('message_persist', False)
-            if persist:
-                kwargs['delivery_mode'] = 2
+            topic, pkt, message = self.make_message(job, topic=topic)
+
+            res = self._publish(topic, message, self.get_properties(pkt))
+
+            _m_published.labels(self.realm).inc()
+            # NOTE: formatting the whole packet is expensive, so only
+            # do it when debugging
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("sent job: %r" % pkt)
+            else:
+                self.logger.info("sent job: action=%s id=%s topic=%s",
+                                 pkt.get('action', None), pkt.get('id', None),
+                                 topic)
+            return res
+
+        except BrokerBlocked as e:
+            self.logger.warning(f"job not sent: {e}")
+            raise e
 
-            msg_ttl_sec = self.config.get('ttl_sec', None)
-            if msg_ttl_sec is not None:
-                # message TTL is in msec
-                message_ttl = int(msg_ttl_sec * 1000)
-                kwargs['expiration'] = str(message_ttl)
+        except Exception as e:
+            _m_publish_errors.labels(self.realm).inc()
+            self.logger.error("Error submitting job to '{}': {}".format(self.realm, e),
+                              exc_info=True)
+            raise e
 
-            props = pika.BasicProperties(**kwargs)
+    def submit_many(self, jobs, topic=None):
+        """Publish a list of jobs.  The jobs are all encoded first and then
+        published back to back, and a single summary is logged.
 
-            self.channel.basic_publish(exchange=self.realm,
-                                       routing_key=topic,
-                                       body=message,
-                                       properties=props)
+        If 'publisher_confirms' is configured, returns a list of Futures,
+        one per job, otherwise None.  If an error occurs, the jobs from the
+        first one not published on are not published.
+        """
+        if len(jobs) == 0:
+            return [] if self.use_confirms else None
 
-            self.logger.info("sent job: %r" % pkt)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        try:
+            messages = [self.make_message(job, topic=topic) for job in jobs]
+
+            results = []
+            topics = set()
+            for _topic, pkt, message in messages:
+                results.append(self._publish(_topic, message,
+                                             self.get_properties(pkt)))
+                topics.add(_topic)
+                if debug:
+                    self.logger.debug("sent job: %r" % pkt)
+
+            _m_published.labels(self.realm).inc(len(messages))
+            self.logger.info("sent %d jobs: topics=%s", len(messages),
+                             ','.join(sorted(topics)))
+            if self.use_confirms:
+                return results
+            return None
+
+        except BrokerBlocked as e:
+            self.logger.warning(f"jobs not sent: {e}")
+            raise e
 
         except Exception as e:
-            self.logger.error("Error submitting job to '{}': {}".format(self.realm, e),
+            _m_publish_errors.labels(self.realm).inc()
+            self.logger.error("Error submitting jobs to '{}': {}".format(self.realm, e),
                               exc_info=True)
             raise e
 
@@ -129,37 +285,262 @@ class JobSource:
         lost if the RabbitMQ server is down--they just keep getting
         requeued in `job_queue` and will be lost if the process using
         this job source is killed before the server comes back up.
+        Configure an outbox ('outbox_file') to avoid this.
         """
         self.recover_jobsrc(ev_quit)
 
         while not ev_quit.is_set():
+            if self.flow.is_blocked and self.connection is not None:
+                # jobs wait in the queue until the broker unblocks us
+                try:
+                    self.connection.process_data_events(time_limit=0.25)
+
+                except Exception as e:
+                    self.logger.error(f"job source error: {e}",
+                                      exc_info=True)
+                    self.recover_jobsrc(ev_quit)
+                continue
+
             try:
                 job = job_queue.get(block=True, timeout=0.25)
 
             except Queue.Empty:
                 continue
 
+            # drain whatever else is waiting, up to the batch size
+            jobs = [job]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(job_queue.get(block=False))
+
+                except Queue.Empty:
+                    break
+
             try:
-                self.submit(job)
+                if len(jobs) == 1:
+                    self.submit(job)
+                else:
+                    self.submit_many(jobs)
+
+            except BrokerBlocked:
+                # blocked while publishing the batch; the jobs wait in
+                # the queue until the broker unblocks us
+                for job in jobs:
+                    job_queue.put(job)
 
             except Exception as e:
                 # Hmm, do we want to put the job back on the front?
                 # It might keep causing an error
-                job_queue.put(job)
+                # NOTE: jobs of a batch published before the error will
+                # be sent again
+                for job in jobs:
+                    job_queue.put(job)
 
                 self.recover_jobsrc(ev_quit)
 
+    def enqueue(self, jobs, topic=None, force=False):
+        """Write a list of jobs to the outbox, to be published by the
+        sender thread.  Never blocks on the broker; raises OutboxFull if
+        the outbox is full (unless `force` is True).
+        """
+        items = []
+        for job in jobs:
+            _topic, pkt, message = self.make_message(job, topic=topic)
+            items.append((_topic, message, self.codec.content_type))
+        self.outbox.put_many(items, force=force)
+
+    def intake_loop(self, job_queue, ev_quit):
+        """Move jobs from a Python queue to the outbox."""
+        while not ev_quit.is_set():
+            try:
+                job = job_queue.get(block=True, timeout=0.25)
+
+            except Queue.Empty:
+                continue
+
+            jobs = [job]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(job_queue.get(block=False))
+
+                except Queue.Empty:
+                    break
+
+            while True:
+                if ev_quit.is_set():
+                    # we already took these jobs off the queue; keep
+                    # them even if that takes the outbox over its limits
+                    try:
+                        self.enqueue(jobs, force=True)
+
+                    except Exception as e:
+                        self.logger.error("error writing {} jobs to outbox on exit; putting them back on the queue: {}".format(
+                            len(jobs), e), exc_info=True)
+                        for job in jobs:
+                            job_queue.put(job)
+                    break
+                try:
+                    self.enqueue(jobs)
+                    break
+
+                except OutboxFull as e:
+                    # jobs wait in the (unbounded) queue meanwhile
+                    self.logger.warning(f"{e}; waiting for room")
+                    ev_quit.wait(1.0)
+
+                except Exception as e:
+                    self.logger.error(f"error writing to outbox: {e}",
+                                      exc_info=True)
+                    ev_quit.wait(1.0)
+
+    def send_loop(self, ev_quit):
+        """Publish jobs from the outbox, committing them as they are
+        confirmed by the broker.
+        """
+        self.recover_jobsrc(ev_quit)
+        publisher = self.get_publisher()
+        batch_size = self.config.get('outbox_batch_size', 500)
+
+        while not ev_quit.is_set():
+            rows = self.outbox.read(batch_size)
+            if len(rows) == 0:
+                self.outbox.ev_ready.wait(0.25)
+                self.outbox.ev_ready.clear()
+                continue
+
+            results = []
+            for row_id, topic, body, content_type in rows:
+                props = self.properties
+                if self.shard_key is not None:
+                    # headers are not kept in the outbox
+                    try:
+                        props = self.get_properties(codec.decode(body,
+                                                                 content_type))
+                    except Exception as e:
+                        self.logger.warning(f"can't decode job for its shard key: {e}")
+                if content_type != props.content_type:
+                    # written with a different codec configured
+                    props = copy.copy(props)
+                    props.content_type = content_type
+                results.append(publisher.publish(self.realm, topic,
+                                                 body, props))
+
+            # wait for the confirms; the publisher holds on to the jobs
+            # through broker outages, so this can take a while
+            pending = set(results)
+            while len(pending) > 0 and not ev_quit.is_set():
+                done, pending = futures.wait(pending, timeout=1.0)
+
+            # commit up to the first job that was not confirmed; jobs
+            # that the publisher gave up on are moved aside, so that
+            # they don't block the outbox
+            num_ok, num_sent = 0, 0
+            for row, res in zip(rows, results):
+                if not res.done():
+                    break
+                exc = res.exception()
+                if exc is not None:
+                    if not isinstance(exc, PublishError):
+                        break
+                    self.logger.error("can't publish job {} from outbox; moved to failed table: {}".format(
+                        row[0], exc))
+                    self.outbox.fail(row[0], exc)
+                else:
+                    num_sent += 1
+                num_ok += 1
+            if num_ok > 0:
+                self.outbox.commit(rows[num_ok - 1][0])
+                _m_published.labels(self.realm).inc(num_sent)
+                self.logger.info("sent %d jobs from outbox", num_sent)
+
+            if num_ok < len(rows) and not ev_quit.is_set():
+                _m_publish_errors.labels(self.realm).inc()
+                self.logger.error("{} jobs from outbox not confirmed; retrying in {} sec".format(
+                    len(rows) - num_ok, self.recover_interval))
+                ev_quit.wait(self.recover_interval)
+
     def start_publish(self, job_queue=None, ev_quit=None):
         if job_queue is None:
             job_queue = Queue.Queue()
+        _m_job_queue_depth.set_function(job_queue.qsize)
         if ev_quit is not None:
             self.ev_quit = ev_quit
         else:
             ev_quit = self.ev_quit
 
+        if self.outbox is None:
+            self.outbox = Outbox.from_config(self.logger, self.config)
+        if self.outbox is not None:
+            # jobs go to the outbox first, then to the broker
+            t = threading.Thread(target=self.intake_loop,
+                                 args=[job_queue, ev_quit])
+            t.start()
+            t = threading.Thread(target=self.send_loop, args=[ev_quit])
+            t.start()
+            return
+
         t = threading.Thread(target=self.publish_loop,
                              args=[job_queue, ev_quit])
         t.start()
 
     def stop_publish(self):
         self.ev_quit.set()
+
+
+class PooledJobSource(JobSource):
+    """A JobSource that can be shared by many producer threads.
+
+    Jobs are published through a fixed pool of 'pool_size' publishers,
+    each with its own connection, channel and I/O thread.  Each producer
+    thread is assigned one publisher on its first submit and keeps using
+    it, so jobs from one thread stay in order.  Handing a job to the I/O
+    thread takes no lock.  `submit` and `submit_many` work as for a
+    JobSource; they return Futures if 'publisher_confirms' is configured.
+    """
+
+    def __init__(self, logger, name, pool_size=None):
+        super().__init__(logger, name)
+        self.pool_size = pool_size
+        self.publishers = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def connect(self):
+        if len(self.publishers) > 0:
+            # publishers recover their own connections
+            return
+        pool_size = self.pool_size
+        if pool_size is None:
+            pool_size = self.config.get('pool_size', 4)
+        params = self.get_connection_params()
+        for i in range(pool_size):
+            publisher = ConfirmPublisher(self.logger, params, self.config,
+                                         name=f"{self.name}-{i}",
+                                         confirm=self.use_confirms,
+                                         limiter=self.limiter)
+            publisher.start()
+            self.publishers.append(publisher)
+
+    def get_publisher(self):
+        """Return the publisher for the calling thread."""
+        publisher = getattr(self._local, 'publisher', None)
+        if publisher is None:
+            with self._lock:
+                publisher = self.publishers[self._next % len(self.publishers)]
+                self._next += 1
+            self._local.publisher = publisher
+        return publisher
+
+    def _publish(self, topic, message, props):
+        res = self.get_publisher().publish(self.realm, topic, message, props)
+        if self.use_confirms:
+            return res
+        return None
+
+    def shutdown(self):
+        timeout = self.config.get('confirm_timeout', 10.0)
+        for publisher in self.publishers:
+            publisher.stop(timeout=timeout)
+        self.publishers = []
+        super().shutdown()
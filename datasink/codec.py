@@ -0,0 +1,124 @@
+#
+# codec.py -- encoding and decoding of job messages
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Job messages are encoded by the job source and decoded by the job sink
+according to the AMQP `content_type` property of the message:
+
+  application/json     -- the default.  Encoded/decoded with `orjson` if it
+                          is installed, otherwise with the stdlib `json`.
+  application/msgpack  -- compact binary; requires `msgpack`.
+
+Sinks pick the decoder from the content type of each message, so old and
+new job sources can publish in the same realm.  Note that older sinks only
+understand JSON, so only configure a source with `codec: msgpack` once all
+the sinks it publishes to have been upgraded.
+"""
+import json
+
+try:
+    import orjson
+    have_orjson = True
+except ImportError:
+    have_orjson = False
+
+try:
+    import msgpack
+    have_msgpack = True
+except ImportError:
+    have_msgpack = False
+
+
+class CodecError(Exception):
+    pass
+
+
+class JSONCodec:
+    """Standard library JSON."""
+
+    name = 'json'
+    content_type = 'application/json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, buf):
+        return json.loads(buf)
+
+
+class ORJSONCodec(JSONCodec):
+    """JSON via orjson; the wire format is interchangeable with JSONCodec."""
+
+    name = 'orjson'
+
+    def encode(self, obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. non-string keys or integers > 64 bits
+            return super().encode(obj)
+
+    def decode(self, buf):
+        try:
+            return orjson.loads(buf)
+        except orjson.JSONDecodeError:
+            # e.g. NaN/Infinity written by the stdlib encoder
+            return super().decode(buf)
+
+
+class MsgpackCodec:
+    """MessagePack binary encoding."""
+
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, buf):
+        return msgpack.unpackb(buf, raw=False)
+
+
+def get_codec(name='json'):
+    """Return the codec for `name` ('json', 'stdjson', 'orjson' or
+    'msgpack').  'json' uses orjson if it is installed.
+    """
+    if name == 'json':
+        name = 'orjson' if have_orjson else 'stdjson'
+
+    if name == 'stdjson':
+        return JSONCodec()
+    if name == 'orjson':
+        if not have_orjson:
+            raise CodecError("codec 'orjson' requested, but orjson is not installed")
+        return ORJSONCodec()
+    if name == 'msgpack':
+        if not have_msgpack:
+            raise CodecError("codec 'msgpack' requested, but msgpack is not installed")
+        return MsgpackCodec()
+    raise CodecError(f"I don't know a codec named '{name}'")
+
+
+# decoders, by content type
+_decoders = {JSONCodec.content_type: get_codec('json')}
+if have_msgpack:
+    _decoders[MsgpackCodec.content_type] = MsgpackCodec()
+default_decoder = _decoders[JSONCodec.content_type]
+
+
+def decode(buf, content_type=None):
+    """Decode a message body according to its `content_type`.  Parameters
+    (e.g. "; charset=utf-8") are ignored, and messages without a content
+    type or with one we don't know are assumed to be JSON.
+    """
+    if content_type is not None:
+        content_type = content_type.split(';', 1)[0].strip().lower()
+    decoder = _decoders.get(content_type, None)
+    if decoder is not None:
+        return decoder.decode(buf)
+    if content_type == MsgpackCodec.content_type:
+        raise CodecError("got a msgpack message, but msgpack is not installed")
+    return default_decoder.decode(buf)
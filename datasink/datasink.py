@@ -10,23 +10,22 @@ $ datasink -f <configfile>
 
 """
 import sys
+import time
 import threading
 import os
 import shutil
 import tarfile
 
-from . import worker, transfer, log
+from . import worker, transfer, log, metrics, trace
+from .breaker import BreakerRegistry
+from .initialize import get_retry_delays
 
+_m_unpack_time = metrics.registry.histogram(
+    'datasink_unpack_seconds', "Time to unpack/move files after transfer")
 
-def server(options, config):
-    # Create top level logger.
-    logger = log.make_logger('datasink', options)
-
-    key = config.get('key', None)
-    if key is None:
-        self.logger.error("Configuration file contains no 'key' directive")
-        sys.exit(0)
 
+def make_settings(logger, config):
+    """Make the settings used for transfers from `config`."""
     datadir = config.get('datadir', None)
     if datadir is None:
         datadir = os.getcwd()
@@ -35,28 +34,55 @@ def server(options, config):
     else:
         logger.info(f"Storing files in {datadir}")
 
-    # if this is set, file will be moved here after transfer
-    movedir = config.get('movedir', None)
-    unpack_tarfiles = config.get('unpack_tarfiles', False)
+    storeby = config.get('storeby', None)
+    if storeby not in (None, 'propid', 'insname'):
+        raise ValueError(f"I don't know how to store by '{storeby}'")
+
+    settings = dict(config=config,
+                    # if this is set, file will be moved here after transfer
+                    movedir=config.get('movedir', None),
+                    unpack_tarfiles=config.get('unpack_tarfiles', False),
+                    # if this is set, only instruments matching this
+                    # instrument will be transferred
+                    insfilter=config.get('insfilter', None))
+
+    # takes care of transfers into datadir
+    settings['xfer'] = transfer.Transfer(logger, datadir, storeby=storeby,
+                                         md5check=config.get('md5check', False))
+    return settings
+
+
+def server(options, config, heartbeat=None):
+    # Create top level logger.
+    logger = log.make_logger('datasink', options)
 
-    # if this is set, only instruments matching this instrument
-    # will be transferred
-    insfilter = config.get('insfilter', None)
+    key = config.get('key', None)
+    if key is None:
+        self.logger.error("Configuration file contains no 'key' directive")
+        sys.exit(0)
 
     # this datasink's name
     name = key.split('-')[0]
-    queue_names = [name]
-    config['queue_names'] = queue_names
 
-    # takes care of transfers into datadir
-    xfer = transfer.Transfer(logger, datadir,
-                             storeby=config.get('storeby', None),
-                             md5check=config.get('md5check', False))
+    # settings used by xfer_file; replaced as a whole on a config reload
+    current = dict(settings=make_settings(logger, config))
+
+    # circuit breakers per (host, method), if enabled
+    breakers = BreakerRegistry.from_config(logger, config)
+    if breakers is not None and len(get_retry_delays(config)) == 0:
+        logger.warning("circuit breakers need retry tiers to defer jobs; disabled")
+        breakers = None
 
     def xfer_file(work_unit, fn_ack):
         job = work_unit['job']
+        tr = work_unit.get('trace', trace.null_trace)
         info, res = {}, {}
 
+        settings = current['settings']
+        config, xfer = settings['config'], settings['xfer']
+        insfilter, movedir = settings['insfilter'], settings['movedir']
+        unpack_tarfiles = settings['unpack_tarfiles']
+
         if insfilter is not None:
             if job['insname'] not in insfilter:
                 # ACK allows another job to be released to us
@@ -72,14 +98,59 @@ def server(options, config):
             job['username'] = config['transfer_username']
         job['direction'] = config.get('transfer_direction', 'from')
 
-        xfer.transfer(job, info, res)
+        breaker_key = (job['host'], job['transfermethod'])
+        if breakers is not None and not breakers.allow(breaker_key):
+            # host seems to be down--try this job again later
+            msg = "circuit open for {}; deferring job".format(breaker_key)
+            logger.info(msg)
+            fn_ack(False, msg, dict(defer=True))
+            return
 
-        # ACK allows another job to be released to us
-        fn_ack(True, '', {})
+        try:
+            xfer.transfer(job, info, res, trace=tr)
+
+        finally:
+            if breakers is not None:
+                # only the transfer command's result says anything about
+                # the host; local errors (e.g. md5 mismatch, bad dstpath)
+                # don't count
+                exit_code = res.get('xfer_exit', None)
+                breakers.record(breaker_key,
+                                None if exit_code is None else exit_code == 0)
+
+        if 'errmsg' in info:
+            # NACK sends the job to be retried later (or dead-lettered)
+            fn_ack(False, info['errmsg'], info)
+            return
+
+        bundle = job.get('bundle', None)
+        if bundle is not None:
+            # bundle of small files: unpack and verify before ACKing, so
+            # that a bad bundle is retried
+            dst_path = res['dst_path']
+            extract_dir = movedir
+            if extract_dir is None:
+                extract_dir = os.path.dirname(dst_path)
+            start_time = time.time()
+            try:
+                with tr.span('unpack'):
+                    xfer.unbundle(dst_path, extract_dir, bundle)
+                os.remove(dst_path)
+
+            except Exception as e:
+                errmsg = "Failed to unbundle '{}': {}".format(dst_path, e)
+                logger.error(errmsg, exc_info=True)
+                fn_ack(False, errmsg, dict(errmsg=errmsg))
+                return
+
+            _m_unpack_time.observe(time.time() - start_time)
+            fn_ack(True, '', {})
+            return
 
         # After the transfer, dictionary `res` should contain a result code.
         if 'xfer_code' not in res:
             logger.error("No result code after transfer: %s" % (str(res)))
+            fn_ack(True, '', {})
             return
 
         if res['xfer_code'] == 0:
@@ -88,6 +159,7 @@ def server(options, config):
             file_pfx, file_ext = os.path.splitext(filename)
             file_ext = file_ext.lower()
 
+            start_time = time.time()
             try:
                 if (unpack_tarfiles and
                     file_ext in ['.tar', '.tgz', '.tar.gz']):
@@ -105,19 +177,39 @@ def server(options, config):
                         move_path = os.path.join(movedir, filename)
                         shutil.move(res['dst_path'], move_path)
 
+                end_time = time.time()
+                _m_unpack_time.observe(end_time - start_time)
+                tr.add_span('unpack', start_time, end_time)
                 logger.info("unpack/move completed")
 
             except Exception as e:
                 logger.error("Error unpacking/moving file after transfer: {}".format(e),
                              exc_info=True)
 
+        # ACK only now, so that the job (or its spool entry) survives a
+        # crash while unpacking/moving; it also allows another job to be
+        # released to us
+        fn_ack(True, '', {})
+
     ev_quit = threading.Event()
 
+    metrics.start_from_config(config, logger)
+
+    def reload_settings(old_config, new_config, diff):
+        # swap in new transfer settings atomically
+        current['settings'] = make_settings(logger, new_config)
+
     jobsink = worker.JobSink(logger, name)
     jobsink.config = config
+    jobsink.configfile = getattr(options, 'conffile', None)
     jobsink.add_action('transfer', xfer_file)
+    jobsink.add_reload_callback(reload_settings)
 
     jobsink.start_workers(ev_quit)
+    if heartbeat is not None:
+        # we are run by a supervisor, which restarts us if this stops
+        threading.Thread(target=jobsink.heartbeat_loop,
+                         args=(ev_quit, heartbeat), daemon=True).start()
     jobsink.serve(ev_quit)
 
     logger.info("Exiting program.")
@@ -0,0 +1,202 @@
+#
+# dedup.py -- idempotency-key deduplication of jobs
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Redelivered, retried or duplicately submitted jobs can reach a sink more
+than once.  `DedupCache` remembers the keys of jobs that a sink has
+completed (or is working on) in a bounded LRU cache whose entries expire
+after a TTL, so that duplicates can be ACKed without being run again.
+
+The cache can optionally be snapshotted to disk periodically and on
+shutdown, so that it survives a restart of the sink.
+"""
+import os
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from datasink import metrics
+
+_m_hits = metrics.registry.counter(
+    'datasink_dedup_hits_total', "Duplicate jobs skipped")
+_m_misses = metrics.registry.counter(
+    'datasink_dedup_misses_total', "Jobs not found in the dedup cache")
+_m_size = metrics.registry.gauge(
+    'datasink_dedup_cache_size', "Entries in the dedup cache")
+_m_hit_rate = metrics.registry.gauge(
+    'datasink_dedup_hit_rate', "Fraction of jobs that were duplicates")
+
+# fields added by the job source on every submit, which therefore must
+# not be part of a content hash
+_volatile_keys = ('time_origin', 'source_origin')
+
+# results of DedupCache.check() for a duplicate
+done = 'done'
+in_progress = 'in progress'
+
+
+def job_key(job):
+    """Return the idempotency key for `job`: the job's 'id' if it has
+    one (e.g. a TransferRequest), otherwise a hash of its content.
+    """
+    _id = job.get('id', None)
+    if _id is not None:
+        return str(_id)
+    d = {key: val for key, val in job.items() if key not in _volatile_keys}
+    buf = json.dumps(d, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(buf).hexdigest()
+
+
+class DedupCache:
+    """Bounded LRU + TTL set of job keys.
+
+    Parameters
+    ----------
+      logger: logging.Logger
+          logger for messages
+      maxsize: int (optional)
+          maximum number of keys remembered
+      ttl_sec: float (optional)
+          seconds a key is remembered after the job completed
+      snapshot: str or None (optional)
+          path of a file to persist the cache to
+      snapshot_interval: float (optional)
+          seconds between snapshots
+    """
+
+    def __init__(self, logger, maxsize=100000, ttl_sec=86400.0,
+                 snapshot=None, snapshot_interval=60.0):
+        self.logger = logger
+        self.maxsize = maxsize
+        self.ttl_sec = ttl_sec
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+
+        self._lock = threading.Lock()
+        # key -> (done, timestamp)
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.ev_quit = threading.Event()
+        self.thread = None
+
+        _m_size.set_function(lambda: len(self._cache))
+        _m_hit_rate.set_function(self.hit_rate)
+
+        if self.snapshot is not None and os.path.exists(self.snapshot):
+            self.load()
+
+    @classmethod
+    def from_config(cls, logger, config):
+        """Make a DedupCache from config, or return None if disabled."""
+        if not config.get('dedup_enable', False):
+            return None
+        return cls(logger, maxsize=config.get('dedup_size', 100000),
+                   ttl_sec=config.get('dedup_ttl_sec', 86400.0),
+                   snapshot=config.get('dedup_snapshot', None),
+                   snapshot_interval=config.get('dedup_snapshot_interval', 60.0))
+
+    def check(self, key):
+        """Return `done` if `key` is a duplicate of a completed job, or
+        `in_progress` if the job with that key is still being worked on.
+        Otherwise, reserve it as in progress and return None; the caller
+        must later `commit` or `release` it.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is not None:
+                is_done, t = entry
+                if not is_done or now - t < self.ttl_sec:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    _m_hits.inc()
+                    return done if is_done else in_progress
+            self._cache[key] = (False, now)
+            self._cache.move_to_end(key)
+            self._trim()
+            self.misses += 1
+            _m_misses.inc()
+            return None
+
+    def commit(self, key):
+        """Mark `key` as successfully done."""
+        with self._lock:
+            self._cache[key] = (True, time.time())
+            self._cache.move_to_end(key)
+            self._trim()
+
+    def release(self, key):
+        """Forget `key` (e.g. because the job failed and may be retried)."""
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def _trim(self):
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def load(self):
+        try:
+            with open(self.snapshot, 'r') as in_f:
+                d = json.loads(in_f.read())
+            cutoff = time.time() - self.ttl_sec
+            with self._lock:
+                for key, t in sorted(d.items(), key=lambda item: item[1]):
+                    if t > cutoff:
+                        self._cache[key] = (True, t)
+                self._trim()
+            self.logger.info("loaded {} dedup keys from {}".format(
+                len(self._cache), self.snapshot))
+
+        except Exception as e:
+            self.logger.error(f"error loading dedup snapshot: {e}",
+                              exc_info=True)
+
+    def save(self):
+        if self.snapshot is None:
+            return
+        with self._lock:
+            # only completed jobs are persisted
+            d = {key: t for key, (is_done, t) in self._cache.items() if is_done}
+        tmppath = self.snapshot + '.tmp'
+        with open(tmppath, 'w') as out_f:
+            out_f.write(json.dumps(d))
+        os.replace(tmppath, self.snapshot)
+
+    def _save(self):
+        try:
+            self.save()
+
+        except Exception as e:
+            self.logger.error(f"error saving dedup snapshot: {e}",
+                              exc_info=True)
+
+    def snapshot_loop(self):
+        while not self.ev_quit.wait(self.snapshot_interval):
+            self._save()
+
+    def start(self):
+        if self.snapshot is not None:
+            self.thread = threading.Thread(target=self.snapshot_loop,
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.ev_quit.set()
+        if self.thread is not None:
+            self.thread.join()
+        self._save()
+        self.logger.info("dedup: {} hits, {} misses (hit rate {:.1%})".format(
+            self.hits, self.misses, self.hit_rate()))
@@ -0,0 +1,125 @@
+#
+# flowcontrol.py -- broker flow control and publish rate limiting
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`FlowControl` tracks the `connection.blocked`/`connection.unblocked`
+notifications that RabbitMQ sends when a memory or disk alarm goes off,
+so that publishers can hold jobs back (instead of stalling inside
+`basic_publish`) while the broker is refusing them.  Where there is no
+buffer to hold them in (a direct `JobSource.submit`), `BrokerBlocked` is
+raised instead.
+
+`TokenBucket` is a token-bucket rate limiter for smoothing bursts of
+publishes to 'publish_rate' jobs/sec, with bursts of up to
+'publish_burst' jobs.
+"""
+import time
+import threading
+
+from datasink import metrics
+
+_m_blocked = metrics.registry.gauge(
+    'datasink_publish_blocked_connections',
+    "Publishing connections currently blocked by the broker")
+_m_blocked_time = metrics.registry.counter(
+    'datasink_publish_blocked_seconds_total',
+    "Time publishing connections have spent blocked by the broker")
+_m_throttled = metrics.registry.counter(
+    'datasink_publish_throttled_total',
+    "Times publishing was held back by the publish rate limit")
+
+
+class BrokerBlocked(Exception):
+    """Raised when publishing directly on a connection that the broker
+    has blocked; the caller should hold on to the job and try again.
+    """
+    pass
+
+
+class FlowControl:
+
+    def __init__(self, logger, on_unblocked=None):
+        self.logger = logger
+        self.on_unblocked_cb = on_unblocked
+        self.blocked_since = None
+
+    @property
+    def is_blocked(self):
+        return self.blocked_since is not None
+
+    def register(self, connection):
+        connection.add_on_connection_blocked_callback(self.on_blocked)
+        connection.add_on_connection_unblocked_callback(self.on_unblocked)
+
+    def on_blocked(self, connection, frame):
+        if self.blocked_since is None:
+            self.blocked_since = time.time()
+            _m_blocked.inc()
+        self.logger.warning("connection blocked by broker: {}".format(
+            frame.method.reason))
+
+    def on_unblocked(self, connection, frame):
+        blocked_time = self.reset()
+        self.logger.info(f"connection unblocked after {blocked_time:.1f} sec")
+        if self.on_unblocked_cb is not None:
+            self.on_unblocked_cb()
+
+    def reset(self):
+        """Clear the blocked state (e.g. when the connection is closed).
+        Returns the time that the connection was blocked.
+        """
+        if self.blocked_since is None:
+            return 0.0
+        blocked_time = time.time() - self.blocked_since
+        self.blocked_since = None
+        _m_blocked.dec()
+        _m_blocked_time.inc(blocked_time)
+        return blocked_time
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate)
+        self.burst = float(burst)
+
+        self._lock = threading.Lock()
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    @classmethod
+    def from_config(cls, config):
+        """Make a TokenBucket from config, or return None if no
+        'publish_rate' is configured.
+        """
+        rate = config.get('publish_rate', None)
+        if rate is None:
+            return None
+        return cls(rate, burst=config.get('publish_burst', None))
+
+    def try_take(self, n=1):
+        """Take `n` tokens if they are available and return 0, otherwise
+        return the time in seconds until they will be.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            _m_throttled.inc()
+            return (n - self.tokens) / self.rate
+
+    def take(self, n=1):
+        """Take `n` tokens, sleeping until they are available."""
+        delay = self.try_take(n)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.try_take(n)
@@ -7,12 +7,34 @@
 import yaml
 import pika
 
+from datasink import metrics
+
 default_topic = 'general'
 
+# exchange that delayed retries are routed back to sink queues through;
+# retry tier N is the exchange and queue named "<retry_exchange>.N"
+retry_exchange = 'dlx.retry'
 
-def setup_queue(channel, queue_name, dct, config, bind=True):
-    """Create queue if necessary and associates it with the exchange,
-    so that it will receive messages sent to the exchange.
+# a sharded sink's queues are fed by a consistent-hash exchange that
+# hashes this header (set by job sources, by default to the job's srcpath)
+shard_header = 'x-ds-shard-key'
+
+_m_dead_letters = metrics.registry.counter(
+    'datasink_dead_letters_total', "Dead letters received by the hub",
+    ['reason'])
+
+
+def queue_arguments(dct, config):
+    """Return (durable, auto_delete, arguments) for declaring a sink queue
+    with configuration `dct`.
+
+    Besides 'persist', 'transient', 'priority', 'queue_length' and
+    'ttl_sec', a queue may set 'queue_length_bytes' (x-max-length-bytes),
+    'overflow' (drop-head, reject-publish or reject-publish-dlx),
+    'queue_mode' ('lazy' keeps messages on disk, for deep backlogs),
+    'queue_type' ('classic' or 'quorum'; quorum queues are always durable)
+    and 'single_active_consumer' (only one consumer at a time gets jobs,
+    the others stand by, which keeps the jobs in order across sinks).
     """
     priority = dct.get('priority', config.get('default_priority', 1))
 
@@ -20,32 +42,144 @@ def setup_queue(channel, queue_name, dct, config, bind=True):
     durable = dct.get('persist', False)
     auto_delete = dct.get('transient', True)
 
+    overflow = dct.get('overflow', 'drop-head')
+    if overflow not in ('drop-head', 'reject-publish', 'reject-publish-dlx'):
+        raise ValueError(f"bad overflow policy '{overflow}'")
+
     args = {'x-priority': priority,
-            'x-overflow': 'drop-head',
+            'x-overflow': overflow,
             'x-dead-letter-exchange': 'dlx',
             #'x-dead-letter-routing-key': queue_name,
             }
     if 'queue_length' in dct:
-        args['x-max-length'] = dct['queue_length'],
+        args['x-max-length'] = int(dct['queue_length'])
+    if 'queue_length_bytes' in dct:
+        args['x-max-length-bytes'] = int(dct['queue_length_bytes'])
     if 'ttl_sec' in dct:
         args['x-message-ttl'] = int(1000 * dct['ttl_sec'])
 
-    # NOTE: if auto_delete==True, the queue is deleted when the
-    #       client exits
-    channel.queue_declare(queue=queue_name, durable=durable,
-                          auto_delete=auto_delete, arguments=args)
+    queue_type = dct.get('queue_type', 'classic')
+    if queue_type == 'quorum':
+        if 'queue_mode' in dct:
+            raise ValueError("'queue_mode' does not apply to quorum queues")
+        if overflow == 'reject-publish-dlx':
+            raise ValueError("quorum queues do not support 'reject-publish-dlx'")
+        # quorum queues are replicated on disk and can't be auto-deleted
+        durable, auto_delete = True, False
+        args['x-queue-type'] = 'quorum'
+    elif queue_type != 'classic':
+        raise ValueError(f"bad queue type '{queue_type}'")
+
+    if 'queue_mode' in dct:
+        args['x-queue-mode'] = dct['queue_mode']
+    if dct.get('single_active_consumer', False):
+        args['x-single-active-consumer'] = True
+
+    return durable, auto_delete, args
+
+
+def shard_exchange_name(queue_name):
+    return '{}.shards'.format(queue_name)
+
+def shard_queue_names(queue_name, num_shards=1):
+    """Return the names of the queues of a sink with `num_shards` shards.
+    Shard 0 is the sink's own queue, so a sink can go from one queue to
+    several (and back) without moving the jobs already queued.
+    """
+    return [queue_name] + ['{}.{}'.format(queue_name, i)
+                           for i in range(1, num_shards)]
+
+def setup_shard_exchange(channel, queue_name, durable=False):
+    """Declare the exchange that spreads a sharded sink's jobs over its
+    shard queues by a hash of the `shard_header`.  Needs the
+    rabbitmq_consistent_hash_exchange plugin.
+    """
+    channel.exchange_declare(exchange=shard_exchange_name(queue_name),
+                             exchange_type='x-consistent-hash',
+                             durable=durable,
+                             arguments={'hash-header': shard_header})
+
+def bind_topic(channel, queue_name, topic, config, num_shards=1,
+               unbind=False):
+    """Bind (or unbind) sink `queue_name` to `topic` on the realm exchange.
+    For a sharded sink its shard exchange is bound instead of the queue.
+    """
+    realm = config['realm']
+    if num_shards > 1:
+        if unbind:
+            channel.exchange_unbind(destination=shard_exchange_name(queue_name),
+                                    source=realm, routing_key=topic)
+        else:
+            channel.exchange_bind(destination=shard_exchange_name(queue_name),
+                                  source=realm, routing_key=topic)
+    elif unbind:
+        channel.queue_unbind(queue=queue_name, exchange=realm,
+                             routing_key=topic)
+    else:
+        channel.queue_bind(queue=queue_name, exchange=realm,
+                           routing_key=topic)
+
+def queue_bindings(queue_name, dct, config):
+    """Return a dict of queue name -> set of (exchange, routing_key)
+    bindings for the queue(s) of sink `queue_name` with configuration
+    `dct`; there is one queue per shard ('shards', default 1).  The
+    realm binding of a sharded sink is on its shard exchange, so it is
+    not included.
+    """
+    num_shards = dct.get('shards', 1)
+    res = dict()
+    for name in shard_queue_names(queue_name, num_shards):
+        bindings = set()
+        if num_shards > 1:
+            # weight of the shard in the consistent hash
+            bindings.add((shard_exchange_name(queue_name), '1'))
+        elif dct.get('enabled', False):
+            bindings.add((config['realm'], dct.get('topic', default_topic)))
+        if len(get_retry_delays(config)) > 0:
+            bindings.add((retry_exchange, name))
+        res[name] = bindings
+    return res
 
+
+def setup_queue(channel, queue_name, dct, config, bind=True):
+    """Create queue if necessary and associates it with the exchange,
+    so that it will receive messages sent to the exchange.
+
+    If 'shards' is more than 1, a queue is created per shard, fed by
+    the sink's shard exchange, and the shard exchange is bound instead.
+    """
+    durable, auto_delete, args = queue_arguments(dct, config)
+    num_shards = dct.get('shards', 1)
     topic = dct.get('topic', default_topic)
+    if num_shards > 1:
+        setup_shard_exchange(channel, queue_name,
+                             durable=config.get('persist', False))
+
+    for name in shard_queue_names(queue_name, num_shards):
+        # NOTE: if auto_delete==True, the queue is deleted when the
+        #       client exits
+        channel.queue_declare(queue=name, durable=durable,
+                              auto_delete=auto_delete, arguments=args)
+
+        if len(get_retry_delays(config)) > 0:
+            # receive jobs coming back from the retry tiers
+            channel.queue_bind(queue=name, exchange=retry_exchange,
+                               routing_key=name)
+
+        if num_shards > 1:
+            channel.queue_bind(queue=name,
+                               exchange=shard_exchange_name(queue_name),
+                               routing_key='1')
+
     # NOTE: queue should be disabled before changing routing key (topic)
     # and then re-enabling
-    if bind:
-        channel.queue_bind(queue=queue_name,
-                           exchange=config['realm'],
-                           # NOTE: acts as a selector for messages to this queue
-                           routing_key=topic)
-    else:
-        channel.queue_unbind(queue=queue_name,
-                             exchange=config['realm'],
+    # NOTE: the topic acts as a selector for messages to this queue
+    bind_topic(channel, queue_name, topic, config, num_shards=num_shards,
+               unbind=not bind)
+
+    if num_shards > 1:
+        # jobs come through the shard exchange now
+        channel.queue_unbind(queue=queue_name, exchange=config['realm'],
                              routing_key=topic)
 
 
@@ -53,9 +187,8 @@ def unlink_queue(channel, queue_name, dct, config):
     """Disassociates this queue from the exchange, so that it won't receive
        messages sent to the exchange.
     """
-    channel.queue_unbind(queue=queue_name,
-                         exchange=config['realm'],
-                         routing_key=dct.get('topic', default_topic))
+    bind_topic(channel, queue_name, dct.get('topic', default_topic), config,
+               num_shards=dct.get('shards', 1), unbind=True)
 
 def purge_queue(channel, queue_name):
     """Purge all messages from the named queue.
@@ -69,6 +202,7 @@ def remove_queue(channel, queue_name):
     channel.queue_delete(queue=queue_name)
 
 def example_dlx_cb(ch, method, properties, body):
+    _m_dead_letters.labels(properties.headers['x-death'][0]['reason']).inc()
     print(" [x] %r" % (properties,))
     print(" [reason] : %s : %r" % (properties.headers['x-death'][0]['reason'], body))
     ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -78,6 +212,50 @@ def handle_dlx(channel, config, callback):
                           on_message_callback=callback)
     channel.start_consuming()
 
+def get_retry_delays(config):
+    """Return the list of delays (sec) for the retry tiers in `config`.
+    Either 'retry_delays_sec' lists them explicitly, or there are
+    'retry_max_attempts' tiers with exponentially increasing delays
+    starting at 'retry_base_sec' and growing by 'retry_factor'.
+    An empty list means failed jobs are dead-lettered right away.
+    """
+    delays = config.get('retry_delays_sec', None)
+    if delays is None:
+        max_attempts = config.get('retry_max_attempts', 0)
+        base = config.get('retry_base_sec', 10.0)
+        factor = config.get('retry_factor', 4.0)
+        delays = [base * factor ** i for i in range(max_attempts)]
+    return list(delays)
+
+def retry_tier_name(tier):
+    return '{}.{}'.format(retry_exchange, tier)
+
+def setup_retry_tiers(channel, config, durable=False):
+    """Declare the delay queues for retrying failed jobs.
+
+    A failed job on its Nth attempt is published by the sink to the fanout
+    exchange of tier N, with the sink's queue name as routing key.  It
+    waits in the tier's queue (without occupying a sink) until its TTL
+    expires, and is then dead-lettered--keeping its routing key--to the
+    `retry_exchange`, which routes it back to the sink's queue.
+    """
+    delays = get_retry_delays(config)
+    if len(delays) == 0:
+        return
+
+    channel.exchange_declare(exchange=retry_exchange, exchange_type='direct',
+                             durable=durable)
+
+    for i, delay in enumerate(delays):
+        name = retry_tier_name(i + 1)
+        channel.exchange_declare(exchange=name, exchange_type='fanout',
+                                 durable=durable)
+        args = {'x-message-ttl': int(1000 * delay),
+                'x-dead-letter-exchange': retry_exchange,
+                }
+        channel.queue_declare(queue=name, durable=durable, arguments=args)
+        channel.queue_bind(queue=name, exchange=name)
+
 def read_config(keys_file):
 
     if not keys_file.endswith('.yml'):
@@ -121,4 +299,7 @@ def configure_exchange(config):
                        #routing_key='task_queue', # x-dead-letter-routing-key
                        queue=config['backlog_queue'])
 
+    # declare delay queues for retrying failed jobs, if configured
+    setup_retry_tiers(channel, config, durable=durable)
+
     return connection, channel
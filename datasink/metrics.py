@@ -0,0 +1,357 @@
+#
+# metrics.py -- in-process metrics for sinks, sources and the hub
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+A small in-process metrics registry with counters, gauges and fixed-bucket
+histograms, which can be exposed on a local HTTP endpoint in the Prometheus
+text exposition format.
+
+Typical use:
+
+    from datasink import metrics
+
+    jobs_done = metrics.registry.counter('datasink_jobs_total',
+                                         "Jobs processed", ['action'])
+    jobs_done.labels('transfer').inc()
+
+    metrics.start_http_server(9100)
+
+Updating a metric is a dictionary lookup plus an addition under an
+uncontended lock, so it is cheap enough to leave on in the hot path.
+"""
+import bisect
+import threading
+import urllib.request
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# default histogram buckets (seconds)
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_value(val):
+    if val == float('inf'):
+        return '+Inf'
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return repr(val)
+
+
+def _format_labels(names, values, extra=None):
+    items = list(zip(names, values))
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (name, str(value).replace('"', '\\"'))
+                           for name, value in items]) + '}'
+
+
+class _Metric:
+
+    mtype = 'untyped'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = dict()
+
+    def labels(self, *values):
+        """Return the child metric for a particular set of label values."""
+        if len(values) != len(self.labelnames):
+            raise ValueError("metric '{}' expects labels {}".format(
+                self.name, self.labelnames))
+        try:
+            return self._children[values]
+        except KeyError:
+            with self._lock:
+                child = self._children.get(values, None)
+                if child is None:
+                    child = self._new_child()
+                    self._children[values] = child
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Yield (labelvalues, child) for all children of this metric."""
+        if len(self.labelnames) == 0:
+            yield ((), self.labels())
+        else:
+            for values, child in list(self._children.items()):
+                yield (values, child)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.doc),
+                 "# TYPE {} {}".format(self.name, self.mtype)]
+        for values, child in self._samples():
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+    # convenience methods for metrics without labels
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class _CounterValue:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def get(self):
+        return self.value
+
+    def render(self, name, labelnames, values):
+        return ["{}{} {}".format(name, _format_labels(labelnames, values),
+                                 _format_value(self.get()))]
+
+
+class _GaugeValue(_CounterValue):
+
+    def __init__(self):
+        super().__init__()
+        self.fn = None
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, fn):
+        """Have the value of this gauge computed by `fn` at collection."""
+        self.fn = fn
+
+    def get(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+
+class _HistogramValue:
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        # one counter per bucket, plus one for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def render(self, name, labelnames, values):
+        lines = []
+        total = 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            lines.append("{}_bucket{} {}".format(
+                name, _format_labels(labelnames, values,
+                                     extra=('le', _format_value(float(le)))),
+                total))
+        labels = _format_labels(labelnames, values)
+        lines.append("{}_sum{} {}".format(name, labels, _format_value(self.sum)))
+        lines.append("{}_count{} {}".format(name, labels, total))
+        return lines
+
+
+class Counter(_Metric):
+    """A value that only goes up (e.g. number of messages received)."""
+
+    mtype = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class Gauge(_Metric):
+    """A value that can go up and down (e.g. a queue depth)."""
+
+    mtype = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set_function(self, fn):
+        self.labels().set_function(fn)
+
+
+class Histogram(_Metric):
+    """Counts observations (e.g. latencies) into fixed buckets."""
+
+    mtype = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=default_buckets):
+        super().__init__(name, doc, labelnames=labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = dict()
+
+    def _get_or_make(self, klass, name, doc, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name, None)
+            if metric is None:
+                metric = klass(name, doc, labelnames=labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, klass):
+                raise ValueError("metric '{}' already registered as a {}".format(
+                    name, metric.mtype))
+            return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._get_or_make(Counter, name, doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._get_or_make(Gauge, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=default_buckets):
+        return self._get_or_make(Histogram, name, doc, labelnames,
+                                 buckets=buckets)
+
+    def render(self):
+        """Return the registry contents in Prometheus text format."""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# the default registry for this process
+registry = Registry()
+
+
+def merge_text(texts):
+    """Merge several Prometheus text expositions (e.g. from the worker
+    processes of one sink) into one.  Samples with the same name and labels
+    are summed, except for gauges whose names end in '_ratio' or '_rate',
+    which are averaged.
+    """
+    headers = OrderedDict()
+    samples = OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if len(line.strip()) == 0:
+                continue
+            if line.startswith('#'):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    family = parts[2]
+                    headers.setdefault(family, OrderedDict())
+                    headers[family].setdefault(parts[1], line)
+                continue
+            key, _, value = line.rpartition(' ')
+            lst = samples.setdefault((family, key), [])
+            lst.append(float(value))
+
+    lines = []
+    for family, hdrs in headers.items():
+        lines.extend(hdrs.values())
+        average = family.endswith('_ratio') or family.endswith('_rate')
+        for (_family, key), values in samples.items():
+            if _family != family:
+                continue
+            value = sum(values)
+            if average:
+                value /= len(values)
+            lines.append("{} {}".format(key, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class Aggregator:
+    """Serves the merged metrics of several other metrics endpoints."""
+
+    def __init__(self, urls, timeout=2.0):
+        self.urls = list(urls)
+        self.timeout = timeout
+
+    def render(self):
+        texts = []
+        for url in self.urls:
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as resp:
+                    texts.append(resp.read().decode('utf-8'))
+            except Exception:
+                # process may be restarting
+                continue
+        return merge_text(texts)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        buf = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(buf)))
+        self.end_headers()
+        self.wfile.write(buf)
+
+    def log_message(self, format, *args):
+        # don't clutter stderr with a line for every scrape
+        pass
+
+
+def start_http_server(port, host='localhost', registry=registry):
+    """Serve `registry` (or anything with a `render` method returning
+    Prometheus text) at http://host:port/metrics from a daemon thread.
+    Returns the server; call its `shutdown` method to stop it.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,),
+                   dict(registry=registry))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+def start_from_config(config, logger):
+    """Start the metrics endpoint if 'metrics_port' is set in `config`."""
+    port = config.get('metrics_port', None)
+    if port is None:
+        return None
+    host = config.get('metrics_host', 'localhost')
+    server = start_http_server(int(port), host=host)
+    logger.info(f"serving metrics on http://{host}:{port}/metrics")
+    return server
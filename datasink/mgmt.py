@@ -0,0 +1,95 @@
+#
+# mgmt.py -- minimal client for the RabbitMQ management HTTP API
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+A small client for the parts of the RabbitMQ management HTTP API that the
+hub tools use.  It is optional: set 'mgmt_url' (e.g.
+"http://localhost:15672") in the realm configuration to use it; the
+realm credentials are used unless 'mgmt_username'/'mgmt_password' are
+given.
+"""
+import json
+import base64
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+class ManagementError(Exception):
+    pass
+
+
+class ManagementAPI:
+
+    def __init__(self, url, username, password, vhost='/', timeout=5.0):
+        self.url = url.rstrip('/')
+        self.vhost = urllib.parse.quote(vhost, safe='')
+        self.timeout = timeout
+        creds = "{}:{}".format(username, password).encode('utf-8')
+        self.auth = "Basic " + base64.b64encode(creds).decode('ascii')
+
+    @classmethod
+    def from_config(cls, config):
+        """Make a ManagementAPI from config, or return None if no
+        'mgmt_url' is configured.
+        """
+        url = config.get('mgmt_url', None)
+        if url is None:
+            return None
+        return cls(url, config.get('mgmt_username', config['realm_username']),
+                   config.get('mgmt_password', config['realm_password']),
+                   vhost=config.get('realm_vhost', '/'))
+
+    def get(self, path):
+        """GET `path` (under /api) and return the decoded JSON, or None if
+        it does not exist.
+        """
+        req = urllib.request.Request(self.url + '/api/' + path,
+                                     headers={'Authorization': self.auth})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read())
+
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise ManagementError(f"GET {path}: {e}")
+
+        except (urllib.error.URLError, OSError) as e:
+            raise ManagementError(f"GET {path}: {e}")
+
+    def get_queue(self, queue_name):
+        return self.get('queues/{}/{}'.format(
+            self.vhost, urllib.parse.quote(queue_name, safe='')))
+
+    def get_queues(self, columns=None):
+        """Return all the queues in the vhost in one request."""
+        path = 'queues/{}'.format(self.vhost)
+        if columns is not None:
+            path += '?columns=' + ','.join(columns)
+        return self.get(path) or []
+
+    def get_bindings(self, queue_name):
+        """Return the (exchange, routing_key) bindings of a queue, not
+        counting the default exchange.
+        """
+        res = self.get('queues/{}/{}/bindings'.format(
+            self.vhost, urllib.parse.quote(queue_name, safe='')))
+        return set([(b['source'], b['routing_key']) for b in res or []
+                    if b['source'] != ''])
+
+    def get_exchange(self, exchange):
+        return self.get('exchanges/{}/{}'.format(
+            self.vhost, urllib.parse.quote(exchange, safe='')))
+
+    def get_exchange_bindings(self, source, destination):
+        """Return the routing keys binding exchange `destination` to
+        exchange `source`.
+        """
+        res = self.get('bindings/{}/e/{}/e/{}'.format(
+            self.vhost, urllib.parse.quote(source, safe=''),
+            urllib.parse.quote(destination, safe='')))
+        return set([b['routing_key'] for b in res or []])
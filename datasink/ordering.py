@@ -0,0 +1,145 @@
+#
+# ordering.py -- run jobs with the same key in order, coalesce superseded jobs
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`KeyedWorkQueue` is the work queue of a `JobSink`.  Work units may carry
+an 'order_key' (the value of the job field named by the sink's
+'order_key' setting, e.g. 'dstpath').  At most one work unit per key is
+handed out to the workers at a time: units that arrive while one with the
+same key is being worked on wait in that key's lane, and the next one is
+released when the worker calls `release` on the previous one.  So jobs
+with the same key run one at a time, in the order they were received,
+while jobs with different keys (or none) run in parallel.
+
+Units are put on the queue in delivery order (from the connection's
+thread), which is what makes the order of each lane the order of the
+broker queue.  Across several sink processes on the same queue order
+also needs the queue to have a single active consumer (see
+'single_active_consumer' in the hub configuration).  A sink with an
+'order_key' can't have retry tiers: a failed job is sent to a retry tier
+and ACKed, and the next job with its key would then run ahead of it, so
+`JobSink.validate_config` rejects the combination.
+
+Work units may also carry a 'coalesce_key' (see the sink's
+'coalesce_key' setting, e.g. 'dstpath').  When a work unit arrives while
+an older one with the same key is still waiting to be worked on, the
+older one is superseded: a worker that gets it finds that `claim` returns
+False, and ACKs it without running it.  Which one is older is decided by
+the jobs' 'time_origin' (when they were submitted), so that a job coming
+back from a retry tier does not supersede a newer version of itself.
+Only jobs in the local window (the work queue, i.e. up to the prefetch
+count) can be coalesced.
+"""
+import queue
+import threading
+from collections import deque
+
+from datasink import metrics
+
+_m_keys_busy = metrics.registry.gauge(
+    'datasink_order_keys_busy', "Order keys with a job being worked on")
+_m_waiting = metrics.registry.gauge(
+    'datasink_order_jobs_waiting', "Jobs waiting for a job with the same order key")
+
+
+class KeyedWorkQueue(queue.Queue):
+
+    def __init__(self):
+        super().__init__()
+        # key -> deque of waiting work units; a key is present while a
+        # work unit with that key is queued or being worked on
+        self._lanes = dict()
+        self._num_waiting = 0
+        # coalesce key -> latest work unit not yet claimed by a worker
+        self._latest = dict()
+        self._lanes_lock = threading.Lock()
+
+        _m_keys_busy.set_function(lambda: len(self._lanes))
+        _m_waiting.set_function(lambda: self._num_waiting)
+
+    def _supersede(self, work_unit):
+        ckey = work_unit.get('coalesce_key', None)
+        if ckey is None:
+            return
+        old = self._latest.get(ckey, None)
+        if old is not None:
+            old_time = old['job'].get('time_origin', None)
+            new_time = work_unit['job'].get('time_origin', None)
+            if old_time is not None and new_time is not None and \
+               new_time < old_time:
+                # this one is the older version
+                work_unit['superseded'] = True
+                return
+            old['superseded'] = True
+        self._latest[ckey] = work_unit
+
+    def put(self, work_unit, block=True, timeout=None):
+        key = work_unit.get('order_key', None)
+        if key is None and work_unit.get('coalesce_key', None) is None:
+            super().put(work_unit, block=block, timeout=timeout)
+            return
+
+        with self._lanes_lock:
+            self._supersede(work_unit)
+            if key is not None:
+                lane = self._lanes.get(key, None)
+                if lane is not None:
+                    # wait for the one in progress
+                    lane.append(work_unit)
+                    self._num_waiting += 1
+                    return
+                self._lanes[key] = deque()
+        super().put(work_unit, block=block, timeout=timeout)
+
+    def claim(self, work_unit):
+        """Called when a worker gets `work_unit`.  Returns False if it has
+        been superseded by a newer one (and should not be run).
+        """
+        ckey = work_unit.get('coalesce_key', None)
+        if ckey is None:
+            return True
+        with self._lanes_lock:
+            if work_unit.get('superseded', False):
+                return False
+            # newer ones arriving from now on don't supersede it
+            if self._latest.get(ckey, None) is work_unit:
+                del self._latest[ckey]
+        return True
+
+    def release(self, work_unit):
+        """Called when a worker is done with `work_unit`; releases the next
+        work unit with the same key, if any.
+        """
+        key = work_unit.get('order_key', None)
+        if key is None:
+            return
+        with self._lanes_lock:
+            lane = self._lanes.get(key, None)
+            if lane is None:
+                return
+            if len(lane) == 0:
+                del self._lanes[key]
+                return
+            next_unit = lane.popleft()
+            self._num_waiting -= 1
+        super().put(next_unit)
+
+    def take_waiting(self):
+        """Remove and return all the work units waiting in lanes (e.g. to
+        requeue them at the broker on shutdown).
+        """
+        with self._lanes_lock:
+            res = []
+            for lane in self._lanes.values():
+                res.extend(lane)
+                lane.clear()
+            self._num_waiting = 0
+            self._latest.clear()
+        return res
+
+    def qsize(self):
+        # includes the work units waiting in lanes
+        return super().qsize() + self._num_waiting
@@ -0,0 +1,174 @@
+#
+# outbox.py -- durable local outbox for a job source
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+A durable local outbox (SQLite in WAL mode) in front of a `JobSource`.
+
+Jobs are encoded and written to the outbox first, so they survive the
+producer process dying while the broker is unreachable.  A sender thread
+reads them back in order, in batches, publishes them with publisher
+confirms and commits the outbox up to the last job confirmed, which
+removes the jobs before that point.
+
+The outbox can be capped with 'outbox_max_jobs' and 'outbox_max_bytes';
+writing to a full outbox raises `OutboxFull` rather than blocking.
+
+Jobs that the broker refuses for good (e.g. returned as unroutable until
+the publisher gives up) are moved to the 'outbox_failed' table with the
+error, so that they don't hold up the jobs behind them; they can be
+inspected and resubmitted from there.
+"""
+import time
+import sqlite3
+import threading
+
+from datasink import metrics
+
+_m_depth = metrics.registry.gauge(
+    'datasink_outbox_depth', "Jobs in the local outbox")
+_m_bytes = metrics.registry.gauge(
+    'datasink_outbox_bytes', "Bytes of jobs in the local outbox")
+_m_written = metrics.registry.counter(
+    'datasink_outbox_jobs_written_total', "Jobs spilled to the local outbox")
+_m_rejected = metrics.registry.counter(
+    'datasink_outbox_jobs_rejected_total',
+    "Jobs that could not be written because the outbox was full")
+_m_failed = metrics.registry.counter(
+    'datasink_outbox_jobs_failed_total',
+    "Jobs moved to the failed table because they could not be published")
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Outbox:
+
+    def __init__(self, logger, path, max_jobs=None, max_bytes=None,
+                 sync='normal'):
+        self.logger = logger
+        self.path = path
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # set when jobs are written
+        self.ev_ready = threading.Event()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous={}".format(
+            {'full': 'FULL', 'normal': 'NORMAL', 'off': 'OFF'}[sync]))
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                             id INTEGER PRIMARY KEY AUTOINCREMENT,
+                             topic TEXT, body BLOB, content_type TEXT,
+                             time_written REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outbox_failed (
+                             id INTEGER PRIMARY KEY,
+                             topic TEXT, body BLOB, content_type TEXT,
+                             time_written REAL, time_failed REAL,
+                             error TEXT)""")
+        row = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM outbox").fetchone()
+        self.num_jobs, self.num_bytes = row
+
+        _m_depth.set_function(lambda: self.num_jobs)
+        _m_bytes.set_function(lambda: self.num_bytes)
+
+    @classmethod
+    def from_config(cls, logger, config):
+        """Make an Outbox from config, or return None if not configured."""
+        path = config.get('outbox_file', None)
+        if path is None:
+            return None
+        return cls(logger, path, max_jobs=config.get('outbox_max_jobs', None),
+                   max_bytes=config.get('outbox_max_bytes', None),
+                   sync=config.get('outbox_sync', 'normal'))
+
+    def put_many(self, items, force=False):
+        """Durably store jobs.  `items` is a list of (topic, body,
+        content_type) tuples.  Raises OutboxFull (and stores none of
+        them) if they would take the outbox over its limits, unless
+        `force` is True.
+        """
+        nbytes = sum([len(body) for topic, body, content_type in items])
+        now = time.time()
+        with self._lock:
+            if not force and ((self.max_jobs is not None and
+                 self.num_jobs + len(items) > self.max_jobs) or
+                (self.max_bytes is not None and
+                 self.num_bytes + nbytes > self.max_bytes)):
+                _m_rejected.inc(len(items))
+                raise OutboxFull("outbox {} is full ({} jobs, {} bytes)".format(
+                    self.path, self.num_jobs, self.num_bytes))
+
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT INTO outbox (topic, body, content_type, time_written) VALUES (?, ?, ?, ?)",
+                    [(topic, body, content_type, now)
+                     for topic, body, content_type in items])
+                self.db.execute("COMMIT")
+
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.num_jobs += len(items)
+            self.num_bytes += nbytes
+        _m_written.inc(len(items))
+        self.ev_ready.set()
+
+    def read(self, limit):
+        """Return up to `limit` uncommitted jobs as (id, topic, body,
+        content_type) tuples, oldest first.
+        """
+        with self._lock:
+            return self.db.execute(
+                "SELECT id, topic, body, content_type FROM outbox ORDER BY id LIMIT ?",
+                (limit,)).fetchall()
+
+    def commit(self, last_id):
+        """Commit the outbox up to and including job `last_id`."""
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                row = self.db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM outbox WHERE id <= ?",
+                    (last_id,)).fetchone()
+                self.db.execute("DELETE FROM outbox WHERE id <= ?", (last_id,))
+                self.db.execute("COMMIT")
+
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.num_jobs -= row[0]
+            self.num_bytes -= row[1]
+
+    def fail(self, row_id, error):
+        """Move job `row_id` out of the outbox to the failed table."""
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                row = self.db.execute(
+                    "SELECT LENGTH(body) FROM outbox WHERE id = ?",
+                    (row_id,)).fetchone()
+                self.db.execute(
+                    "INSERT OR REPLACE INTO outbox_failed SELECT id, topic, body, content_type, time_written, ?, ? FROM outbox WHERE id = ?",
+                    (time.time(), str(error), row_id))
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+                self.db.execute("COMMIT")
+
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            if row is not None:
+                self.num_jobs -= 1
+                self.num_bytes -= row[0]
+        _m_failed.inc()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,339 @@
+#
+# publisher.py -- pipelined publishing with publisher confirms
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`ConfirmPublisher` publishes messages from a dedicated I/O thread running
+a pika `SelectConnection` in confirm mode.  Callers hand messages off
+without blocking and get a `concurrent.futures.Future` for each one, which
+is resolved when the broker confirms the message.
+
+Up to `confirm_window` messages may be outstanding (published but not yet
+confirmed) at once.  Confirms are processed as they arrive, including the
+`multiple` acks the broker uses to confirm many messages at once.
+Messages are published with `mandatory=True`; messages that the broker
+NACKs or returns as unroutable are retried after `confirm_retry_interval`
+seconds, up to `confirm_max_retries` times, after which their future gets
+a `PublishError`.  If the connection is lost, outstanding messages are
+republished after reconnecting, so delivery is at-least-once.
+
+While the broker has the connection blocked (memory or disk alarm),
+messages are held in the pending buffer; callers are never blocked.  A
+`TokenBucket` can be given to limit the publish rate.
+
+With `confirm=False` the publisher does not use confirm mode and a
+message's future is resolved as soon as it has been written to the
+connection.
+"""
+import copy
+import time
+import weakref
+import threading
+import collections
+from concurrent.futures import Future
+
+import pika
+
+from datasink import metrics
+from datasink.flowcontrol import FlowControl
+
+_m_confirmed = metrics.registry.counter(
+    'datasink_publish_confirmed_total', "Publishes confirmed by the broker")
+_m_republished = metrics.registry.counter(
+    'datasink_publish_retries_total',
+    "Publishes retried after a NACK, return or lost connection", ['reason'])
+_m_failed = metrics.registry.counter(
+    'datasink_publish_failed_total', "Publishes given up on")
+_m_outstanding = metrics.registry.gauge(
+    'datasink_publish_outstanding', "Publishes awaiting broker confirms")
+_m_pending = metrics.registry.gauge(
+    'datasink_publish_pending', "Messages waiting to be published")
+
+# all live publishers, for the gauges
+_publishers = weakref.WeakSet()
+_m_outstanding.set_function(
+    lambda: sum([len(pub.outstanding) for pub in list(_publishers)]))
+_m_pending.set_function(
+    lambda: sum([len(pub.pending) for pub in list(_publishers)]))
+
+
+class PublishError(Exception):
+    pass
+
+
+class _Message:
+
+    __slots__ = ('exchange', 'routing_key', 'body', 'props', 'future',
+                 'tries', 'msg_id')
+
+    def __init__(self, exchange, routing_key, body, props, future, msg_id):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.props = props
+        self.future = future
+        self.tries = 0
+        self.msg_id = msg_id
+
+
+class ConfirmPublisher:
+
+    def __init__(self, logger, params, config, name='publisher',
+                 confirm=True, limiter=None):
+        self.logger = logger
+        self.params = params
+        self.name = name
+        self.confirm = confirm
+        self.limiter = limiter
+        self.flow = FlowControl(logger, on_unblocked=self._pump)
+        self.window = config.get('confirm_window', 1000)
+        self.max_retries = config.get('confirm_max_retries', 5)
+        self.retry_interval = config.get('confirm_retry_interval', 1.0)
+        self.recover_interval = config.get('retry_interval', 60.0)
+
+        self.ev_quit = threading.Event()
+        self.thread = None
+        self.connection = None
+        self.channel = None
+
+        # messages waiting to be published (thread-safe handoff)
+        self.pending = collections.deque()
+        # delivery tag -> message, in publish order
+        self.outstanding = collections.OrderedDict()
+        # ids of messages returned as unroutable
+        self.returned = set()
+        # msg id -> message waiting to be retried
+        self.retrying = collections.OrderedDict()
+        self._next_tag = 0
+        self._seq = 0
+        self._wakeup = False
+        self._pump_timer = False
+        self._lock = threading.Lock()
+        # futures not yet resolved
+        self.unresolved = set()
+
+        _publishers.add(self)
+
+    def publish(self, exchange, routing_key, body, props):
+        """Queue a message for publishing.  Never blocks.
+        Returns a Future that is resolved when the broker confirms it.
+        """
+        future = self._make_future()
+        with self._lock:
+            self._seq += 1
+            msg_id = '{}-{}'.format(self.name, self._seq)
+            self.unresolved.add(future)
+        future.add_done_callback(self.unresolved.discard)
+
+        # each message needs its own id to match up returns
+        props = copy.copy(props)
+        props.message_id = msg_id
+        self.pending.append(_Message(exchange, routing_key, body, props,
+                                     future, msg_id))
+        self._wake()
+        return future
+
+    def _make_future(self):
+        return Future()
+
+    def _call_later(self, delay, callback):
+        self.connection.ioloop.call_later(delay, callback)
+
+    def _wake(self):
+        # coalesce wakeups of the I/O thread
+        connection = self.connection
+        if not self._wakeup and connection is not None:
+            self._wakeup = True
+            try:
+                connection.ioloop.add_callback_threadsafe(self._pump)
+            except Exception:
+                # connection is going down; pending messages will be
+                # published after reconnecting
+                self._wakeup = False
+
+    def _pump(self):
+        """Publish pending messages while there is room in the window."""
+        self._wakeup = False
+        channel = self.channel
+        if channel is None or not channel.is_open or self.flow.is_blocked:
+            # messages are buffered until the broker accepts them again
+            return
+        while len(self.pending) > 0 and len(self.outstanding) < self.window:
+            if self.limiter is not None:
+                delay = self.limiter.try_take()
+                if delay > 0:
+                    self._pump_later(delay)
+                    return
+            msg = self.pending.popleft()
+            msg.tries += 1
+            try:
+                channel.basic_publish(exchange=msg.exchange,
+                                      routing_key=msg.routing_key,
+                                      body=msg.body, properties=msg.props,
+                                      mandatory=self.confirm)
+
+            except Exception as e:
+                self.logger.error(f"error publishing: {e}", exc_info=True)
+                self.pending.appendleft(msg)
+                return
+            if not self.confirm:
+                msg.future.set_result(True)
+                continue
+            self._next_tag += 1
+            self.outstanding[self._next_tag] = msg
+
+    def _pump_later(self, delay):
+        if not self._pump_timer:
+            self._pump_timer = True
+
+            def _timed_pump():
+                self._pump_timer = False
+                self._pump()
+
+            self._call_later(delay, _timed_pump)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = []
+            for tag in self.outstanding:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            msg = self.outstanding.pop(tag, None)
+            if msg is None:
+                continue
+            if msg.msg_id in self.returned:
+                self.returned.discard(msg.msg_id)
+                self._retry(msg, 'returned')
+            elif acked:
+                _m_confirmed.inc()
+                msg.future.set_result(True)
+            else:
+                self._retry(msg, 'nacked')
+        self._pump()
+
+    def _on_return(self, channel, method, props, body):
+        self.logger.warning("message {} returned: {} {}".format(
+            props.message_id, method.reply_code, method.reply_text))
+        self.returned.add(props.message_id)
+
+    def _retry(self, msg, reason):
+        if msg.tries > self.max_retries:
+            self.logger.error("giving up publishing message {} ({})".format(
+                msg.msg_id, reason))
+            _m_failed.inc()
+            msg.future.set_exception(PublishError(
+                f"message {msg.msg_id} {reason} by broker"))
+            return
+        _m_republished.labels(reason).inc()
+        self.retrying[msg.msg_id] = msg
+
+        def _requeue():
+            if self.retrying.pop(msg.msg_id, None) is None:
+                # moved back to pending when the connection was lost
+                return
+            self.pending.appendleft(msg)
+            self._pump()
+
+        self._call_later(self.retry_interval, _requeue)
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        self._next_tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        if self.confirm:
+            channel.add_on_return_callback(self._on_return)
+            channel.confirm_delivery(self._on_confirm)
+        self.logger.info("publisher channel open")
+        self._pump()
+
+    def _on_channel_closed(self, channel, reason):
+        self.logger.warning(f"publisher channel closed: {reason}")
+        self.channel = None
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+    def _on_open(self, connection):
+        self.flow.register(connection)
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_open_error(self, connection, err):
+        self.logger.error(f"publisher connection failed: {err}")
+        connection.ioloop.stop()
+
+    def _on_closed(self, connection, reason):
+        self.channel = None
+        if not self.ev_quit.is_set():
+            self.logger.warning(f"publisher connection closed: {reason}")
+        connection.ioloop.stop()
+
+    def _requeue_outstanding(self):
+        # unconfirmed messages must be published again, as well as
+        # those waiting to be retried, whose timers may have gone with
+        # the connection
+        msgs = list(self.retrying.values()) + list(self.outstanding.values())
+        self.retrying.clear()
+        self.outstanding.clear()
+        self.returned.clear()
+        # timers went with the connection
+        self._pump_timer = False
+        self.flow.reset()
+        if len(msgs) > 0:
+            _m_republished.labels('reconnect').inc(len(msgs))
+            self.pending.extendleft(reversed(msgs))
+
+    def io_loop(self):
+        while not self.ev_quit.is_set():
+            try:
+                self.connection = pika.SelectConnection(
+                    self.params, on_open_callback=self._on_open,
+                    on_open_error_callback=self._on_open_error,
+                    on_close_callback=self._on_closed)
+                self.connection.ioloop.start()
+
+            except Exception as e:
+                self.logger.error(f"publisher error: {e}", exc_info=True)
+
+            self._wakeup = False
+            self._requeue_outstanding()
+            if not self.ev_quit.is_set():
+                self.logger.info(f"reconnecting publisher in {self.recover_interval} sec")
+                self.ev_quit.wait(self.recover_interval)
+        self.connection = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.io_loop, daemon=True)
+        self.thread.start()
+
+    def flush(self, timeout=None):
+        """Wait until all messages published so far are confirmed (or have
+        failed).  Returns True if they were all resolved within `timeout`.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self.unresolved) > 0:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=10.0):
+        if not self.flush(timeout=timeout):
+            self.logger.warning("{} messages unconfirmed at shutdown".format(
+                len(self.unresolved)))
+        self.ev_quit.set()
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(connection.close)
+            except Exception:
+                pass
+        if self.thread is not None:
+            self.thread.join()
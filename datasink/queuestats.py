@@ -0,0 +1,243 @@
+#
+# queuestats.py -- sample the depth and rates of the realm's queues
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`QueueMonitor` samples every sink queue in the realm configuration, plus
+the backlog queue, and works out whether the sinks are keeping up.
+
+There are two sources:
+
+- AMQP (the default): a passive `queue_declare` per queue, on a single
+  channel, gives the number of ready messages and of consumers.  Only the
+  net rate (change in depth over time) can be measured this way.
+- the management API, if 'mgmt_url' is configured: a single request per
+  sample returns, for all the queues at once, the ready and unacked
+  messages, consumers, consumer utilisation and the cumulative publish
+  and ack counters, from which ingress and egress rates are computed.
+
+Rates are smoothed over samples ('stats_smoothing', the weight of the
+newest sample, default 0.5).  The estimated drain time is the depth over
+the net outflow; it is None if the queue is not draining.
+
+Alerts are raised when a queue is deeper than 'alert_depth' jobs, would
+take longer than 'alert_drain_sec' to drain, or has jobs but no consumers
+(sink queues only).  The thresholds can be set for the realm and
+overridden per queue in its 'queues' entry; each shard of a sharded sink
+is checked against its sink's thresholds.
+"""
+import time
+
+import pika
+
+from datasink import metrics
+from datasink.initialize import shard_queue_names
+
+_m_depth = metrics.registry.gauge(
+    'datasink_broker_queue_depth', "Messages ready in the broker queue",
+    ['queue'])
+_m_consumers = metrics.registry.gauge(
+    'datasink_broker_queue_consumers', "Consumers of the broker queue",
+    ['queue'])
+_m_rate_net = metrics.registry.gauge(
+    'datasink_broker_queue_net_rate', "Change in queue depth (msgs/sec)",
+    ['queue'])
+
+_mgmt_columns = ['name', 'messages_ready', 'messages_unacknowledged',
+                 'consumers', 'consumer_utilisation',
+                 'message_stats.publish', 'message_stats.ack',
+                 'message_stats.deliver_no_ack', 'message_stats.get_no_ack']
+
+
+class QueueMonitor:
+
+    def __init__(self, logger, config, connection=None, mgmt=None,
+                 queue_names=None):
+        if connection is None and mgmt is None:
+            raise ValueError("need an AMQP connection or a management API")
+        self.logger = logger
+        self.config = config
+        self.connection = connection
+        self.mgmt = mgmt
+        self.channel = None
+
+        # queue (shard) name -> sink name
+        self.sinks = dict()
+        for sink_name, dct in config.get('queues', {}).items():
+            for queue_name in shard_queue_names(sink_name,
+                                                dct.get('shards', 1)):
+                self.sinks[queue_name] = sink_name
+        if queue_names is None:
+            queue_names = list(self.sinks.keys())
+            queue_names.append(config['backlog_queue'])
+        self.queue_names = queue_names
+        self.smoothing = config.get('stats_smoothing', 0.5)
+
+        # queue name -> last sample, smoothed stats
+        self.last = dict()
+        self.stats = dict()
+
+    def _get_channel(self):
+        if self.channel is None or not self.channel.is_open:
+            self.channel = self.connection.channel()
+        return self.channel
+
+    def sample_amqp(self):
+        res = dict()
+        now = time.time()
+        for queue_name in self.queue_names:
+            channel = self._get_channel()
+            try:
+                ok = channel.queue_declare(queue=queue_name, passive=True)
+
+            except pika.exceptions.ChannelClosedByBroker as e:
+                if e.reply_code != 404:
+                    raise
+                # the channel is closed; another is opened for the next one
+                res[queue_name] = None
+                continue
+
+            res[queue_name] = dict(time=now,
+                                   depth=ok.method.message_count,
+                                   consumers=ok.method.consumer_count)
+        return res
+
+    def sample_mgmt(self):
+        now = time.time()
+        queues = {q['name']: q for q in self.mgmt.get_queues(_mgmt_columns)}
+        res = dict()
+        for queue_name in self.queue_names:
+            q = queues.get(queue_name, None)
+            if q is None:
+                res[queue_name] = None
+                continue
+            stats = q.get('message_stats', {})
+            acked = (stats.get('ack', 0) + stats.get('deliver_no_ack', 0) +
+                     stats.get('get_no_ack', 0))
+            res[queue_name] = dict(time=now,
+                                   depth=q.get('messages_ready', 0),
+                                   unacked=q.get('messages_unacknowledged', 0),
+                                   consumers=q.get('consumers', 0),
+                                   utilisation=q.get('consumer_utilisation',
+                                                     None),
+                                   published=stats.get('publish', 0),
+                                   acked=acked)
+        return res
+
+    def sample(self):
+        """Return queue name -> raw sample (None if the queue is missing)."""
+        if self.mgmt is not None:
+            return self.sample_mgmt()
+        return self.sample_amqp()
+
+    def _smooth(self, old, new):
+        if old is None or new is None:
+            return new
+        return self.smoothing * new + (1.0 - self.smoothing) * old
+
+    def update(self):
+        """Take a sample and return queue name -> stats.  Rates are None
+        until there are two samples, or if the source can't measure them.
+        """
+        samples = self.sample()
+        for queue_name, cur in samples.items():
+            if cur is None:
+                self.last.pop(queue_name, None)
+                self.stats[queue_name] = dict(name=queue_name, missing=True)
+                continue
+
+            st = dict(name=queue_name, missing=False,
+                      depth=cur['depth'], unacked=cur.get('unacked', None),
+                      consumers=cur['consumers'],
+                      utilisation=cur.get('utilisation', None),
+                      rate_in=None, rate_out=None, rate_net=None,
+                      drain_sec=None)
+            prev = self.last.get(queue_name, None)
+            old = self.stats.get(queue_name, {})
+            if prev is not None and cur['time'] > prev['time']:
+                elapsed = cur['time'] - prev['time']
+                rate_net = (cur['depth'] - prev['depth']) / elapsed
+                if 'published' in cur:
+                    # counters are reset if the queue is recreated
+                    rate_in = max(0, cur['published'] - prev['published']) / elapsed
+                    rate_out = max(0, cur['acked'] - prev['acked']) / elapsed
+                    st['rate_in'] = self._smooth(old.get('rate_in'), rate_in)
+                    st['rate_out'] = self._smooth(old.get('rate_out'), rate_out)
+                    rate_net = st['rate_in'] - st['rate_out']
+                else:
+                    rate_net = self._smooth(old.get('rate_net'), rate_net)
+                st['rate_net'] = rate_net
+                if rate_net < 0:
+                    st['drain_sec'] = cur['depth'] / -rate_net
+                elif cur['depth'] == 0:
+                    st['drain_sec'] = 0.0
+
+            self.last[queue_name] = cur
+            self.stats[queue_name] = st
+
+            _m_depth.labels(queue_name).set(st['depth'])
+            _m_consumers.labels(queue_name).set(st['consumers'])
+            if st['rate_net'] is not None:
+                _m_rate_net.labels(queue_name).set(st['rate_net'])
+
+        return dict(self.stats)
+
+    def get_threshold(self, queue_name, key):
+        q_cfg = self.config.get('queues', {}).get(
+            self.sinks.get(queue_name, queue_name), {})
+        return q_cfg.get(key, self.config.get(key, None))
+
+    def check_alerts(self, stats):
+        """Return a list of alert messages for `stats` (from `update`)."""
+        alerts = []
+        for queue_name, st in stats.items():
+            if st['missing']:
+                alerts.append(f"{queue_name}: queue does not exist")
+                continue
+            max_depth = self.get_threshold(queue_name, 'alert_depth')
+            if max_depth is not None and st['depth'] > max_depth:
+                alerts.append("{}: depth {} > {}".format(queue_name,
+                                                         st['depth'],
+                                                         max_depth))
+            max_drain = self.get_threshold(queue_name, 'alert_drain_sec')
+            if max_drain is not None and st['depth'] > 0 and \
+               st['rate_net'] is not None:
+                if st['drain_sec'] is None:
+                    alerts.append(f"{queue_name}: not draining")
+                elif st['drain_sec'] > max_drain:
+                    alerts.append("{}: drain time {:.0f}s > {}s".format(
+                        queue_name, st['drain_sec'], max_drain))
+            if queue_name in self.sinks and st['consumers'] == 0 and \
+               st['depth'] > 0:
+                alerts.append(f"{queue_name}: {st['depth']} jobs and no consumers")
+        return alerts
+
+    def close(self):
+        if self.channel is not None and self.channel.is_open:
+            self.channel.close()
+        self.channel = None
+
+
+def _fmt(val, fmt):
+    if val is None:
+        return '-'
+    return fmt % val
+
+
+def format_table(stats):
+    lines = ["%-20s %9s %8s %5s %9s %9s %9s %9s" % (
+        'queue', 'depth', 'unacked', 'cons', 'in/s', 'out/s', 'net/s',
+        'drain')]
+    for queue_name in sorted(stats.keys()):
+        st = stats[queue_name]
+        if st['missing']:
+            lines.append("%-20s %9s" % (queue_name, '(missing)'))
+            continue
+        lines.append("%-20s %9d %8s %5d %9s %9s %9s %9s" % (
+            queue_name, st['depth'], _fmt(st['unacked'], '%d'),
+            st['consumers'], _fmt(st['rate_in'], '%.1f'),
+            _fmt(st['rate_out'], '%.1f'), _fmt(st['rate_net'], '%+.1f'),
+            _fmt(st['drain_sec'], '%.0fs')))
+    return '\n'.join(lines)
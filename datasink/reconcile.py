@@ -0,0 +1,455 @@
+#
+# reconcile.py -- bring the realm's sink queues in line with the config
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`Reconciler` compares the sink queues described in the realm
+configuration with what exists on the broker, makes a plan of the changes
+needed and applies it.  Running it again when nothing has changed does
+nothing.
+
+The current state is read from the management API if 'mgmt_url' is
+configured (queue arguments and bindings), otherwise it is probed over
+AMQP: a passive declare tells whether a queue exists and a declare with
+the wanted arguments (on a throwaway channel) whether they match.  Over
+AMQP the existing bindings can't be listed, so the wanted bindings are
+(re)applied each time, which is harmless.
+
+A queue whose type, mode, limits or other arguments have changed can't
+be redeclared in place.  It is migrated (only if asked for, since
+consumers are disconnected while it happens) by moving its messages to a
+temporary queue "<name>.migrate" that receives new jobs meanwhile,
+recreating the queue with the new arguments and moving the messages back.
+If a migration was interrupted, the "<name>.migrate" queue is left behind;
+`plan` notices it and plans a migration that picks up where it stopped.
+
+A sink with 'shards' > 1 has a queue per shard (see
+`initialize.setup_queue`) and a shard exchange bound to the realm.  When
+shards are added, the new shard queues are declared and bound to the
+shard exchange, which then sends them their share of the keys.  When
+shards are removed, the queues left over are unbound, their jobs are
+sent back through the shard exchange (or to the sink's queue if it is no
+longer sharded) and they are deleted.  Bindings are added before old ones
+are removed, so jobs may be delivered twice while this happens but none
+are left unrouted.
+"""
+import re
+
+import pika
+
+from datasink.initialize import (queue_arguments, queue_bindings,
+                                 default_topic, shard_exchange_name,
+                                 setup_shard_exchange)
+
+migrate_suffix = '.migrate'
+
+# order in which changes are applied
+_kind_order = ['declare-exchange', 'declare', 'migrate', 'bind',
+               'bind-exchange', 'unbind', 'unbind-exchange', 'unshard',
+               'delete-exchange']
+
+
+class Change:
+
+    def __init__(self, kind, queue_name, binding=None, detail=''):
+        # one of _kind_order; the *-exchange kinds and unshard are for
+        # the shard exchange of sink `queue_name`
+        self.kind = kind
+        self.queue_name = queue_name
+        # (exchange, routing_key) for bind, unbind
+        self.binding = binding
+        self.detail = detail
+
+    def __str__(self):
+        detail = self.detail
+        if self.binding is not None:
+            detail = "{}:{}".format(*self.binding)
+        return "{:8s} {} {}".format(self.kind, self.queue_name,
+                                    detail).rstrip()
+
+
+def _normalize(args):
+    return {key: val for key, val in (args or {}).items()
+            if key != 'x-queue-type'}
+
+
+class Reconciler:
+
+    def __init__(self, logger, connection, config, mgmt=None):
+        self.logger = logger
+        self.connection = connection
+        self.config = config
+        self.mgmt = mgmt
+
+    def desired(self):
+        """Return queue name -> wanted declaration and bindings, for every
+        queue (shard) of every sink.
+        """
+        res = dict()
+        for sink_name, dct in self.config.get('queues', {}).items():
+            durable, auto_delete, args = queue_arguments(dct, self.config)
+            bindings = queue_bindings(sink_name, dct, self.config)
+            for queue_name, _bindings in bindings.items():
+                res[queue_name] = dict(sink=sink_name, durable=durable,
+                                       auto_delete=auto_delete,
+                                       arguments=args,
+                                       queue_type=dct.get('queue_type',
+                                                          'classic'),
+                                       bindings=_bindings,
+                                       topic=dct.get('topic', default_topic),
+                                       shards=dct.get('shards', 1))
+        return res
+
+    def _declare(self, channel, queue_name, want):
+        channel.queue_declare(queue=queue_name, durable=want['durable'],
+                              auto_delete=want['auto_delete'],
+                              arguments=want['arguments'])
+
+    def _probe(self, queue_name, want):
+        """Inspect a queue over AMQP.  Returns (exists, matches)."""
+        channel = self.connection.channel()
+        try:
+            channel.queue_declare(queue=queue_name, passive=True)
+
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code == 404:
+                return False, False
+            raise
+        finally:
+            if channel.is_open:
+                channel.close()
+
+        channel = self.connection.channel()
+        try:
+            self._declare(channel, queue_name, want)
+            return True, True
+
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code == 406:
+                # PRECONDITION_FAILED: declared with other arguments
+                return True, False
+            raise
+        finally:
+            if channel.is_open:
+                channel.close()
+
+    def _exists(self, declare):
+        """Call `declare(channel)` with a passive declare on a throwaway
+        channel and return False if the broker says it does not exist.
+        """
+        channel = self.connection.channel()
+        try:
+            declare(channel)
+            return True
+
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code == 404:
+                return False
+            raise
+        finally:
+            if channel.is_open:
+                channel.close()
+
+    def queue_exists(self, queue_name):
+        if self.mgmt is not None:
+            return self.mgmt.get_queue(queue_name) is not None
+        return self._exists(lambda channel: channel.queue_declare(
+            queue=queue_name, passive=True))
+
+    def exchange_exists(self, exchange):
+        if self.mgmt is not None:
+            return self.mgmt.get_exchange(exchange) is not None
+        return self._exists(lambda channel: channel.exchange_declare(
+            exchange=exchange, passive=True))
+
+    def extra_shards(self, sink_name, num_shards):
+        """Return the names of the shard queues of a sink beyond its
+        configured number of shards.
+        """
+        if self.mgmt is not None:
+            regex = re.compile(r'^{}\.(\d+)$'.format(re.escape(sink_name)))
+            res = []
+            for q in self.mgmt.get_queues(['name']):
+                match = regex.match(q['name'])
+                if match is not None and int(match.group(1)) >= num_shards:
+                    res.append(q['name'])
+            return sorted(res)
+
+        # shards are numbered consecutively, so stop at the first missing
+        res = []
+        i = max(1, num_shards)
+        while True:
+            queue_name = '{}.{}'.format(sink_name, i)
+            if not self.queue_exists(queue_name):
+                break
+            res.append(queue_name)
+            i += 1
+        return res
+
+    def plan_shards(self, sink_name, dct):
+        """Return the Changes for the shard exchange and leftover shard
+        queues of a sink.
+        """
+        changes = []
+        num_shards = dct.get('shards', 1)
+        exchange = shard_exchange_name(sink_name)
+        exists = self.exchange_exists(exchange)
+        realm_binding = (self.config['realm'], dct.get('topic', default_topic))
+        enabled = dct.get('enabled', False)
+
+        keys = None
+        if exists and self.mgmt is not None:
+            keys = set([(self.config['realm'], key) for key in
+                        self.mgmt.get_exchange_bindings(self.config['realm'],
+                                                        exchange)])
+
+        if num_shards > 1:
+            if not exists:
+                changes.append(Change('declare-exchange', sink_name,
+                                      detail=exchange))
+            if keys is None:
+                keys = set()
+                if enabled:
+                    changes.append(Change('bind-exchange', sink_name,
+                                          realm_binding))
+                elif exists:
+                    changes.append(Change('unbind-exchange', sink_name,
+                                          realm_binding))
+            else:
+                want = set([realm_binding]) if enabled else set()
+                for binding in sorted(want - keys):
+                    changes.append(Change('bind-exchange', sink_name, binding))
+                for binding in sorted(keys - want):
+                    changes.append(Change('unbind-exchange', sink_name,
+                                          binding))
+
+        elif exists:
+            # no longer sharded
+            for binding in sorted(keys or set([realm_binding])):
+                changes.append(Change('unbind-exchange', sink_name, binding))
+
+        for queue_name in self.extra_shards(sink_name, num_shards):
+            target = exchange if num_shards > 1 else sink_name
+            changes.append(Change('unshard', queue_name,
+                                  detail=f"-> {target}"))
+
+        if num_shards <= 1 and exists:
+            changes.append(Change('delete-exchange', sink_name,
+                                  detail=exchange))
+        return changes
+
+    def inspect(self, queue_name, want):
+        """Return (exists, matches, bindings) for a queue; bindings is None
+        if they can't be found out.
+        """
+        if self.mgmt is None:
+            exists, matches = self._probe(queue_name, want)
+            return exists, matches, None
+
+        q = self.mgmt.get_queue(queue_name)
+        if q is None:
+            return False, False, None
+        matches = (q.get('durable') == want['durable'] and
+                   q.get('auto_delete') == want['auto_delete'] and
+                   q.get('type', 'classic') == want['queue_type'] and
+                   _normalize(q.get('arguments')) == _normalize(want['arguments']))
+        return True, matches, self.mgmt.get_bindings(queue_name)
+
+    def plan(self):
+        """Return the list of Changes needed, in the order they should be
+        applied.
+        """
+        changes = []
+        for queue_name, want in self.desired().items():
+            exists, matches, bindings = self.inspect(queue_name, want)
+            if not exists:
+                changes.append(Change('declare', queue_name))
+            if self.queue_exists(queue_name + migrate_suffix):
+                changes.append(Change('migrate', queue_name,
+                                      detail="(resume interrupted migration)"))
+            elif exists and not matches:
+                changes.append(Change('migrate', queue_name,
+                                      detail="(declared with other arguments)"))
+
+            if bindings is None or not exists:
+                # don't know what is bound; (re)bind what should be and
+                # unbind the topic if the queue is disabled or sharded
+                for binding in sorted(want['bindings']):
+                    changes.append(Change('bind', queue_name, binding))
+                realm_binding = (self.config['realm'], want['topic'])
+                if exists and queue_name == want['sink'] and \
+                   realm_binding not in want['bindings']:
+                    changes.append(Change('unbind', queue_name,
+                                          realm_binding))
+                continue
+
+            for binding in sorted(want['bindings'] - bindings):
+                changes.append(Change('bind', queue_name, binding))
+            for binding in sorted(bindings - want['bindings']):
+                changes.append(Change('unbind', queue_name, binding))
+
+        for sink_name, dct in self.config.get('queues', {}).items():
+            changes.extend(self.plan_shards(sink_name, dct))
+
+        # sorted() is stable, so changes of a kind stay in order
+        return sorted(changes, key=lambda change: _kind_order.index(change.kind))
+
+    def apply(self, changes, migrate=False):
+        """Apply `changes` (from `plan`).  Migrations are skipped unless
+        `migrate` is True.  Returns the list of changes applied.
+        """
+        desired = self.desired()
+        sinks = self.config.get('queues', {})
+        applied = []
+        channel = self.connection.channel()
+        try:
+            for change in changes:
+                if change.kind == 'declare':
+                    self._declare(channel, change.queue_name,
+                                  desired[change.queue_name])
+
+                elif change.kind == 'migrate':
+                    if not migrate:
+                        self.logger.warning(f"not migrating {change.queue_name}")
+                        continue
+                    self.migrate_queue(change.queue_name,
+                                       desired[change.queue_name])
+
+                elif change.kind in ('bind', 'unbind'):
+                    exchange, routing_key = change.binding
+                    if change.kind == 'bind':
+                        channel.queue_bind(queue=change.queue_name,
+                                           exchange=exchange,
+                                           routing_key=routing_key)
+                    else:
+                        channel.queue_unbind(queue=change.queue_name,
+                                             exchange=exchange,
+                                             routing_key=routing_key)
+
+                elif change.kind == 'declare-exchange':
+                    setup_shard_exchange(channel, change.queue_name,
+                                         durable=self.config.get('persist',
+                                                                 False))
+
+                elif change.kind in ('bind-exchange', 'unbind-exchange'):
+                    source, routing_key = change.binding
+                    exchange = shard_exchange_name(change.queue_name)
+                    if change.kind == 'bind-exchange':
+                        channel.exchange_bind(destination=exchange,
+                                              source=source,
+                                              routing_key=routing_key)
+                    else:
+                        channel.exchange_unbind(destination=exchange,
+                                                source=source,
+                                                routing_key=routing_key)
+
+                elif change.kind == 'unshard':
+                    sink_name = change.queue_name.rsplit('.', 1)[0]
+                    self.remove_shard(change.queue_name, sink_name,
+                                      sinks.get(sink_name, {}).get('shards', 1))
+
+                elif change.kind == 'delete-exchange':
+                    channel.exchange_delete(
+                        exchange=shard_exchange_name(change.queue_name))
+
+                applied.append(change)
+                self.logger.info(f"applied: {change}")
+
+        finally:
+            if channel.is_open:
+                channel.close()
+        return applied
+
+    def move_messages(self, src, dst, exchange=''):
+        """Move all messages from queue `src` to queue `dst` or, if
+        `exchange` is given, republish them to `exchange`.
+        """
+        channel = self.connection.channel()
+        channel.confirm_delivery()
+        num = 0
+        try:
+            while True:
+                method, properties, body = channel.basic_get(queue=src,
+                                                             auto_ack=False)
+                if method is None:
+                    break
+                # the default exchange routes by queue name
+                channel.basic_publish(exchange=exchange, routing_key=dst,
+                                      body=body, properties=properties,
+                                      mandatory=True)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                num += 1
+                if num % 10000 == 0:
+                    self.logger.info(f"moved {num} messages {src} -> {dst}")
+
+        finally:
+            if channel.is_open:
+                channel.close()
+        return num
+
+    def migrate_queue(self, queue_name, want):
+        """Recreate `queue_name` with the wanted arguments, keeping its
+        messages.  Each step can be repeated, so an interrupted migration
+        is finished by running this again.
+        """
+        tmp_name = queue_name + migrate_suffix
+        # if the queue is missing, or already has the new arguments, an
+        # earlier run got past the first half
+        exists, matches, bindings = self.inspect(queue_name, want)
+        channel = self.connection.channel()
+        try:
+            # park messages (old and new) in a temporary queue with the
+            # new arguments
+            channel.queue_declare(queue=tmp_name, durable=want['durable'],
+                                  auto_delete=False,
+                                  arguments=want['arguments'])
+            if exists and not matches:
+                for exchange, routing_key in want['bindings']:
+                    channel.queue_bind(queue=tmp_name, exchange=exchange,
+                                       routing_key=routing_key)
+                    channel.queue_unbind(queue=queue_name, exchange=exchange,
+                                         routing_key=routing_key)
+                num = self.move_messages(queue_name, tmp_name)
+                self.logger.info(f"moved {num} messages to {tmp_name}")
+                channel.queue_delete(queue=queue_name)
+            else:
+                self.logger.info(f"resuming migration of {queue_name}")
+
+            # recreate the queue and move them back
+            self._declare(channel, queue_name, want)
+            for exchange, routing_key in want['bindings']:
+                channel.queue_bind(queue=queue_name, exchange=exchange,
+                                   routing_key=routing_key)
+                channel.queue_unbind(queue=tmp_name, exchange=exchange,
+                                     routing_key=routing_key)
+            num = self.move_messages(tmp_name, queue_name)
+            channel.queue_delete(queue=tmp_name)
+            self.logger.info(f"migrated {queue_name} ({num} messages)")
+
+        finally:
+            if channel.is_open:
+                channel.close()
+
+    def remove_shard(self, queue_name, sink_name, num_shards):
+        """Remove a shard queue of sink `sink_name`, which now has
+        `num_shards` shards, passing its jobs on to the remaining ones.
+        """
+        exchange = shard_exchange_name(sink_name)
+        channel = self.connection.channel()
+        try:
+            # stop it getting any more jobs
+            channel.queue_unbind(queue=queue_name, exchange=exchange,
+                                 routing_key='1')
+            if num_shards > 1:
+                # rehashed over the remaining shards
+                num = self.move_messages(queue_name, '', exchange=exchange)
+            else:
+                num = self.move_messages(queue_name, sink_name)
+            channel.queue_delete(queue=queue_name)
+            self.logger.info(f"removed shard {queue_name} ({num} messages)")
+
+        finally:
+            if channel.is_open:
+                channel.close()
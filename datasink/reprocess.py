@@ -0,0 +1,265 @@
+#
+# reprocess.py -- batch reprocessing of the dead letter backlog
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`BacklogReprocessor` consumes the hub's backlog queue in batches and
+decides what to do with each dead letter by rules, e.g. (in the hub
+configuration):
+
+    dlx_rules:
+      # jobs that expired or were dropped in ins1's queue during an
+      # outage: send them again
+      - match: {reason: expired, queue: ins1}
+        action: republish
+      - match: {reason: maxlen}
+        action: republish
+      # everything else is archived (the default action)
+
+A rule's `match` may test the dead letter's `reason` (rejected, expired,
+maxlen, ... or 'sink-error' for jobs dead-lettered by a spooling sink),
+the `queue` it died in, the `exchange` it was originally published to
+and its `routing_key`, with shell-style wildcards.  The first rule that
+matches decides the action: 'republish' sends the job again to its
+original exchange and routing key (at most 'dlx_rate' jobs/sec), and
+'archive' appends it to a gzipped JSON lines file.  A republish rule with
+`target: queue` sends the job straight back to the queue it died in
+instead, which avoids delivering it again to other sinks whose queues
+are bound to the same topic.  A job is archived
+anyway once it has been republished 'dlx_max_republish' times, or if the
+broker refuses to take it back (e.g. it is unroutable because its queue
+is gone); the latter are counted with the action 'unroutable'.
+
+Dead letters are only ACKed once they have been republished (with broker
+confirms) or archived.  In a dry run nothing is republished or archived
+and all the messages are returned to the backlog at the end.
+"""
+import time
+import gzip
+import json
+import base64
+import fnmatch
+import contextlib
+from collections import Counter
+
+import pika
+
+from datasink import metrics, codec
+from datasink.flowcontrol import TokenBucket
+
+_m_reprocessed = metrics.registry.counter(
+    'datasink_dlx_reprocessed_total', "Dead letters reprocessed",
+    ['reason', 'action'])
+
+# headers that describe a job's previous life
+_strip_headers = ('x-death', 'x-first-death-exchange', 'x-first-death-queue',
+                  'x-first-death-reason', 'x-last-death-exchange',
+                  'x-last-death-queue', 'x-last-death-reason',
+                  'x-ds-attempt', 'x-ds-deferred', 'x-ds-error', 'x-ds-queue')
+
+
+def classify(method, properties):
+    """Return a dict describing why and where a dead letter died."""
+    headers = properties.headers or {}
+    if 'x-ds-queue' in headers:
+        # dead-lettered by a spooling sink; send it straight back to the
+        # sink's queue (through the default exchange).  This comes first
+        # because the job keeps the 'x-death' headers of its earlier
+        # trips through the retry tiers, and the sink's is the last death
+        queue_name = str(headers['x-ds-queue'])
+        return dict(reason='sink-error', queue=queue_name, exchange='',
+                    routing_key=queue_name, count=1)
+
+    deaths = headers.get('x-death', None)
+    if deaths:
+        # most recent death first
+        death = deaths[0]
+        routing_keys = death.get('routing-keys', [method.routing_key])
+        return dict(reason=str(death.get('reason', 'unknown')),
+                    queue=str(death.get('queue', '')),
+                    exchange=str(death.get('exchange', '')),
+                    routing_key=str(routing_keys[0]) if routing_keys else '',
+                    count=death.get('count', 1))
+
+    return dict(reason='unknown', queue='', exchange=method.exchange,
+                routing_key=method.routing_key, count=1)
+
+
+class BacklogReprocessor:
+
+    def __init__(self, logger, channel, config, dry_run=False,
+                 archive_path=None, rate=None, batch_size=None):
+        self.logger = logger
+        self.channel = channel
+        self.config = config
+        self.queue_name = config['backlog_queue']
+        self.rules = config.get('dlx_rules', [])
+        self.default_action = config.get('dlx_default_action', 'archive')
+        self.max_republish = config.get('dlx_max_republish', 3)
+        self.dry_run = dry_run
+        if batch_size is None:
+            batch_size = config.get('dlx_batch_size', 500)
+        self.batch_size = batch_size
+        if archive_path is None:
+            archive_path = config.get('dlx_archive', None)
+        if archive_path is None:
+            archive_path = time.strftime("backlog-%Y%m%d.jsonl.gz")
+        self.archive_path = archive_path
+        if rate is None:
+            rate = config.get('dlx_rate', 100.0)
+        self.limiter = None
+        if rate is not None and rate > 0:
+            self.limiter = TokenBucket(rate)
+
+        # (reason, queue, action) -> count
+        self.summary = Counter()
+
+        for rule in self.rules:
+            if rule.get('action', None) not in ('republish', 'archive'):
+                raise ValueError("dlx rule {} has bad action (should be 'republish' or 'archive')".format(rule))
+
+        if not dry_run:
+            # republished jobs must make it to a queue before the dead
+            # letter is ACKed
+            channel.confirm_delivery()
+
+    def get_rule(self, info, headers):
+        """Return the rule that applies to a dead letter."""
+        if headers.get('x-ds-republished', 0) >= self.max_republish:
+            return dict(action='archive')
+        for rule in self.rules:
+            match = rule.get('match', {})
+            if all([fnmatch.fnmatchcase(str(info.get(key, '')), str(pattern))
+                    for key, pattern in match.items()]):
+                return rule
+        return dict(action=self.default_action)
+
+    def republish(self, info, properties, body, target='exchange'):
+        headers = dict(properties.headers or {})
+        for key in _strip_headers:
+            headers.pop(key, None)
+        headers['x-ds-republished'] = headers.get('x-ds-republished', 0) + 1
+        props = pika.BasicProperties(content_type=properties.content_type,
+                                     delivery_mode=properties.delivery_mode,
+                                     priority=properties.priority,
+                                     headers=headers)
+        exchange, routing_key = info['exchange'], info['routing_key']
+        if target == 'queue' and info['queue']:
+            # the default exchange routes by queue name
+            exchange, routing_key = '', info['queue']
+        if self.limiter is not None:
+            self.limiter.take()
+        self.channel.basic_publish(exchange=exchange,
+                                   routing_key=routing_key,
+                                   body=body, properties=props,
+                                   mandatory=True)
+
+    def make_record(self, info, properties, body):
+        rec = dict(info, time_archived=time.time(),
+                   content_type=properties.content_type,
+                   headers=properties.headers or {})
+        try:
+            rec['job'] = codec.decode(body, properties.content_type)
+
+        except Exception:
+            rec['body_b64'] = base64.b64encode(body).decode('ascii')
+        return rec
+
+    def process_batch(self, archive_f):
+        """Process up to a batch of dead letters.  Returns the number of
+        messages processed (0 if the backlog is empty).
+        """
+        last_tag, done_tag = None, None
+        num = 0
+        try:
+            while num < self.batch_size:
+                method, properties, body = self.channel.basic_get(
+                    queue=self.queue_name, auto_ack=False)
+                if method is None:
+                    break
+                num += 1
+                last_tag = method.delivery_tag
+
+                info = classify(method, properties)
+                rule = self.get_rule(info, properties.headers or {})
+                action = rule['action']
+                if self.dry_run:
+                    self.summary[(info['reason'], info['queue'], action)] += 1
+                    continue
+
+                error = None
+                if action == 'republish':
+                    try:
+                        self.republish(info, properties, body,
+                                       target=rule.get('target', 'exchange'))
+
+                    except (pika.exceptions.UnroutableError,
+                            pika.exceptions.NackError) as e:
+                        # archive it rather than getting stuck on it
+                        self.logger.warning("can't republish dead letter from {}; archiving it: {}".format(
+                            info['queue'], e))
+                        action, error = 'unroutable', str(e)
+                if action != 'republish':
+                    rec = self.make_record(info, properties, body)
+                    if error is not None:
+                        rec['republish_error'] = error
+                    archive_f.write(json.dumps(rec, default=str) + '\n')
+                self.summary[(info['reason'], info['queue'], action)] += 1
+                _m_reprocessed.labels(info['reason'], action).inc()
+                done_tag = last_tag
+
+        except Exception:
+            if last_tag is not None and not self.dry_run:
+                # ACK what was done; the rest goes back to the backlog
+                archive_f.flush()
+                if done_tag is not None:
+                    self.channel.basic_ack(delivery_tag=done_tag,
+                                           multiple=True)
+                if done_tag != last_tag:
+                    self.channel.basic_nack(delivery_tag=last_tag,
+                                            multiple=True, requeue=True)
+            raise
+
+        if last_tag is not None and not self.dry_run:
+            archive_f.flush()
+            self.channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        return num
+
+    def run(self, ev_quit=None, once=False, poll_interval=1.0):
+        """Reprocess the backlog.  If `once`, stop when it is empty,
+        otherwise keep waiting for dead letters until `ev_quit` is set.
+        """
+        if self.dry_run:
+            archive = contextlib.nullcontext()
+        else:
+            archive = gzip.open(self.archive_path, 'at')
+        with archive as archive_f:
+            while ev_quit is None or not ev_quit.is_set():
+                num = self.process_batch(archive_f)
+                if num > 0:
+                    self.logger.info(f"processed {num} dead letters")
+                    continue
+                if once or self.dry_run:
+                    break
+                if ev_quit is not None:
+                    ev_quit.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+
+        if self.dry_run:
+            # give all the messages we looked at back to the backlog
+            self.channel.basic_nack(delivery_tag=0, multiple=True,
+                                    requeue=True)
+
+    def format_summary(self):
+        lines = ["%-12s %-20s %-10s %8s" % ('reason', 'queue', 'action',
+                                             'count')]
+        for (reason, queue_name, action), count in sorted(self.summary.items()):
+            lines.append("%-12s %-20s %-10s %8d" % (reason, queue_name,
+                                                     action, count))
+        total = sum(self.summary.values())
+        verb = "would have been" if self.dry_run else "were"
+        lines.append(f"{total} dead letters {verb} processed")
+        return '\n'.join(lines)
@@ -0,0 +1,111 @@
+#
+# spool.py -- crash-safe local job spool for a sink
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+A durable local spool (SQLite in WAL mode) between the broker and the
+workers of a `JobSink`.
+
+When the spool is enabled, jobs received from the broker are written to
+the spool in batches and only then ACKed to the broker; the workers run
+them from the spool and a job is removed from the spool when it is done.
+If the sink crashes, the jobs left in the spool are replayed when it is
+restarted.  Since nothing the broker has delivered is left unACKed for
+long, the sink can prefetch deeply without risking mass redelivery.
+
+The 'spool_sync' setting controls durability: 'full' syncs every batch to
+disk (survives power loss), 'normal' (the default) survives a crash of the
+sink process, 'off' leaves it to the OS.
+"""
+import time
+import json
+import sqlite3
+import threading
+
+from datasink import metrics
+
+_m_spooled = metrics.registry.gauge(
+    'datasink_spool_depth', "Jobs in the local spool")
+_m_spool_writes = metrics.registry.counter(
+    'datasink_spool_jobs_written_total', "Jobs written to the local spool")
+
+
+class Spool:
+
+    def __init__(self, logger, path, sync='normal'):
+        self.logger = logger
+        self.path = path
+
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous={}".format(
+            {'full': 'FULL', 'normal': 'NORMAL', 'off': 'OFF'}[sync]))
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                             id INTEGER PRIMARY KEY AUTOINCREMENT,
+                             queue TEXT, body BLOB, content_type TEXT,
+                             headers TEXT, time_spooled REAL)""")
+        self.num_jobs = self.count()
+
+        _m_spooled.set_function(lambda: self.num_jobs)
+
+    @classmethod
+    def from_config(cls, logger, config):
+        """Make a Spool from config, or return None if not configured."""
+        path = config.get('spool_file', None)
+        if path is None:
+            return None
+        return cls(logger, path, sync=config.get('spool_sync', 'normal'))
+
+    def count(self):
+        with self._lock:
+            row = self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()
+        return row[0]
+
+    def put_many(self, items):
+        """Durably store jobs.  `items` is a list of (queue_name, body,
+        content_type, headers) tuples.  Returns the list of spool ids.
+        """
+        now = time.time()
+        ids = []
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                for queue_name, body, content_type, headers in items:
+                    cur = self.db.execute(
+                        "INSERT INTO jobs (queue, body, content_type, headers, time_spooled) VALUES (?, ?, ?, ?, ?)",
+                        (queue_name, body, content_type,
+                         json.dumps(headers, default=str), now))
+                    ids.append(cur.lastrowid)
+                self.db.execute("COMMIT")
+
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.num_jobs += len(ids)
+        _m_spool_writes.inc(len(ids))
+        return ids
+
+    def remove(self, spool_id):
+        """Remove a job that is finished with."""
+        with self._lock:
+            cur = self.db.execute("DELETE FROM jobs WHERE id = ?", (spool_id,))
+            self.num_jobs -= cur.rowcount
+
+    def replay(self):
+        """Return (spool_id, queue_name, body, content_type, headers) for
+        all jobs in the spool, oldest first.
+        """
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, queue, body, content_type, headers FROM jobs ORDER BY id").fetchall()
+        return [(spool_id, queue_name, body, content_type,
+                 json.loads(headers) if headers else {})
+                for spool_id, queue_name, body, content_type, headers in rows]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,206 @@
+#
+# supervisor.py -- run a datasink as a group of consumer processes
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Runs N copies of the datasink `server` as separate processes, so that one
+sink can use more than one core for checksums, decoding and unpacking.
+Each process has its own connection to the realm and consumes from the
+same queue(s).
+
+The supervisor restarts processes that die, with an exponential backoff,
+writes the pids of the whole group to the pidfile, forwards SIGTERM/SIGINT
+to the group (so that each process drains its jobs) and SIGHUP (so that
+each process reloads its configuration) and, if 'metrics_port'
+is configured, serves the merged metrics of all processes on that port
+(process i serves its own metrics on metrics_port + 1 + i).
+
+Processes run in their own process group, so that a CTRL+C at the
+terminal reaches only the supervisor, which signals each process once.
+Each process also sends a heartbeat while none of its jobs has run for
+longer than 'job_timeout' seconds; a process whose heartbeat is older
+than 'health_timeout' seconds (e.g. one hung in I/O) is killed and
+restarted.
+"""
+import os
+import sys
+import copy
+import time
+import signal
+import threading
+import multiprocessing
+
+from datasink import log, metrics
+
+
+def _run_child(i, options, config, heartbeat, metrics_server=None):
+    from datasink.datasink import server
+
+    # signals from the terminal go to the supervisor only
+    os.setpgrp()
+
+    # the fork inherits the supervisor's metrics listening socket (but not
+    # the thread serving it); close it so that it isn't held open by us
+    if metrics_server is not None:
+        metrics_server.socket.close()
+
+    # processes inherit the supervisor's signal handlers; restore the
+    # defaults so that the sink drains on CTRL+C or SIGTERM
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    options = copy.copy(options)
+    # only the supervisor writes the pidfile
+    options.pidfile = None
+    if options.logfile is not None:
+        options.logfile = "{}.{}".format(options.logfile, i)
+
+    config = copy.deepcopy(config)
+    if config.get('metrics_port', None) is not None:
+        config['metrics_port'] = int(config['metrics_port']) + 1 + i
+
+    server(options, config, heartbeat=heartbeat)
+
+
+class Supervisor:
+
+    def __init__(self, logger, options, config, num_procs, pidfile=None):
+        self.logger = logger
+        self.options = options
+        self.config = config
+        self.num_procs = num_procs
+        self.pidfile = pidfile
+
+        self.ev_quit = threading.Event()
+        self.ctx = multiprocessing.get_context('fork')
+        self.procs = [None] * num_procs
+        # for each slot: time started, current backoff, time to restart
+        self.started = [0.0] * num_procs
+        self.backoff = [0.0] * num_procs
+        self.restart_at = [0.0] * num_procs
+        # time of the last heartbeat of each process
+        self.heartbeats = [self.ctx.Value('d', 0.0) for i in range(num_procs)]
+
+        self.min_backoff = config.get('restart_backoff_min', 1.0)
+        self.max_backoff = config.get('restart_backoff_max', 60.0)
+        # a process that has run at least this long is considered healthy
+        # and its backoff is reset
+        self.stable_time = config.get('restart_stable_time', 60.0)
+        self.stop_timeout = config.get('drain_timeout', 30.0) + 10.0
+        self.health_timeout = config.get('health_timeout', 60.0)
+        self.metrics_server = None
+
+    def start_proc(self, i):
+        self.heartbeats[i].value = 0.0
+        proc = self.ctx.Process(target=_run_child,
+                                args=(i, self.options, self.config,
+                                      self.heartbeats[i],
+                                      self.metrics_server),
+                                name=f"datasink-{i}")
+        proc.start()
+        self.procs[i] = proc
+        self.started[i] = time.time()
+        self.logger.info(f"started process {i} (pid={proc.pid})")
+        self.write_pidfile()
+
+    def write_pidfile(self):
+        if self.pidfile is None:
+            return
+        # supervisor first, so that --kill stops it before the group
+        pids = [os.getpid()] + [proc.pid for proc in self.procs
+                                if proc is not None and proc.pid is not None]
+        with open(self.pidfile, 'w') as pid_f:
+            pid_f.write('\n'.join([str(pid) for pid in pids]))
+
+    def check_procs(self):
+        now = time.time()
+        for i, proc in enumerate(self.procs):
+            if proc is not None and proc.is_alive():
+                last = max(self.started[i], self.heartbeats[i].value)
+                if now - last > self.health_timeout:
+                    self.logger.error("process {} (pid={}) has not sent a heartbeat for {:.1f} sec; killing it".format(
+                        i, proc.pid, now - last))
+                    proc.kill()
+                    proc.join()
+                else:
+                    continue
+
+            if proc is not None:
+                # process has died
+                proc.join()
+                ran = now - self.started[i]
+                if ran >= self.stable_time:
+                    self.backoff[i] = self.min_backoff
+                else:
+                    self.backoff[i] = min(self.max_backoff,
+                                          max(self.min_backoff,
+                                              self.backoff[i] * 2))
+                self.restart_at[i] = now + self.backoff[i]
+                self.procs[i] = None
+                self.logger.error("process {} (pid={}) exited with code {} after {:.1f} sec; restarting in {:.1f} sec".format(
+                    i, proc.pid, proc.exitcode, ran, self.backoff[i]))
+
+            if now >= self.restart_at[i]:
+                self.start_proc(i)
+
+    def stop(self, signum=None, frame=None):
+        self.ev_quit.set()
+
+    def reload(self, signum=None, frame=None):
+        # each process re-reads the configuration itself
+        for proc in self.procs:
+            if proc is not None and proc.is_alive():
+                os.kill(proc.pid, signal.SIGHUP)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+
+        port = self.config.get('metrics_port', None)
+        if port is not None:
+            host = self.config.get('metrics_host', 'localhost')
+            urls = ["http://{}:{}/metrics".format(host, int(port) + 1 + i)
+                    for i in range(self.num_procs)]
+            self.metrics_server = metrics.start_http_server(
+                int(port), host=host, registry=metrics.Aggregator(urls))
+            self.logger.info(f"serving merged metrics on http://{host}:{port}/metrics")
+
+        self.logger.info(f"starting {self.num_procs} datasink processes")
+        for i in range(self.num_procs):
+            self.start_proc(i)
+
+        while not self.ev_quit.is_set():
+            self.check_procs()
+            self.ev_quit.wait(1.0)
+
+        self.logger.info("stopping datasink processes...")
+        procs = [proc for proc in self.procs if proc is not None]
+        for proc in procs:
+            if proc.is_alive():
+                # processes drain their jobs on SIGTERM
+                os.kill(proc.pid, signal.SIGTERM)
+        deadline = time.time() + self.stop_timeout
+        for proc in procs:
+            proc.join(timeout=max(0, deadline - time.time()))
+            if proc.is_alive():
+                self.logger.warning(f"killing process (pid={proc.pid})")
+                proc.kill()
+                proc.join()
+
+        if self.pidfile is not None and os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
+        self.logger.info("all processes stopped.")
+
+
+def supervise(options, config, num_procs, pidfile=None):
+    logger = log.make_logger('datasink', options)
+
+    sup = Supervisor(logger, options, config, num_procs, pidfile=pidfile)
+    sup.run()
+
+    logger.info("Exiting program.")
+    sys.exit(0)
@@ -0,0 +1,302 @@
+#
+# trace.py -- lightweight per-job latency tracing
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+Per-job latency tracing through the sink pipeline.
+
+A `Trace` is attached to each sampled work unit when the message is
+received.  Stages of the pipeline add timed spans to it (local queueing,
+transfer, md5 check, unpack/move) and when the job is finished the trace
+is handed to the `Tracer`, which writes completed traces in batches from a
+background thread, either to a rotating JSONL file or as OTLP-compatible
+JSON (to a file, or POSTed to an OTLP/HTTP collector).
+
+Unsampled jobs get `null_trace`, whose methods do nothing, so the stages
+never need to check whether tracing is enabled.
+"""
+import os
+import time
+import json
+import queue
+import random
+import threading
+import contextlib
+import logging, logging.handlers
+import urllib.request
+
+from datasink import log
+
+
+class NullTrace:
+    """A trace that records nothing."""
+
+    def mark(self, name, t=None):
+        pass
+
+    def add_span(self, name, start, end, **attrs):
+        pass
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        yield self
+
+    def set_status(self, ok, msg=''):
+        pass
+
+    def finish(self):
+        pass
+
+
+null_trace = NullTrace()
+
+
+class Trace(NullTrace):
+
+    def __init__(self, tracer, job, queue_name):
+        self.tracer = tracer
+        self.trace_id = os.urandom(16).hex()
+        self.job = job
+        self.queue_name = queue_name
+        self.marks = dict(received=time.time())
+        self.spans = []
+        self.ok = None
+        self.msg = ''
+
+    def mark(self, name, t=None):
+        """Record that the job reached stage `name` at time `t`."""
+        if t is None:
+            t = time.time()
+        self.marks[name] = t
+
+    def add_span(self, name, start, end, **attrs):
+        self.spans.append(dict(name=name, start=start, end=end,
+                               duration=end - start, attrs=attrs))
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.add_span(name, start, time.time(), **attrs)
+
+    def set_status(self, ok, msg=''):
+        self.ok = ok
+        self.msg = msg
+
+    def finish(self):
+        """Close the trace and queue it for export."""
+        self.mark('done')
+        marks = self.marks
+        time_origin = self.job.get('time_origin', None)
+        if time_origin is not None:
+            self.add_span('broker_queue', time_origin, marks['received'])
+        if 'dequeued' in marks:
+            self.add_span('local_queue', marks['received'], marks['dequeued'])
+            self.add_span('execute', marks['dequeued'], marks['done'])
+        self.tracer.submit(self)
+
+    def as_dict(self):
+        job = self.job
+        start = job.get('time_origin', self.marks['received'])
+        return dict(trace_id=self.trace_id, job_id=job.get('id', None),
+                    action=job.get('action', None),
+                    source=job.get('source_origin', None),
+                    queue=self.queue_name, ok=self.ok, msg=self.msg,
+                    start=start, end=self.marks['done'],
+                    duration=self.marks['done'] - start,
+                    spans=sorted(self.spans, key=lambda d: d['start']))
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    if isinstance(value, int):
+        return dict(intValue=str(value))
+    if isinstance(value, float):
+        return dict(doubleValue=value)
+    return dict(stringValue=str(value))
+
+
+def _otlp_attrs(dct):
+    return [dict(key=key, value=_otlp_value(value))
+            for key, value in dct.items() if value is not None]
+
+
+def _nsec(t):
+    return str(int(t * 1e9))
+
+
+def to_otlp(traces, service_name='datasink'):
+    """Convert a list of Trace objects into an OTLP/JSON export request."""
+    spans = []
+    for tr in traces:
+        d = tr.as_dict()
+        root_id = os.urandom(8).hex()
+        spans.append(dict(traceId=d['trace_id'], spanId=root_id,
+                          name=str(d['action']), kind=5,
+                          startTimeUnixNano=_nsec(d['start']),
+                          endTimeUnixNano=_nsec(d['end']),
+                          attributes=_otlp_attrs(
+                              {'job.id': d['job_id'],
+                               'job.source': d['source'],
+                               'messaging.destination.name': d['queue']}),
+                          status=dict(code=1 if d['ok'] else 2,
+                                      message=d['msg'])))
+        for sp in d['spans']:
+            spans.append(dict(traceId=d['trace_id'],
+                              spanId=os.urandom(8).hex(),
+                              parentSpanId=root_id, name=sp['name'],
+                              kind=1,
+                              startTimeUnixNano=_nsec(sp['start']),
+                              endTimeUnixNano=_nsec(sp['end']),
+                              attributes=_otlp_attrs(sp['attrs'])))
+    return dict(resourceSpans=[
+        dict(resource=dict(attributes=_otlp_attrs(
+            {'service.name': service_name})),
+             scopeSpans=[dict(scope=dict(name='datasink'), spans=spans)])])
+
+
+class Tracer:
+    """Samples jobs for tracing and exports completed traces in batches.
+
+    Parameters
+    ----------
+      logger: logging.Logger
+          logger for errors
+      filepath: str or None (optional)
+          rotating file to write completed traces to
+      fmt: str (optional, defaults to 'jsonl')
+          'jsonl' for one trace per line, 'otlp' for one OTLP/JSON export
+          request per batch
+      url: str or None (optional)
+          URL of an OTLP/HTTP collector (e.g. http://host:4318/v1/traces)
+      sample_rate: float (optional, defaults to 1.0)
+          fraction of jobs to trace
+      batch_size: int (optional)
+          maximum number of traces written per batch
+      flush_interval: float (optional)
+          maximum seconds a completed trace waits before being written
+    """
+
+    def __init__(self, logger, filepath=None, fmt='jsonl', url=None,
+                 sample_rate=1.0, batch_size=100, flush_interval=5.0,
+                 maxbytes=log.max_logsize, backups=log.max_backups,
+                 service_name='datasink'):
+        self.logger = logger
+        self.fmt = fmt
+        self.url = url
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.service_name = service_name
+
+        self.trace_q = queue.Queue()
+        self.ev_quit = threading.Event()
+        self.thread = None
+
+        self.writer = None
+        if filepath is not None:
+            # reuse the logging machinery for size-based file rotation
+            self.writer = logging.Logger('datasink.trace')
+            hdlr = logging.handlers.RotatingFileHandler(filepath,
+                                                        maxBytes=maxbytes,
+                                                        backupCount=backups)
+            hdlr.setFormatter(logging.Formatter('%(message)s'))
+            self.writer.addHandler(hdlr)
+
+    @classmethod
+    def from_config(cls, logger, config, service_name='datasink'):
+        """Make a Tracer from config, or return None if tracing is off."""
+        filepath = config.get('trace_file', None)
+        url = config.get('trace_otlp_url', None)
+        if filepath is None and url is None:
+            return None
+        return cls(logger, filepath=filepath, url=url,
+                   fmt=config.get('trace_format', 'jsonl'),
+                   sample_rate=config.get('trace_sample_rate', 1.0),
+                   batch_size=config.get('trace_batch_size', 100),
+                   flush_interval=config.get('trace_flush_interval', 5.0),
+                   maxbytes=config.get('trace_maxbytes', log.max_logsize),
+                   backups=config.get('trace_backups', log.max_backups),
+                   service_name=service_name)
+
+    def start_trace(self, job, queue_name):
+        """Start a trace for `job`, if it is sampled."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return null_trace
+        return Trace(self, job, queue_name)
+
+    def submit(self, trace):
+        self.trace_q.put(trace)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.export_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.ev_quit.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def export_loop(self):
+        while not self.ev_quit.is_set():
+            self.flush(timeout=self.flush_interval)
+        # write whatever is left, a batch at a time
+        while self.flush(timeout=0) > 0:
+            pass
+
+    def flush(self, timeout=0):
+        """Export up to a batch of traces, waiting up to `timeout` seconds
+        for them.  Returns the number of traces taken off the queue.
+        """
+        batch = []
+        deadline = time.time() + timeout
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.trace_q.get(block=True,
+                                              timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        if len(batch) > 0:
+            self.export(batch)
+        return len(batch)
+
+    def export(self, batch):
+        """Write `batch` to the trace file and post it to the collector.
+        The file is written first, and a failure of either one does not
+        keep the batch from the other.
+        """
+        if self.writer is not None:
+            try:
+                self.write_file(batch)
+
+            except Exception as e:
+                self.logger.error(f"error writing traces: {e}", exc_info=True)
+
+        if self.url is not None:
+            try:
+                self.post_otlp(batch)
+
+            except Exception as e:
+                self.logger.error(f"error posting traces to {self.url}: {e}",
+                                  exc_info=True)
+
+    def write_file(self, batch):
+        if self.fmt == 'otlp':
+            otlp = to_otlp(batch, service_name=self.service_name)
+            self.writer.info(json.dumps(otlp))
+        else:
+            self.writer.info('\n'.join([json.dumps(tr.as_dict())
+                                        for tr in batch]))
+
+    def post_otlp(self, batch):
+        otlp = to_otlp(batch, service_name=self.service_name)
+        req = urllib.request.Request(self.url,
+                                     data=json.dumps(otlp).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=10.0) as resp:
+            resp.read()
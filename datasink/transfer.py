@@ -13,12 +13,45 @@ import datetime
 import subprocess
 import socket
 import json
+import hashlib
+import tarfile
+
+from datasink import metrics
+from datasink.trace import null_trace
+
+_m_xfer_bytes = metrics.registry.counter(
+    'datasink_transfer_bytes_total', "Bytes transferred",
+    ['host', 'method'])
+_m_xfer_rate = metrics.registry.histogram(
+    'datasink_transfer_bytes_per_second', "Transfer rate",
+    ['host', 'method'],
+    buckets=(1e4, 1e5, 1e6, 1e7, 5e7, 1e8, 2.5e8, 5e8, 1e9))
+_m_xfer_time = metrics.registry.histogram(
+    'datasink_transfer_seconds', "Transfer time", ['host', 'method'])
+_m_xfer_errors = metrics.registry.counter(
+    'datasink_transfer_errors_total', "Failed transfers", ['host', 'method'])
+_m_md5_time = metrics.registry.histogram(
+    'datasink_md5_seconds', "Time to calculate md5 checksums")
 
 class TransferError(Exception):
     pass
 class md5Error(TransferError):
     pass
 
+def file_md5sum(filepath, bufsize=1024 * 1024):
+    """Calculate the md5 checksum of a file in-process (same result as
+    the 'md5sum' command).
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as in_f:
+        while True:
+            buf = in_f.read(bufsize)
+            if len(buf) == 0:
+                break
+            md5.update(buf)
+    return md5.hexdigest()
+
+
 class Transfer:
 
     def __init__(self, logger, datadir,
@@ -28,7 +61,8 @@ class Transfer:
         # Base of where to store any FITS files we receive directly
         self.datadir = datadir
 
-        # Should we verify md5 checksum
+        # Should we verify md5 checksum ('require' to fail jobs that
+        # don't carry one)
         self.md5check = md5check
         # controls use of subdirectories for storing files
         self.storeby = storeby
@@ -56,8 +90,10 @@ class Transfer:
             else:
                 raise md5Error(result)
 
+            calc_time = time.time() - start_time
+            _m_md5_time.observe(calc_time)
             self.logger.debug("%s: md5sum=%s calc_time=%.3f sec" % (
-                    filepath, calc_md5sum, time.time() - start_time))
+                    filepath, calc_md5sum, calc_time))
             return calc_md5sum
 
         except Exception as e:
@@ -72,6 +108,9 @@ class Transfer:
 
         md5sum = req.get('md5sum', None)
         if md5sum is None:
+            if self.md5check == 'require':
+                raise md5Error("%s: upstream md5 checksum missing!" % (
+                    filepath))
             # For now only raise a warning when checksum seems to be
             # missing
             #raise md5Error("%s: upstream md5 checksum missing!" % (
@@ -86,6 +125,65 @@ class Transfer:
 
         return md5sum
 
+    def unbundle(self, bundle_path, extract_dir, manifest):
+        """Unpack a bundle of small files (see `ds_watch`) into
+        `extract_dir`, verifying the size and md5 checksum of every member
+        against `manifest`.  Members are only put in place if the whole
+        bundle checks out.  Returns the number of files unpacked.
+        """
+        expected = {entry['name']: entry for entry in manifest}
+        unpacked = []
+        try:
+            with tarfile.open(bundle_path, 'r') as tar_f:
+                for tarinfo in tar_f:
+                    name = os.path.normpath(tarinfo.name)
+                    entry = expected.pop(tarinfo.name, None)
+                    if (entry is None or not tarinfo.isfile() or
+                        os.path.isabs(name) or name.startswith('..')):
+                        raise md5Error("%s: unexpected member '%s'" % (
+                            bundle_path, tarinfo.name))
+
+                    newpath = os.path.join(extract_dir, name)
+                    os.makedirs(os.path.dirname(newpath), exist_ok=True)
+                    tmppath = newpath + '.part'
+                    unpacked.append((tmppath, newpath))
+
+                    md5 = hashlib.md5()
+                    nbytes = 0
+                    with tar_f.extractfile(tarinfo) as in_f:
+                        with open(tmppath, 'wb') as out_f:
+                            while True:
+                                buf = in_f.read(1024 * 1024)
+                                if len(buf) == 0:
+                                    break
+                                md5.update(buf)
+                                out_f.write(buf)
+                                nbytes += len(buf)
+
+                    if nbytes != entry['size']:
+                        raise md5Error("%s: size (%d) does not match sent size (%d)" % (
+                            name, nbytes, entry['size']))
+                    if md5.hexdigest() != entry['md5sum']:
+                        raise md5Error("%s: md5 checksums don't match recv='%s' sent='%s'" % (
+                            name, md5.hexdigest(), entry['md5sum']))
+
+            if len(expected) > 0:
+                raise md5Error("%s: %d members missing, e.g. '%s'" % (
+                    bundle_path, len(expected), list(expected.keys())[0]))
+
+        except Exception:
+            for tmppath, newpath in unpacked:
+                if os.path.exists(tmppath):
+                    os.remove(tmppath)
+            raise
+
+        for tmppath, newpath in unpacked:
+            self.check_rename(newpath)
+            os.rename(tmppath, newpath)
+        self.logger.info("unbundled %d files from %s" % (
+            len(unpacked), bundle_path))
+        return len(unpacked)
+
     def get_newpath(self, filename, req, direction='from'):
 
         abspath = lambda x: x
@@ -112,7 +210,7 @@ class Transfer:
 
         return newpath
 
-    def transfer(self, req, info, xfer_dict):
+    def transfer(self, req, info, xfer_dict, trace=null_trace):
 
         filepath = req['srcpath']
         direction = req.get('direction', 'from')
@@ -135,13 +233,15 @@ class Transfer:
                                    transfermethod=req['transfermethod'],
                                    username=req.get('username', None),
                                    port=req.get('port', None),
-                                   result=xfer_dict, info=info, req=req)
+                                   result=xfer_dict, info=info, req=req,
+                                   trace=trace)
             else:
                 self.transfer_to(filepath, req['host'], newpath,
                                    transfermethod=req['transfermethod'],
                                    username=req.get('username', None),
                                    port=req.get('port', None),
-                                   result=xfer_dict, info=info, req=req)
+                                   result=xfer_dict, info=info, req=req,
+                                   trace=trace)
 
         except Exception as e:
             errmsg = "Failed to transfer file '%s': %s" % (filename, str(e))
@@ -150,6 +250,12 @@ class Transfer:
             info['errmsg'] = errmsg
             return
 
+    def _record_transfer(self, host, transfermethod, nbytes, elapsed):
+        _m_xfer_bytes.labels(host, transfermethod).inc(nbytes)
+        _m_xfer_time.labels(host, transfermethod).observe(elapsed)
+        if elapsed > 0:
+            _m_xfer_rate.labels(host, transfermethod).observe(nbytes / elapsed)
+
     def check_rename(self, newpath):
         if os.path.exists(newpath):
             renamepath = newpath + time.strftime(".%Y%m%d-%H%M%S",
@@ -163,7 +269,7 @@ class Transfer:
     def transfer_from(self, filepath, host, newpath,
                       transfermethod='ftps', username=None,
                       password=None, port=None, result={},
-                      info={}, req={}):
+                      info={}, req={}, trace=null_trace):
 
         """This function handles transfering a file via one of the following
         protocols: { ftp, ftps, sftp, http, https, scp, copy (nfs) }
@@ -190,6 +296,8 @@ class Transfer:
               metadata info collected about the file
           req: dict
               the original file transfer request
+          trace: datasink.trace.Trace (optional)
+              trace to record the transfer stages in
         """
 
         # check for file exists already; if so, rename it and allow the
@@ -273,14 +381,23 @@ class Transfer:
             start_time = time.time()
 
             res = os.system(cmd)
+            # exit status of the transfer command itself, as opposed to
+            # the checks done locally afterwards
+            result.update(dict(xfer_exit=res))
 
             end_time = time.time()
+            elapsed = end_time - start_time
+            trace.add_span('transfer', start_time, end_time,
+                           host=host, method=transfermethod)
             self.logger.info("transfer completed, elapsed=%.4f sec" % (
-                end_time - start_time))
+                elapsed))
 
             # Check size
             statbuf = os.stat(newpath)
             info['filesize'] = statbuf.st_size
+            if res == 0:
+                self._record_transfer(host, transfermethod,
+                                      statbuf.st_size, elapsed)
             size = req.get('size', None)
             if size != None:
                 if info['filesize'] != size:
@@ -290,7 +407,8 @@ class Transfer:
 
             if self.md5check:
                 # Check MD5 hash
-                md5sum = self.check_md5sum(newpath, req)
+                with trace.span('md5'):
+                    md5sum = self.check_md5sum(newpath, req)
             else:
                 md5sum = None
             info['md5sum'] = md5sum
@@ -299,6 +417,7 @@ class Transfer:
                                md5sum=md5sum, xfer_code=res))
 
         except (OSError, md5Error) as e:
+            _m_xfer_errors.labels(host, transfermethod).inc()
             self.logger.error("Command was: %s" % (cmd))
             errmsg = "Failed to transfer file '%s': %s" % (
                 filename, str(e))
@@ -307,6 +426,7 @@ class Transfer:
             raise TransferError(errmsg)
 
         if res != 0:
+            _m_xfer_errors.labels(host, transfermethod).inc()
             self.logger.error("Command was: %s" % (cmd))
             errmsg = "Failed to transfer file '%s': exit err=%d" % (
                 filename, res)
@@ -316,7 +436,7 @@ class Transfer:
     def transfer_to(self, filepath, host, newpath,
                       transfermethod='ftps', username=None,
                       password=None, port=None, result={},
-                      info={}, req={}):
+                      info={}, req={}, trace=null_trace):
 
         """This function handles transfering a file via one of the following
         protocols: { ftp, ftps, sftp, http, https, scp, copy (nfs) }
@@ -343,6 +463,8 @@ class Transfer:
               metadata info collected about the file
           req: dict
               the original file transfer request
+          trace: datasink.trace.Trace (optional)
+              trace to record the transfer stages in
         """
 
         # check for file exists already; if so, rename it and allow the
@@ -426,10 +548,22 @@ class Transfer:
             start_time = time.time()
 
             res = os.system(cmd)
+            # exit status of the transfer command itself, as opposed to
+            # the checks done locally afterwards
+            result.update(dict(xfer_exit=res))
 
             end_time = time.time()
+            elapsed = end_time - start_time
+            trace.add_span('transfer', start_time, end_time,
+                           host=host, method=transfermethod)
             self.logger.info("transfer completed, elapsed=%.4f sec" % (
-                end_time - start_time))
+                elapsed))
+            if res == 0:
+                try:
+                    self._record_transfer(host, transfermethod,
+                                          os.stat(filepath).st_size, elapsed)
+                except OSError:
+                    pass
 
             # TODO: Check size, md5sum on remote?
             size, md5sum = None, None
@@ -440,6 +574,7 @@ class Transfer:
                                md5sum=md5sum, xfer_code=res))
 
         except (OSError, md5Error) as e:
+            _m_xfer_errors.labels(host, transfermethod).inc()
             self.logger.error("Command was: %s" % (cmd))
             errmsg = "Failed to transfer file '%s': %s" % (
                 filename, str(e))
@@ -448,6 +583,7 @@ class Transfer:
             raise TransferError(errmsg)
 
         if res != 0:
+            _m_xfer_errors.labels(host, transfermethod).inc()
             self.logger.error("Command was: %s" % (cmd))
             errmsg = "Failed to transfer file '%s': exit err=%d" % (
                 filename, res)
@@ -0,0 +1,526 @@
+#
+# watcher.py -- turn new files in watched directories into transfer jobs
+#
+# This is open-source software licensed under a BSD license.
+# Please see the file LICENSE.md for details.
+#
+"""
+`FileWatcher` watches directories for new files and submits a 'transfer'
+job for each one through a `JobSource`.
+
+Files are picked up when they are closed after writing (or moved into
+the directory), using inotify via the optional `inotify_simple` package;
+without it the directories are polled instead.  A file is only taken
+once it has been quiet for 'watch_debounce_sec' seconds, so a file that
+is written in several goes is sent once, complete.  Its size and md5
+checksum are then calculated in a pool of 'hash_workers' threads and put
+in the job, so that the sink can verify the transfer (see 'md5check').
+Jobs are submitted in batches of up to 'watch_batch_size', at least
+every 'watch_batch_sec' seconds.
+
+The files published are recorded in 'watch_state_file' (SQLite), so that
+they are not published again after a restart, while files that arrived
+while the watcher was down are picked up by a scan at startup.
+
+If 'bundle_max_file_size' is set, files smaller than that are not sent
+one job per file but packed into tar bundles in 'bundle_dir', each holding
+up to 'bundle_max_files' files or 'bundle_max_bytes' bytes, or whatever
+arrived within 'bundle_window_sec' seconds.  A bundle is sent as one
+transfer job with a 'bundle' manifest listing the name, size and md5
+checksum of each member; the sink unpacks it and verifies every member.
+Members are named by their watched directory's name and their path in it,
+and 'bundle_dir' must not be watched itself.
+Bundles are removed from 'bundle_dir' after 'bundle_keep_sec' seconds.
+"""
+import os
+import time
+import socket
+import fnmatch
+import hashlib
+import sqlite3
+import tarfile
+import threading
+from concurrent import futures
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    have_inotify = True
+except ImportError:
+    have_inotify = False
+
+from datasink import metrics
+from datasink.transfer import TransferRequest, file_md5sum
+
+_m_files_seen = metrics.registry.counter(
+    'datasink_watch_files_seen_total', "New files seen in watched directories")
+_m_files_published = metrics.registry.counter(
+    'datasink_watch_files_published_total', "Transfer jobs published for files")
+_m_hash_time = metrics.registry.histogram(
+    'datasink_watch_hash_seconds', "Time to checksum a new file")
+_m_hash_queue = metrics.registry.gauge(
+    'datasink_watch_hash_queue', "Files waiting to be checksummed")
+_m_bundles = metrics.registry.counter(
+    'datasink_watch_bundles_total', "Bundles of small files made")
+_m_bundled_files = metrics.registry.counter(
+    'datasink_watch_bundled_files_total', "Small files put in bundles")
+
+
+class WatchState:
+    """Persistent record of the files that have been published."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        if path != ':memory:':
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                             path TEXT PRIMARY KEY, size INTEGER,
+                             mtime REAL, md5sum TEXT, time_published REAL)""")
+
+    def is_published(self, path, size, mtime):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT size, mtime FROM files WHERE path = ?",
+                (path,)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    def add_many(self, items):
+        """Record files as published.  `items` is a list of (path, size,
+        mtime, md5sum) tuples.
+        """
+        now = time.time()
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO files (path, size, mtime, md5sum, time_published) VALUES (?, ?, ?, ?, ?)",
+                    [(path, size, mtime, md5sum, now)
+                     for path, size, mtime, md5sum in items])
+                self.db.execute("COMMIT")
+
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def prune(self):
+        """Forget files that no longer exist."""
+        with self._lock:
+            paths = [row[0] for row in
+                     self.db.execute("SELECT path FROM files").fetchall()]
+            gone = [(path,) for path in paths if not os.path.exists(path)]
+            if len(gone) > 0:
+                self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+        return len(gone)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class FileWatcher:
+
+    def __init__(self, logger, jobsrc, config):
+        self.logger = logger
+        self.jobsrc = jobsrc
+        self.config = config
+
+        self.dirs = [os.path.abspath(path) for path in config['watch_dirs']]
+        self.patterns = config.get('watch_patterns', ['*'])
+        self.ignore = config.get('watch_ignore', ['.*', '*.tmp', '*.part'])
+        self.recursive = config.get('watch_recursive', False)
+        self.debounce_sec = config.get('watch_debounce_sec', 2.0)
+        self.poll_sec = config.get('watch_poll_sec', 5.0)
+        self.batch_size = config.get('watch_batch_size', 100)
+        self.batch_sec = config.get('watch_batch_sec', 1.0)
+        self.retry_interval = config.get('retry_interval', 60.0)
+        # else the job source's topic
+        self.topic = config.get('watch_topic', None)
+
+        # how the sink should fetch the files
+        self.host = config.get('transfer_host', socket.getfqdn())
+        self.method = config.get('transfer_method', 'ftps')
+        self.username = config.get('transfer_username', None)
+        self.dstdir = config.get('transfer_dstdir', '.')
+        self.priority = config.get('transfer_priority', None)
+        # extra metadata for every job (e.g. insname, propid)
+        self.job_extra = config.get('job_extra', {})
+
+        # small file bundling
+        self.bundle_max_file_size = config.get('bundle_max_file_size', None)
+        self.bundle_dir = config.get('bundle_dir', None)
+        if self.bundle_max_file_size is not None:
+            self.check_bundle_dir()
+        self.bundle_max_files = config.get('bundle_max_files', 1000)
+        self.bundle_max_bytes = config.get('bundle_max_bytes', 256 * 1024 * 1024)
+        self.bundle_window_sec = config.get('bundle_window_sec', 10.0)
+        self.bundle_keep_sec = config.get('bundle_keep_sec', 86400.0)
+
+        self.state = WatchState(config.get('watch_state_file', ':memory:'))
+        self.pool = futures.ThreadPoolExecutor(
+            max_workers=config.get('hash_workers', 4))
+
+        # path -> time of last event, for files waiting to settle
+        self.candidates = dict()
+        # path -> (size, mtime) at the last poll
+        self.last_seen = dict()
+        # future -> path, for files being checksummed
+        self.hashing = dict()
+        # future -> bundle members, for bundles being written
+        self.bundling = dict()
+        # jobs waiting to be submitted, each with a list of the
+        # (path, size, mtime, md5sum) of the file(s) it is for
+        self.batch = []
+        self.batch_time = time.time()
+        self.last_poll = 0.0
+        # small files waiting to be bundled
+        self.bundle_items = []
+        self.bundle_bytes = 0
+        self.bundle_time = time.time()
+        self.bundle_seq = 0
+        self.last_cleanup = 0.0
+
+        self.inotify = None
+        self.wds = dict()
+
+        _m_hash_queue.set_function(lambda: len(self.hashing))
+
+    def check_bundle_dir(self):
+        """Reject a bundling setup in which the watcher would pick up its
+        own bundles, or in which members of different watched directories
+        could get the same name in a bundle.
+        """
+        if self.bundle_dir is None:
+            raise ValueError("'bundle_dir' is needed for bundling")
+        self.bundle_dir = os.path.abspath(self.bundle_dir)
+        for dirpath in self.dirs:
+            if (self.bundle_dir == dirpath or
+                (self.recursive and
+                 self.bundle_dir.startswith(dirpath + os.sep))):
+                raise ValueError(f"'bundle_dir' ({self.bundle_dir}) is watched (in {dirpath})")
+        names = [os.path.basename(dirpath) for dirpath in self.dirs]
+        if len(set(names)) != len(names):
+            raise ValueError("watched directories need different names for bundling")
+
+    def is_wanted(self, path):
+        filename = os.path.basename(path)
+        for pattern in self.ignore:
+            if fnmatch.fnmatch(filename, pattern):
+                return False
+        for pattern in self.patterns:
+            if fnmatch.fnmatch(filename, pattern):
+                return True
+        return False
+
+    def get_topdir(self, path):
+        for dirpath in self.dirs:
+            if path.startswith(dirpath + os.sep):
+                return dirpath
+        return os.path.dirname(path)
+
+    def walk(self):
+        """Yield the paths of all wanted files in the watched directories."""
+        for dirpath in self.dirs:
+            for root, dirnames, filenames in os.walk(dirpath):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if self.is_wanted(path):
+                        yield path
+                if not self.recursive:
+                    break
+
+    def add_watch(self, dirpath):
+        mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO |
+                inotify_flags.CREATE)
+        wd = self.inotify.add_watch(dirpath, mask)
+        self.wds[wd] = dirpath
+
+    def start(self):
+        if have_inotify:
+            self.inotify = INotify()
+            for dirpath in self.dirs:
+                for root, dirnames, filenames in os.walk(dirpath):
+                    self.add_watch(root)
+                    if not self.recursive:
+                        break
+        else:
+            self.logger.warning("inotify_simple not installed; polling directories every {} sec".format(
+                self.poll_sec))
+
+        # pick up files that arrived while we were not running
+        num_pruned = self.state.prune()
+        self.logger.info(f"forgot {num_pruned} files that no longer exist")
+        now = time.time()
+        for path in self.walk():
+            self.candidates[path] = now
+
+    def poll_events(self, timeout):
+        """Wait up to `timeout` sec for new files and add them to the
+        candidates.
+        """
+        now = time.time()
+        if self.inotify is not None:
+            for event in self.inotify.read(timeout=int(timeout * 1000)):
+                dirpath = self.wds.get(event.wd, None)
+                if dirpath is None or not event.name:
+                    continue
+                path = os.path.join(dirpath, event.name)
+                if event.mask & inotify_flags.ISDIR:
+                    if (event.mask & inotify_flags.CREATE) and self.recursive:
+                        self.add_watch(path)
+                    continue
+                if event.mask & inotify_flags.CREATE:
+                    # (re)started writing; wait for the close
+                    self.candidates.pop(path, None)
+                    continue
+                if self.is_wanted(path):
+                    self.candidates[path] = time.time()
+            return
+
+        time.sleep(timeout)
+        if now - self.last_poll < self.poll_sec:
+            return
+        self.last_poll = now
+        for path in self.walk():
+            try:
+                statbuf = os.stat(path)
+
+            except OSError:
+                continue
+            stat_key = (statbuf.st_size, statbuf.st_mtime)
+            if self.last_seen.get(path, None) != stat_key:
+                # new or still changing
+                self.last_seen[path] = stat_key
+                self.candidates[path] = now
+
+    def start_hashes(self):
+        """Checksum the candidates that have settled."""
+        now = time.time()
+        settled = [path for path, last_time in self.candidates.items()
+                   if now - last_time >= self.debounce_sec]
+        for path in settled:
+            del self.candidates[path]
+            try:
+                statbuf = os.stat(path)
+
+            except OSError:
+                # removed or renamed again before we got to it
+                continue
+            if self.state.is_published(path, statbuf.st_size,
+                                       statbuf.st_mtime):
+                continue
+            _m_files_seen.inc()
+            self.hashing[self.pool.submit(self.hash_file, path)] = path
+
+    def hash_file(self, path):
+        start_time = time.time()
+        statbuf = os.stat(path)
+        md5sum = file_md5sum(path)
+        after = os.stat(path)
+        _m_hash_time.observe(time.time() - start_time)
+        if (after.st_size, after.st_mtime) != (statbuf.st_size,
+                                               statbuf.st_mtime):
+            # still being written
+            return None
+        return (path, statbuf.st_size, statbuf.st_mtime, md5sum)
+
+    def collect_hashes(self):
+        done = [fut for fut in self.hashing if fut.done()]
+        for fut in done:
+            path = self.hashing.pop(fut)
+            try:
+                res = fut.result()
+
+            except Exception as e:
+                self.logger.error(f"error checksumming {path}: {e}")
+                continue
+            if res is None:
+                self.logger.info(f"{path} changed while checksumming; waiting")
+                self.candidates[path] = time.time()
+                continue
+            self.add_file(*res)
+
+    def make_job(self, path, size, mtime, md5sum):
+        relpath = os.path.relpath(path, self.get_topdir(path))
+        req = TransferRequest(path, os.path.join(self.dstdir, relpath),
+                              self.username, self.host, self.method,
+                              size=size, md5sum=md5sum,
+                              priority=self.priority, **self.job_extra)
+        job = dict(req.as_dict())
+        # the same file always gets the same id, so that the sink can
+        # drop duplicates (see 'dedup_enable')
+        job['id'] = hashlib.sha1("{}:{}:{}:{}".format(
+            self.host, path, size, mtime).encode('utf-8')).hexdigest()
+        job['action'] = 'transfer'
+        return job
+
+    def add_file(self, path, size, mtime, md5sum):
+        if (self.bundle_max_file_size is not None and
+            size < self.bundle_max_file_size):
+            if len(self.bundle_items) == 0:
+                self.bundle_time = time.time()
+            self.bundle_items.append((path, size, mtime, md5sum))
+            self.bundle_bytes += size
+            return
+        self.add_job(self.make_job(path, size, mtime, md5sum),
+                     [(path, size, mtime, md5sum)])
+
+    def add_job(self, job, items):
+        if len(self.batch) == 0:
+            self.batch_time = time.time()
+        self.batch.append((job, items))
+
+    def check_bundle(self, force=False):
+        """Start writing a bundle if enough small files have arrived."""
+        if len(self.bundle_items) == 0:
+            return
+        if not (force or len(self.bundle_items) >= self.bundle_max_files or
+                self.bundle_bytes >= self.bundle_max_bytes or
+                time.time() - self.bundle_time >= self.bundle_window_sec):
+            return
+        items, self.bundle_items = self.bundle_items, []
+        self.bundle_bytes = 0
+        self.bundle_seq += 1
+        name = "bundle-{}-{}-{:06d}.tar".format(
+            self.host.split('.')[0], time.strftime("%Y%m%d-%H%M%S"),
+            self.bundle_seq)
+        fut = self.pool.submit(self.write_bundle,
+                               os.path.join(self.bundle_dir, name), items)
+        self.bundling[fut] = items
+
+    def write_bundle(self, bundle_path, items):
+        """Write the files in `items` to a tar file.  Returns the bundle
+        path, its size, md5 checksum and manifest, and the items that were
+        bundled (files that changed since they were checksummed are left
+        out).
+        """
+        tmp_path = bundle_path + '.part'
+        manifest, bundled = [], []
+        with tarfile.open(tmp_path, 'w') as tar_f:
+            for item in items:
+                path, size, mtime, md5sum = item
+                # members are stored under the name of their watched
+                # directory, so files from different ones don't collide
+                topdir = self.get_topdir(path)
+                arcname = os.path.join(os.path.basename(topdir),
+                                       os.path.relpath(path, topdir))
+                try:
+                    with open(path, 'rb') as in_f:
+                        tarinfo = tar_f.gettarinfo(arcname=arcname,
+                                                   fileobj=in_f)
+                        if ((tarinfo.size, int(tarinfo.mtime)) !=
+                            (size, int(mtime))):
+                            self.logger.info(f"{path} changed since checksumming; not bundled")
+                            continue
+                        tar_f.addfile(tarinfo, fileobj=in_f)
+
+                except OSError as e:
+                    self.logger.error(f"error bundling {path}: {e}")
+                    continue
+                manifest.append(dict(name=arcname, size=size, md5sum=md5sum))
+                bundled.append(item)
+        os.rename(tmp_path, bundle_path)
+        size = os.stat(bundle_path).st_size
+        return (bundle_path, size, file_md5sum(bundle_path), manifest, bundled)
+
+    def collect_bundles(self):
+        done = [fut for fut in self.bundling if fut.done()]
+        for fut in done:
+            items = self.bundling.pop(fut)
+            try:
+                bundle_path, size, md5sum, manifest, bundled = fut.result()
+
+            except Exception as e:
+                self.logger.error(f"error writing bundle: {e}", exc_info=True)
+                # send the files one by one instead
+                for item in items:
+                    self.add_job(self.make_job(*item), [item])
+                continue
+
+            job = self.make_job(bundle_path, size,
+                                os.stat(bundle_path).st_mtime, md5sum)
+            job['bundle'] = manifest
+            self.add_job(job, bundled)
+            _m_bundles.inc()
+            _m_bundled_files.inc(len(bundled))
+            # files left out are picked up again once they settle
+            left_out = set([item[0] for item in items]) - set([item[0] for item in bundled])
+            now = time.time()
+            for path in left_out:
+                self.candidates[path] = now
+            self.logger.info("bundled {} files in {}".format(
+                len(bundled), bundle_path))
+
+    def cleanup_bundles(self):
+        """Remove bundles old enough to have been fetched."""
+        now = time.time()
+        if self.bundle_dir is None or now - self.last_cleanup < 60.0:
+            return
+        self.last_cleanup = now
+        for filename in os.listdir(self.bundle_dir):
+            if not filename.startswith('bundle-'):
+                continue
+            path = os.path.join(self.bundle_dir, filename)
+            try:
+                if now - os.stat(path).st_mtime > self.bundle_keep_sec:
+                    os.remove(path)
+
+            except OSError as e:
+                self.logger.warning(f"error removing old bundle {path}: {e}")
+
+    def flush(self, force=False):
+        """Submit the batch if it is full or old enough."""
+        if len(self.batch) == 0:
+            return True
+        if not (force or len(self.batch) >= self.batch_size or
+                time.time() - self.batch_time >= self.batch_sec):
+            return True
+
+        batch, self.batch = self.batch[:self.batch_size], self.batch[self.batch_size:]
+        jobs = [job for job, item in batch]
+        try:
+            results = self.jobsrc.submit_many(jobs, topic=self.topic)
+            if results is not None:
+                # wait for the confirms before recording the files
+                for res in results:
+                    res.result()
+
+        except Exception as e:
+            self.logger.error(f"error submitting {len(jobs)} jobs: {e}")
+            # try again later
+            self.batch = batch + self.batch
+            return False
+
+        items = [item for job, _items in batch for item in _items]
+        self.state.add_many(items)
+        _m_files_published.inc(len(items))
+        return True
+
+    def run(self, ev_quit):
+        self.start()
+        while not ev_quit.is_set():
+            self.poll_events(0.2)
+            self.start_hashes()
+            self.collect_hashes()
+            self.check_bundle()
+            self.collect_bundles()
+            self.cleanup_bundles()
+            if not self.flush():
+                ev_quit.wait(self.retry_interval)
+                self.jobsrc.recover_jobsrc(ev_quit)
+
+        # submit what we have hashed already
+        self.pool.shutdown(wait=True)
+        self.collect_hashes()
+        # NOTE: small files not bundled yet are not recorded as
+        # published, so they are picked up again at the next start
+        self.collect_bundles()
+        while len(self.batch) > 0:
+            if not self.flush(force=True):
+                break
+
+    def stop(self):
+        self.state.close()
+        if self.inotify is not None:
+            self.inotify.close()
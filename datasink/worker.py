@@ -7,7 +7,7 @@
 
 import sys
 import time
-import json
+import signal
 import functools
 import queue
 import pprint
@@ -15,17 +15,90 @@ import threading
 
 import pika
 
-from datasink.initialize import read_config, default_topic
+from datasink.initialize import (read_config, default_topic,
+                                 get_retry_delays, retry_tier_name,
+                                 shard_queue_names, shard_exchange_name,
+                                 bind_topic, shard_header)
+from datasink import metrics, trace, codec, dedup
+from datasink.spool import Spool
+from datasink.autoscale import Autoscaler
+from datasink.ordering import KeyedWorkQueue
+
+_m_received = metrics.registry.counter(
+    'datasink_messages_received_total',
+    "Messages received from the broker", ['queue'])
+_m_acked = metrics.registry.counter(
+    'datasink_messages_acked_total', "Messages ACKed", ['queue'])
+_m_nacked = metrics.registry.counter(
+    'datasink_messages_nacked_total', "Messages NACKed", ['queue'])
+_m_retried = metrics.registry.counter(
+    'datasink_messages_retried_total',
+    "Failed messages sent to a delayed retry tier", ['queue', 'tier'])
+_m_queue_depth = metrics.registry.gauge(
+    'datasink_work_queue_depth', "Jobs waiting in the local work queue")
+_m_busy_ratio = metrics.registry.gauge(
+    'datasink_worker_busy_ratio', "Fraction of workers executing a job")
+_m_latency = metrics.registry.histogram(
+    'datasink_job_latency_seconds',
+    "End-to-end job latency from submission (time_origin) to completion",
+    ['action'])
+_m_superseded = metrics.registry.counter(
+    'datasink_jobs_superseded_total',
+    "Jobs ACKed without running because a newer one was queued", ['queue'])
+_m_superseded_bytes = metrics.registry.counter(
+    'datasink_superseded_bytes_total',
+    "Bytes not transferred thanks to superseded jobs", ['queue'])
 
 
 class JobSink:
 
+    # config keys set by the program rather than the configuration file,
+    # or only read at startup (a supervisor also offsets 'metrics_port' per
+    # process), which are kept across a reload
+    runtime_keys = ('queue_names', 'metrics_port', 'metrics_host')
+
     def __init__(self, logger, name):
         self.logger = logger
         self.name = name
-        self.work_queue = queue.Queue()
+        # jobs with the same 'order_key' are handed out one at a time
+        self.work_queue = KeyedWorkQueue()
         self.config = dict()
+        self.configfile = None
+        # all worker threads started
         self.threads = []
+        # current worker pool: list of (thread, ev_stop)
+        self.workers = []
+        self._worker_num = 0
+        self.ev_quit = None
+        self.connection = None
+        self.channel = None
+        # queue name -> consumer tag, for the current channel
+        self.consumers = dict()
+        # topic given to serve(), overrides config
+        self.topic_override = None
+        # called with (old_config, new_config, diff) after a reload
+        self.reload_callbacks = []
+        self.tracer = None
+        self.dedup = None
+        # dedup key -> duplicates waiting for the job in progress
+        self._held = dict()
+        self._held_lock = threading.Lock()
+        self.autoscaler = None
+        self.spool = None
+        # work units received but not yet written to the spool
+        self._spool_pending = []
+        self._spool_flush_scheduled = False
+        # spool id -> (work unit, msg_txt, info) for failed spooled jobs
+        # not yet sent to a retry tier or dead-lettered
+        self._unsettled = dict()
+        self._unsettled_lock = threading.Lock()
+        # number of workers currently executing a job
+        self.num_busy = 0
+        # total time workers have spent executing jobs
+        self.busy_time = 0.0
+        # worker number -> time its current job started
+        self.job_start = dict()
+        self._busy_lock = threading.Lock()
 
         self.action_tbl = {'ping': self.ping,
                            'window': self.window,
@@ -33,10 +106,56 @@ class JobSink:
                            'debug': self.debug,
                            }
         self.recover_interval = 60.0
+        # number of retry tiers that exist at the broker, if fewer than
+        # configured
+        self.num_retry_tiers = None
+        # set if we are configured with shards but the hub has not
+        # created our shard exchange
+        self.shards_missing = False
+        self._warned_shard_key = False
+
+        _m_queue_depth.set_function(self.work_queue.qsize)
+        _m_busy_ratio.set_function(self.get_busy_ratio)
+
+        # how long we will wait for prefetched and in-flight jobs to
+        # finish on shutdown before requeueing the rest
+        self.drain_timeout = 30.0
+        self.drain_deadline = 0.0
 
     def add_action(self, aname, method):
         self.action_tbl[aname] = method
 
+    def add_reload_callback(self, fn):
+        """Register `fn(old_config, new_config, diff)` to be called when
+        the configuration is reloaded.  It should raise an exception if
+        it cannot apply the new configuration.
+        """
+        self.reload_callbacks.append(fn)
+
+    def get_prefetch_count(self):
+        """Size of the window of unacknowledged jobs for our channel."""
+        if self.spool is not None:
+            # jobs are ACKed as soon as they are spooled, so we can
+            # afford to pull large batches
+            return self.config.get('spool_prefetch', 1000)
+        num = max(1, len(self.workers))
+        return num * self.config.get('prefetch_factor', 1)
+
+    def get_busy_time(self, now=None):
+        """Total time workers have spent executing jobs, including the
+        jobs running now.
+        """
+        if now is None:
+            now = time.time()
+        with self._busy_lock:
+            return self.busy_time + sum([now - start_time
+                                         for start_time in self.job_start.values()])
+
+    def get_busy_ratio(self):
+        if len(self.workers) == 0:
+            return 0.0
+        return self.num_busy / len(self.workers)
+
     def _ack_message(self, ack_flag, channel, delivery_tag, requeue=False):
         # Note that `channel` must be the same pika channel instance via which
         # the message being ACKed was retrieved (AMQP protocol constraint).
@@ -49,35 +168,396 @@ class JobSink:
             # Channel is already closed, so we can't ACK this message
             self.logger.error("Whups! channel is closed--can't ACK")
 
+    def _release(self, work_unit, ack_flag):
+        """Let go of a work unit: ACK/NACK it at the broker or, if it was
+        spooled (and so ACKed to the broker already), remove it from the
+        spool.
+        """
+        spool_id = work_unit.get('spool_id', None)
+        if spool_id is not None:
+            self.spool.remove(spool_id)
+        else:
+            self._ack_message(ack_flag, work_unit['channel'],
+                              work_unit['delivery_tag'])
+
+    def _dead_letter(self, work_unit, channel, msg_txt):
+        _m_nacked.labels(work_unit.get('queue_name', '')).inc()
+        if work_unit.get('spool_id', None) is None:
+            # broker routes NACKed jobs to the DLX
+            self._ack_message(False, channel, work_unit['delivery_tag'])
+            return
+
+        # spooled job was ACKed already, so send it to the DLX ourselves
+        props = work_unit['properties']
+        headers = dict(props.headers or {})
+        headers['x-ds-error'] = str(msg_txt)[:1024]
+        headers['x-ds-queue'] = work_unit['queue_name']
+        channel.basic_publish(exchange='dlx',
+                              routing_key=work_unit['queue_name'],
+                              body=work_unit['body'],
+                              properties=pika.BasicProperties(
+                                  content_type=props.content_type,
+                                  headers=headers))
+        self._release(work_unit, False)
+
+    def _settle(self, work_unit, ack_flag, msg_txt, info):
+        """Finish with a work unit at the broker.  Failed jobs are sent to
+        the next retry tier, if there is one, otherwise they are NACKed
+        (and dead-lettered).  Jobs NACKed with `defer` set in `info` are
+        sent to the first retry tier without using up an attempt.
+        Runs in the connection's thread.
+        """
+        spooled = work_unit.get('spool_id', None) is not None
+        channel = self.channel if spooled else work_unit['channel']
+        if ack_flag:
+            self._release(work_unit, True)
+            return
+        if spooled:
+            with self._unsettled_lock:
+                if self._unsettled.pop(work_unit['spool_id'], None) is None:
+                    # settled already, after a reconnect
+                    return
+        if channel is None or not channel.is_open:
+            if spooled:
+                self.logger.error("channel is closed; failed job will be settled on reconnect")
+                self._add_unsettled(work_unit, msg_txt, info)
+            else:
+                self._ack_message(False, channel, work_unit['delivery_tag'])
+            return
+
+        props = work_unit.get('properties', None)
+        headers = dict(props.headers or {}) if props is not None else {}
+        attempt = headers.get('x-ds-attempt', 0)
+        delays = self.get_retry_delays()
+        defer = info.get('defer', False) and len(delays) > 0
+        if defer:
+            # don't count this as an attempt
+            attempt = 0
+        if attempt >= len(delays) or 'body' not in work_unit:
+            # out of retries
+            self._dead_letter(work_unit, channel, msg_txt)
+            return
+
+        tier = attempt + 1
+        if defer:
+            headers['x-ds-deferred'] = headers.get('x-ds-deferred', 0) + 1
+        else:
+            headers['x-ds-attempt'] = tier
+        headers['x-ds-error'] = str(msg_txt)[:1024]
+        # NOTE: per-message TTL is dropped, or the job could expire
+        # while waiting to be retried
+        retry_props = pika.BasicProperties(content_type=props.content_type,
+                                           delivery_mode=props.delivery_mode,
+                                           priority=props.priority,
+                                           headers=headers)
+        queue_name = work_unit['queue_name']
+        try:
+            channel.basic_publish(exchange=retry_tier_name(tier),
+                                  routing_key=queue_name,
+                                  body=work_unit['body'],
+                                  properties=retry_props)
+
+        except Exception as e:
+            self.logger.error(f"error sending job to retry tier {tier}: {e}",
+                              exc_info=True)
+            self._dead_letter(work_unit, channel, msg_txt)
+            return
+
+        if defer:
+            self.logger.info("deferring job for {} sec".format(delays[0]))
+        else:
+            self.logger.info("retrying job in {} sec (attempt {} of {})".format(
+                delays[attempt], tier, len(delays)))
+        _m_retried.labels(queue_name, str(tier)).inc()
+        self._release(work_unit, True)
+
+    def _add_unsettled(self, work_unit, msg_txt, info):
+        with self._unsettled_lock:
+            self._unsettled[work_unit['spool_id']] = (work_unit, msg_txt, info)
+
+    def settle_unsettled(self):
+        """Settle the failed spooled jobs that could not be sent to a
+        retry tier (or dead-lettered) because we were disconnected.
+        Runs in the connection's thread, after a reconnect.
+        """
+        with self._unsettled_lock:
+            items = list(self._unsettled.values())
+        if len(items) == 0:
+            return
+        self.logger.info(f"settling {len(items)} failed jobs from the spool")
+        for work_unit, msg_txt, info in items:
+            self._settle(work_unit, False, msg_txt, info)
+
+    def get_retry_delays(self):
+        """The delays of the retry tiers we can use: those configured,
+        up to the first one whose exchange is missing at the broker.
+        """
+        delays = get_retry_delays(self.config)
+        if self.num_retry_tiers is not None:
+            delays = delays[:self.num_retry_tiers]
+        return delays
+
+    def check_retry_tiers(self, connection):
+        """Check that the exchange of each configured retry tier exists
+        (they are declared by the hub).  Publishing to a missing one would
+        get our channel closed, so retries stop at the first missing tier
+        and failed jobs are dead-lettered from there on.
+        """
+        delays = get_retry_delays(self.config)
+        self.num_retry_tiers = None
+        for i in range(len(delays)):
+            exchange = retry_tier_name(i + 1)
+            # a failed passive declare closes the channel
+            channel = connection.channel()
+            try:
+                channel.exchange_declare(exchange=exchange, passive=True)
+
+            except pika.exceptions.ChannelClosedByBroker as e:
+                if e.reply_code != 404:
+                    raise
+                self.num_retry_tiers = i
+                self.logger.error("retry tier exchange '{}' does not exist (are the hub's retry settings the same?); dead-lettering jobs after {} retries".format(
+                    exchange, i))
+                return
+            channel.close()
+
+    def _check_duplicate(self, job, held=None):
+        """Returns (dedup_key, status), where status is None unless `job`
+        is a duplicate (see `DedupCache.check`).  If `held` is given (a
+        work unit without a job) and the job is a duplicate of one still
+        in progress, `held` is kept until that job finishes: it is then
+        ACKed if the job succeeded and requeued if it failed.
+        """
+        if self.dedup is None:
+            return None, None
+        dedup_key = dedup.job_key(job)
+        with self._held_lock:
+            status = self.dedup.check(dedup_key)
+            if status == dedup.in_progress and held is not None:
+                self._held.setdefault(dedup_key, []).append(held)
+        if status is not None:
+            self.logger.info("duplicate job %s (%s)", dedup_key, status)
+        return dedup_key, status
+
+    def _finish_duplicates(self, dedup_key, ack_flag):
+        """Commit or release `dedup_key` and settle the duplicates held
+        while its job was in progress.  Called from a worker thread.
+        """
+        with self._held_lock:
+            if ack_flag:
+                self.dedup.commit(dedup_key)
+            else:
+                # allow a retry of this job to run
+                self.dedup.release(dedup_key)
+            held = self._held.pop(dedup_key, [])
+        for wu in held:
+            if not wu['connection'].is_open:
+                # it will be redelivered
+                continue
+            if ack_flag:
+                _m_acked.labels(wu['queue_name']).inc()
+            # a failed job's duplicate goes back to the broker to be run
+            cb = functools.partial(self._ack_message, ack_flag, wu['channel'],
+                                   wu['delivery_tag'], requeue=True)
+            wu['connection'].add_callback_threadsafe(cb)
+
+    def _make_work_unit(self, job, queue_name, body, properties,
+                        dedup_key=None):
+        """Returns a work unit for `job`."""
+        if self.tracer is not None:
+            tr = self.tracer.start_trace(job, queue_name)
+        else:
+            tr = trace.null_trace
+
+        order_key = None
+        key_field = self.config.get('order_key', None)
+        if key_field is not None and job.get(key_field, None) is not None:
+            order_key = str(job[key_field])
+
+        coalesce_key = None
+        key_fields = self.config.get('coalesce_key', None)
+        if key_fields is not None:
+            if isinstance(key_fields, str):
+                key_fields = [key_fields]
+            values = [job.get(field, None) for field in key_fields]
+            if None not in values:
+                coalesce_key = (job.get('action', None),
+                                tuple([str(val) for val in values]))
+
+        return dict(job=job, queue_name=queue_name, trace=tr,
+                    dedup_key=dedup_key, order_key=order_key,
+                    coalesce_key=coalesce_key, body=body,
+                    properties=properties)
+
+    def _spool_message(self, work_unit):
+        self._spool_pending.append(work_unit)
+        if len(self._spool_pending) >= self.config.get('spool_batch', 100):
+            self._flush_spool()
+        elif not self._spool_flush_scheduled:
+            self._spool_flush_scheduled = True
+            work_unit['connection'].call_later(
+                self.config.get('spool_flush_sec', 0.05), self._flush_spool)
+
+    def _flush_spool(self):
+        """Write pending jobs to the spool, ACK them to the broker in one
+        batch and hand them to the workers.  Runs in the connection's thread.
+        """
+        self._spool_flush_scheduled = False
+        pending, self._spool_pending = self._spool_pending, []
+        if len(pending) == 0:
+            return
+        last = pending[-1]
+        try:
+            ids = self.spool.put_many([(wu['queue_name'], wu['body'],
+                                        wu['properties'].content_type,
+                                        wu['properties'].headers or {})
+                                       for wu in pending])
+
+        except Exception as e:
+            self.logger.error(f"error writing to spool: {e}", exc_info=True)
+            # give the jobs back to the broker
+            for wu in pending:
+                if wu['dedup_key'] is not None:
+                    self.dedup.release(wu['dedup_key'])
+            last['channel'].basic_nack(last['delivery_tag'], multiple=True,
+                                       requeue=True)
+            return
+
+        # one ACK for the whole batch
+        last['channel'].basic_ack(last['delivery_tag'], multiple=True)
+        for wu, spool_id in zip(pending, ids):
+            wu['spool_id'] = spool_id
+            self.work_queue.put(wu)
+
+    def _reset_spool_pending(self):
+        # jobs not yet spooled when a connection is lost will be
+        # redelivered by the broker
+        for wu in self._spool_pending:
+            if wu['dedup_key'] is not None:
+                self.dedup.release(wu['dedup_key'])
+        self._spool_pending = []
+        self._spool_flush_scheduled = False
+
+    def replay_spool(self):
+        """Queue up the jobs left in the spool from a previous run."""
+        rows = self.spool.replay()
+        if len(rows) == 0:
+            return
+        self.logger.info(f"replaying {len(rows)} jobs from spool")
+        for spool_id, queue_name, body, content_type, headers in rows:
+            props = pika.BasicProperties(content_type=content_type,
+                                         headers=headers)
+            try:
+                job = codec.decode(body, content_type)
+
+            except Exception as e:
+                self.logger.error(f"error decoding spooled job: {body!r}: {e}")
+                self.spool.remove(spool_id)
+                continue
+
+            dedup_key, status = self._check_duplicate(job)
+            if status is not None:
+                self.spool.remove(spool_id)
+                continue
+            work_unit = self._make_work_unit(job, queue_name, body, props,
+                                             dedup_key=dedup_key)
+            work_unit.update(spool_id=spool_id, channel=None,
+                             connection=None, delivery_tag=None)
+            self.work_queue.put(work_unit)
+
     def handle_message(self, ch, method, properties, body, args):
-        self.logger.debug("received %r" % body)
+        self.logger.debug("received %r", body)
         channel, connection, queue_name = args
+        _m_received.labels(queue_name).inc()
         try:
-            job = json.loads(body)
+            job = codec.decode(body, properties.content_type)
 
         except Exception as e:
-            msg = "JSON loading error for job: %r:\n%r" % (body, e)
+            msg = "error decoding job: %r:\n%r" % (body, e)
             self.logger.error(msg)
+            _m_nacked.labels(queue_name).inc()
             self._ack_message(False, channel, method.delivery_tag)
             return
 
-        work_unit = dict(channel=channel, connection=connection,
-                         delivery_tag=method.delivery_tag, job=job)
+        if self.get_num_shards() > 1 and not self._warned_shard_key and \
+           shard_header not in (properties.headers or {}):
+            # the shard exchange hashes them all to the same shard
+            self.logger.warning("got jobs without a shard key header; their job sources need a 'shard_key' to spread them over our shards")
+            self._warned_shard_key = True
+
+        held = None
+        if self.spool is None:
+            held = dict(queue_name=queue_name, channel=channel,
+                        connection=connection,
+                        delivery_tag=method.delivery_tag)
+        dedup_key, status = self._check_duplicate(job, held=held)
+        if status == dedup.in_progress and held is not None:
+            # settled when the job in progress finishes
+            return
+        if status is not None:
+            # done already, or (with the spool) in progress: the job in
+            # the spool is retried or dead-lettered if it fails, and the
+            # batch ACK of the spool covers this message anyway
+            _m_acked.labels(queue_name).inc()
+            self._ack_message(True, channel, method.delivery_tag)
+            return
+
+        work_unit = self._make_work_unit(job, queue_name, body, properties,
+                                         dedup_key=dedup_key)
+        work_unit.update(channel=channel, connection=connection,
+                         delivery_tag=method.delivery_tag)
+        if self.spool is not None:
+            self._spool_message(work_unit)
+            return
+
         self.work_queue.put(work_unit)
 
     def do_work(self, i, work_unit):
         job = work_unit['job']
-        self.logger.info('worker {} handling job {}'.format(i, str(job)))
+        self.logger.info('worker %d handling job %s', i, job)
 
         action = job.get('action', None)
         method = self.action_tbl.get(action, self.no_such_action)
+        if not self.work_queue.claim(work_unit):
+            # a newer job for the same destination is queued
+            method = self.superseded
+        tr = work_unit.get('trace', trace.null_trace)
 
         # define acknowledgement function
         def ack(ack_flag, msg_txt, info):
-            cb = functools.partial(self._ack_message, ack_flag,
-                                   work_unit['channel'],
-                                   work_unit['delivery_tag'])
-            work_unit['connection'].add_callback_threadsafe(cb)
+            tr.set_status(ack_flag, msg_txt)
+            dedup_key = work_unit.get('dedup_key', None)
+            if dedup_key is not None:
+                self._finish_duplicates(dedup_key, ack_flag)
+            if ack_flag:
+                _m_acked.labels(work_unit.get('queue_name', '')).inc()
+            time_origin = job.get('time_origin', None)
+            if time_origin is not None:
+                _m_latency.labels(str(action)).observe(time.time() - time_origin)
+
+            if work_unit.get('spool_id', None) is not None:
+                if ack_flag:
+                    # no need to involve the broker
+                    self._release(work_unit, True)
+                    return
+                # kept until settled, in case the connection is lost first
+                self._add_unsettled(work_unit, msg_txt, info)
+                connection = self.connection
+                if connection is None or not connection.is_open:
+                    self.logger.error("not connected; failed job will be settled on reconnect")
+                    return
+            else:
+                connection = work_unit['connection']
+
+            cb = functools.partial(self._settle, work_unit, ack_flag,
+                                   msg_txt, info)
+            try:
+                connection.add_callback_threadsafe(cb)
+
+            except Exception as e:
+                # connection was closed meanwhile; a spooled job is
+                # settled on reconnect, others are redelivered
+                self.logger.error(f"can't settle job: {e}")
 
         try:
             method(work_unit, ack)
@@ -88,21 +568,59 @@ class JobSink:
             # TODO: include traceback
             ack(False, msg, {})
 
-    def worker_loop(self, i, ev_quit):
+        tr.finish()
+
+    def worker_loop(self, i, ev_quit, ev_stop=None):
         """N workers will run this method.  They pull jobs off of the work
-        queue and perform those tasks until ev_quit event is set.
+        queue and perform those tasks until ev_quit event is set (or
+        `ev_stop`, if the pool is shrunk).
         """
+        if ev_stop is None:
+            ev_stop = threading.Event()
         self.logger.info("starting worker {}...".format(i))
-        while not ev_quit.is_set():
+        while not (ev_quit.is_set() or ev_stop.is_set()):
             try:
                 work_unit = self.work_queue.get(block=True, timeout=1.0)
             except queue.Empty:
                 continue
 
-            self.do_work(i, work_unit)
+            work_unit.get('trace', trace.null_trace).mark('dequeued')
+            start_time = time.time()
+            with self._busy_lock:
+                self.num_busy += 1
+                self.job_start[i] = start_time
+            try:
+                self.do_work(i, work_unit)
+            finally:
+                with self._busy_lock:
+                    self.num_busy -= 1
+                    self.busy_time += time.time() - start_time
+                    del self.job_start[i]
+                # let the next job with the same order key go
+                self.work_queue.release(work_unit)
 
         self.logger.info("ending worker loop...")
 
+    def heartbeat_loop(self, ev_quit, heartbeat):
+        """Set `heartbeat.value` (e.g. a `multiprocessing.Value`) to the
+        current time every 'heartbeat_interval' seconds while no job has
+        been running longer than 'job_timeout' seconds, so that a
+        supervisor can tell that this process is stuck.
+        """
+        interval = self.config.get('heartbeat_interval', 5.0)
+        job_timeout = self.config.get('job_timeout', 3600.0)
+        while not ev_quit.is_set():
+            now = time.time()
+            with self._busy_lock:
+                started = list(self.job_start.values())
+            if job_timeout is None or len(started) == 0 or \
+               now - min(started) <= job_timeout:
+                heartbeat.value = now
+            else:
+                self.logger.warning("a job has been running for {:.0f} sec".format(
+                    now - min(started)))
+            ev_quit.wait(interval)
+
     def debug(self, work_unit, fn_ack):
         """debug job."""
         job = work_unit['job']
@@ -129,6 +647,18 @@ class JobSink:
         time.sleep(secs)
         fn_ack(True, '', {})
 
+    def superseded(self, work_unit, fn_ack):
+        """Runs instead of a job that a newer one has superseded."""
+        job = work_unit['job']
+        queue_name = work_unit.get('queue_name', '')
+        self.logger.info("skipping job %s: superseded by a newer one",
+                         job.get('id', None))
+        _m_superseded.labels(queue_name).inc()
+        size = job.get('size', None)
+        if isinstance(size, (int, float)):
+            _m_superseded_bytes.labels(queue_name).inc(size)
+        fn_ack(True, 'superseded', {})
+
     def no_such_action(self, work_unit, fn_ack):
         """This job runs if the job type is not recognized."""
         job = work_unit['job']
@@ -138,31 +668,436 @@ class JobSink:
         fn_ack(False, msg, {})
 
     def read_config(self, configfile):
+        self.configfile = configfile
         self.config = read_config(configfile)
 
         self.recover_interval = self.config.get('retry_interval', 60.0)
+        self.drain_timeout = self.config.get('drain_timeout', 30.0)
 
     def start_workers(self, ev_quit=None):
+        self.validate_config(self.config)
+
+        if self.tracer is None:
+            self.tracer = trace.Tracer.from_config(self.logger, self.config,
+                                                   service_name=self.name)
+            if self.tracer is not None:
+                self.tracer.start()
+
+        if self.dedup is None:
+            self.dedup = dedup.DedupCache.from_config(self.logger, self.config)
+            if self.dedup is not None:
+                self.dedup.start()
+
+        if self.spool is None:
+            self.spool = Spool.from_config(self.logger, self.config)
+            if self.spool is not None:
+                self.replay_spool()
+
+        if ev_quit is None:
+            ev_quit = threading.Event()
+        self.ev_quit = ev_quit
+
         numworkers = self.config['num_workers']
-        for i in range(numworkers):
-            t = threading.Thread(target=self.worker_loop, args=[i, ev_quit])
+        if Autoscaler.is_enabled(self.config):
+            self.autoscaler = Autoscaler(self.logger, self)
+            params = self.autoscaler.get_params()
+            numworkers = min(params['max_workers'],
+                             max(params['min_workers'], numworkers))
+
+        self.set_num_workers(numworkers)
+
+    def set_num_workers(self, numworkers):
+        """Grow or shrink the worker pool to `numworkers` threads.
+        Workers that are retired finish the job they are doing first.
+        """
+        # forget threads that have finished
+        self.threads = [t for t in self.threads if t.is_alive()]
+
+        while len(self.workers) < numworkers:
+            i = self._worker_num
+            self._worker_num += 1
+            ev_stop = threading.Event()
+            # daemon, so that a job hung past the drain deadline does not
+            # keep the process from exiting
+            t = threading.Thread(target=self.worker_loop,
+                                 args=[i, self.ev_quit, ev_stop],
+                                 daemon=True)
+            self.workers.append((t, ev_stop))
             self.threads.append(t)
             t.start()
 
+        while len(self.workers) > numworkers:
+            t, ev_stop = self.workers.pop()
+            ev_stop.set()
+
+    def validate_config(self, config):
+        """Raise a ValueError if `config` is not usable by this sink."""
+        for key in ('realm', 'realm_host', 'realm_username',
+                    'realm_password', 'num_workers'):
+            if key not in config:
+                raise ValueError(f"config is missing '{key}'")
+        num = config['num_workers']
+        if not isinstance(num, int) or num < 1:
+            raise ValueError(f"num_workers should be a positive integer: {num}")
+        for key in ('min_workers', 'max_workers'):
+            num = config.get(key, 1)
+            if not isinstance(num, int) or num < 1:
+                raise ValueError(f"{key} should be a positive integer: {num}")
+        if config.get('min_workers', 1) > config.get('max_workers',
+                                                     config.get('min_workers', 1)):
+            raise ValueError("min_workers should not be more than max_workers")
+        if config.get('order_key', None) is not None and \
+           len(get_retry_delays(config)) > 0:
+            # a failed job is ACKed and parked in a retry tier, so the
+            # next job with its key would run ahead of it
+            raise ValueError("'order_key' can't be used with retry tiers ('retry_max_attempts' or 'retry_delays_sec')")
+
+    def reload_config(self):
+        """Re-read the configuration file and apply the differences
+        without stopping the consumer.  Called in the connection's thread.
+        """
+        if self.configfile is None:
+            self.logger.error("can't reload: no configuration file known")
+            return
+        self.logger.info(f"reloading configuration from {self.configfile}")
+        old_config = self.config
+        try:
+            # keys deleted from the file revert to their defaults
+            new_config = read_config(self.configfile)
+            for key in self.runtime_keys:
+                if key in old_config:
+                    new_config[key] = old_config[key]
+            self.validate_config(new_config)
+
+        except Exception as e:
+            self.logger.error(f"error reading configuration; not applied: {e}",
+                              exc_info=True)
+            return
+
+        keys = set(old_config.keys()) | set(new_config.keys())
+        diff = {key: (old_config.get(key, None), new_config.get(key, None))
+                for key in sorted(keys)
+                if old_config.get(key, None) != new_config.get(key, None)}
+        if len(diff) == 0:
+            self.logger.info("configuration unchanged")
+            return
+
+        try:
+            for fn in self.reload_callbacks:
+                fn(old_config, new_config, diff)
+
+        except Exception as e:
+            self.logger.error(f"error applying configuration; not applied: {e}",
+                              exc_info=True)
+            return
+
+        self.config = new_config
+        self.recover_interval = new_config.get('retry_interval', 60.0)
+        self.drain_timeout = new_config.get('drain_timeout', 30.0)
+
+        if 'max_workers' in diff:
+            self.reset_autoscaler()
+
+        if 'num_workers' in diff or 'prefetch_factor' in diff or \
+           'max_workers' in diff:
+            if self.autoscaler is None:
+                self.set_num_workers(new_config['num_workers'])
+            if self.channel is not None and self.channel.is_open:
+                self.channel.basic_qos(prefetch_count=self.get_prefetch_count())
+
+        if any([key.startswith('retry_') for key in diff]) and \
+           self.connection is not None and self.connection.is_open:
+            self.check_retry_tiers(self.connection)
+
+        if 'topic' in diff and self.topic_override is None:
+            self.rebind(old_config.get('topic', default_topic),
+                        new_config.get('topic', default_topic))
+
+        if 'shards' in diff or 'queue_names' in diff:
+            # pick up shards added (or removed) by the hub
+            if self.channel is not None and self.channel.is_open:
+                topic = self.topic_override
+                if topic is None:
+                    topic = new_config.get('topic', default_topic)
+                self.bind_queues(self.channel, topic)
+                self.consume(self.channel, self.connection)
+
+        for key in ('realm', 'realm_host', 'realm_port', 'realm_username',
+                    'realm_password'):
+            if key in diff:
+                self.logger.warning(f"change to '{key}' takes effect on reconnect")
+
+        for key, (old_val, new_val) in diff.items():
+            if 'password' in key:
+                old_val, new_val = '***', '***'
+            self.logger.info(f"config changed: {key}: {old_val!r} -> {new_val!r}")
+
+    def reset_autoscaler(self):
+        """Start or stop the autoscaler after 'max_workers' was added to
+        or removed from the configuration.
+        """
+        enabled = Autoscaler.is_enabled(self.config)
+        if self.autoscaler is not None and not enabled:
+            self.autoscaler.stop()
+            self.autoscaler = None
+            self.logger.info("autoscaling disabled")
+
+        elif self.autoscaler is None and enabled:
+            self.autoscaler = Autoscaler(self.logger, self)
+            params = self.autoscaler.get_params()
+            self.set_num_workers(min(params['max_workers'],
+                                     max(params['min_workers'],
+                                         len(self.workers))))
+            if self.connection is not None and self.connection.is_open and \
+               self.channel is not None and self.channel.is_open:
+                self.autoscaler.schedule(self.connection, self.channel)
+            self.logger.info("autoscaling enabled")
+
+    def get_queue_names(self):
+        """Return the names of the queues we consume from: 'queue_names' if
+        configured, otherwise our queue, or one per shard if 'shards' is
+        more than 1.
+        """
+        queue_names = self.config.get('queue_names', None)
+        if queue_names is not None:
+            return list(queue_names)
+        return shard_queue_names(self.name, self.get_num_shards())
+
+    def get_num_shards(self):
+        """Our configured number of shards, or 1 if the hub has not
+        created our shard exchange.
+        """
+        if self.shards_missing:
+            return 1
+        return self.config.get('shards', 1)
+
+    def _shard_exchange_exists(self):
+        # a failed passive declare closes the channel
+        channel = self.connection.channel()
+        try:
+            channel.exchange_declare(exchange=shard_exchange_name(self.name),
+                                     passive=True)
+            return True
+
+        except pika.exceptions.ChannelClosedByBroker as e:
+            if e.reply_code != 404:
+                raise
+            return False
+
+        finally:
+            if channel.is_open:
+                channel.close()
+
+    def bind_queues(self, channel, topic, unbind=False):
+        """Bind (or unbind) our queues, or our shard exchange if sharded,
+        to `topic` on the realm exchange.  The other kind of binding (left
+        from before the number of shards changed, or made by a hub with
+        a different number of shards) is removed, so that jobs don't
+        arrive twice.
+        """
+        if 'queue_names' in self.config:
+            for queue_name in self.get_queue_names():
+                bind_topic(channel, queue_name, topic, self.config,
+                           unbind=unbind)
+            return
+
+        num_shards = self.config.get('shards', 1)
+        exists = self._shard_exchange_exists()
+        self.shards_missing = num_shards > 1 and not exists
+        if self.shards_missing:
+            self.logger.error("shard exchange '{}' does not exist (is 'shards' set for this sink in the hub?); consuming from our own queue only".format(
+                shard_exchange_name(self.name)))
+        sharded = num_shards > 1 and exists
+        if sharded:
+            bind_topic(channel, self.name, topic, self.config,
+                       num_shards=num_shards, unbind=unbind)
+        else:
+            bind_topic(channel, self.name, topic, self.config, unbind=unbind)
+
+        # the new binding is in place before the other one is removed
+        realm = self.config['realm']
+        if sharded or unbind:
+            channel.queue_unbind(queue=self.name, exchange=realm,
+                                 routing_key=topic)
+        if exists and (not sharded or unbind):
+            channel.exchange_unbind(destination=shard_exchange_name(self.name),
+                                    source=realm, routing_key=topic)
+
+    def consume(self, channel, connection):
+        """Start consuming from each of our queues that we are not
+        consuming from yet, and stop consuming from queues that are no
+        longer ours (e.g. after the number of shards changed).
+        """
+        queue_names = self.get_queue_names()
+        for queue_name in queue_names:
+            if queue_name in self.consumers:
+                continue
+            callback_fn = functools.partial(self.handle_message,
+                                            args=[channel, connection,
+                                                  queue_name])
+            self.consumers[queue_name] = channel.basic_consume(
+                queue=queue_name, on_message_callback=callback_fn)
+
+        for queue_name in list(self.consumers.keys()):
+            if queue_name not in queue_names:
+                # jobs already delivered from it are still worked on
+                channel.basic_cancel(self.consumers.pop(queue_name))
+
+        self.logger.info("consuming on queues: %s" % (', '.join(queue_names)))
+
+    def rebind(self, old_topic, new_topic):
+        """Bind our queues to `new_topic` in place of `old_topic`."""
+        if self.channel is None or not self.channel.is_open:
+            return
+        self.bind_queues(self.channel, new_topic)
+        self.bind_queues(self.channel, old_topic, unbind=True)
+        self.logger.info(f"rebound queues from topic '{old_topic}' to '{new_topic}'")
+
+    def _sighup_handler(self, signum, frame):
+        # do the reload in the connection's thread, between deliveries
+        if self.connection is not None and self.connection.is_open:
+            self.connection.add_callback_threadsafe(self.reload_config)
+        else:
+            self.reload_config()
+
+    def drain(self, connection, ev_quit):
+        """Drain the sink after the consumer has been cancelled.
+
+        Workers keep pulling prefetched jobs off of the work queue until
+        it is empty or `drain_timeout` seconds elapse; pending ACKs are
+        flushed to the broker while we wait.  Any jobs still left in the
+        work queue at the deadline are NACKed back to the broker (requeued),
+        so that another sink can pick them up right away.  In-flight jobs
+        are waited for until the same deadline; any still running after it
+        are left to be redelivered by the broker when we disconnect.
+
+        The deadline is the `drain_deadline` set when the interrupt was
+        received, so time spent cancelling the consumer counts against it.
+        """
+        if self.drain_deadline <= 0.0:
+            self.drain_deadline = time.time() + self.drain_timeout
+        deadline = self.drain_deadline
+        if self.spool is not None:
+            # spool (and ACK) anything received but not yet spooled
+            self._flush_spool()
+        self.logger.info("draining {} queued and {} in-flight jobs (timeout={} sec)...".format(
+            self.work_queue.qsize(), self.num_busy, self.drain_timeout))
+
+        while time.time() < deadline:
+            if self.work_queue.empty() and self.num_busy == 0:
+                break
+            # this runs the ACK callbacks queued by the workers
+            connection.process_data_events(time_limit=0.25)
+
+        # stop the workers picking up any more jobs
+        ev_quit.set()
+
+        # requeue whatever is left
+        leftover = []
+        while True:
+            try:
+                leftover.append(self.work_queue.get(block=False))
+            except queue.Empty:
+                break
+        # and the jobs waiting for others with the same order key
+        leftover.extend(self.work_queue.take_waiting())
+        if len(leftover) > 0:
+            self.logger.warning("drain deadline reached; requeueing {} jobs".format(
+                len(leftover)))
+            self._requeue_leftover(leftover)
+
+        # wait for in-flight jobs and flush their ACKs
+        for t in self.threads:
+            while t.is_alive() and time.time() < deadline:
+                connection.process_data_events(time_limit=0.25)
+                t.join(timeout=0.0)
+        connection.process_data_events(time_limit=0)
+        if self.num_busy > 0:
+            self.logger.warning("drain deadline reached; abandoning {} in-flight jobs".format(
+                self.num_busy))
+        self.logger.info("drain complete")
+
+    def _requeue_leftover(self, leftover):
+        """NACK (requeue) the work units in `leftover` back to the broker.
+
+        If no job is in flight and no duplicate is held, every unsettled
+        delivery on a channel is a leftover, so each channel gets a single
+        NACK with `multiple=True` up to its highest leftover tag.  Otherwise
+        the leftovers are NACKed one by one, because a `multiple` NACK would
+        also requeue the lower-tagged jobs that are still being worked on.
+        """
+        by_channel = dict()
+        for work_unit in leftover:
+            if work_unit.get('spool_id', None) is not None:
+                # will be replayed from the spool on restart
+                continue
+            _m_nacked.labels(work_unit.get('queue_name', '')).inc()
+            channel = work_unit['channel']
+            by_channel.setdefault(id(channel), (channel, []))[1].append(
+                work_unit['delivery_tag'])
+
+        with self._held_lock:
+            num_held = len(self._held)
+        batch = (self.num_busy == 0 and num_held == 0)
+
+        for channel, tags in by_channel.values():
+            if not channel.is_open:
+                self.logger.error("Whups! channel is closed--can't NACK "
+                                  "{} jobs".format(len(tags)))
+                continue
+            if batch:
+                channel.basic_nack(delivery_tag=max(tags), multiple=True,
+                                   requeue=True)
+            else:
+                for delivery_tag in tags:
+                    channel.basic_nack(delivery_tag, requeue=True)
+
+    def _sigterm_handler(self, signum, frame):
+        # treat SIGTERM the same as CTRL+C, so that we drain before exiting
+        raise KeyboardInterrupt("SIGTERM")
+
+    def _draining_signal_handler(self, signum, frame):
+        self.logger.info(f"already draining; ignoring signal {signum}")
+
+    def _ignore_signals(self):
+        """Keep a second SIGINT/SIGTERM (e.g. from both the terminal and a
+        supervisor) from interrupting the drain.
+        """
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, self._draining_signal_handler)
+
+    def _backoff(self, ev_quit):
+        """Wait `recover_interval` seconds before reconnecting.  Returns
+        False if CTRL+C or SIGTERM arrived during the wait, in which case
+        the caller should stop reconnecting and shut down.
+        """
+        self.logger.info(f"retrying after {self.recover_interval} sec interval")
+        try:
+            ev_quit.wait(self.recover_interval)
+
+        except KeyboardInterrupt:
+            self._ignore_signals()
+            self.drain_deadline = time.time() + self.drain_timeout
+            self.logger.info("detected keyboard interrupt while reconnecting!")
+            return False
+        return True
+
     def serve(self, ev_quit=None, topic=None):
         config = self.config
-        # connect to queues
-        auth = pika.PlainCredentials(username=config['realm_username'],
-                                     password=config['realm_password'])
-        params = pika.ConnectionParameters(host=config['realm_host'],
-                                           port=config.get('realm_port', 5672),
-                                           credentials=auth)
 
         # start up consumer workers
         if ev_quit is None:
             ev_quit = threading.Event()
 
+        self.drain_timeout = config.get('drain_timeout', self.drain_timeout)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._sigterm_handler)
+            signal.signal(signal.SIGHUP, self._sighup_handler)
+        self.topic_override = topic
+
         connection, channel = None, None
+        draining = False
 
         while not ev_quit.is_set():
             # closures to avoid too many open files failures
@@ -179,63 +1114,104 @@ class JobSink:
                 except Exception:
                     pass
             connection = None
+            self.connection, self.channel = None, None
+            self._reset_spool_pending()
 
             try:
+                # NOTE: config may have been reloaded since last time around
+                config = self.config
+                # connect to queues
+                auth = pika.PlainCredentials(username=config['realm_username'],
+                                             password=config['realm_password'])
+                params = pika.ConnectionParameters(host=config['realm_host'],
+                                                   port=config.get('realm_port', 5672),
+                                                   credentials=auth)
                 connection = pika.BlockingConnection(params)
                 channel = connection.channel()
+                self.connection, self.channel = connection, channel
 
-                channel.basic_qos(prefetch_count=config['num_workers'])
+                channel.basic_qos(prefetch_count=self.get_prefetch_count())
 
+                topic = self.topic_override
                 if topic is None:
                     topic = config.get('topic', default_topic)
 
-                queue_names = config.get('queue_names', [self.name])
-                for queue_name in queue_names:
-                    channel.queue_bind(queue=queue_name,
-                                       exchange=config['realm'],
-                                       routing_key=topic)
+                self.check_retry_tiers(connection)
+                self.bind_queues(channel, topic)
+
+                # one consumer per queue (shard)
+                self.consumers = dict()
+                self.consume(channel, connection)
+                if self.spool is not None:
+                    self.settle_unsettled()
 
-                callback_fn = functools.partial(self.handle_message,
-                                                args=[channel, connection,
-                                                      queue_name])
-                channel.basic_consume(queue=queue_name,
-                                      on_message_callback=callback_fn)
+                if self.autoscaler is not None:
+                    self.autoscaler.schedule(connection, channel)
 
-                self.logger.info("consuming on queues: %s" % (', '.join(queue_names)))
                 self.logger.info("Waiting for messages. To exit press CTRL+C")
                 channel.start_consuming()
 
             except KeyboardInterrupt:
+                self._ignore_signals()
+                self.drain_deadline = time.time() + self.drain_timeout
                 self.logger.info("detected keyboard interrupt!")
-                channel.stop_consuming()
+                # cancels our consumer(s), so no more jobs are delivered
+                if channel is not None and channel.is_open:
+                    channel.stop_consuming()
+                draining = True
                 break
 
             except pika.exceptions.ConnectionClosedByBroker as e:
                 self.logger.error(f"broker closed connection: {e}")
-                self.logger.info(f"retrying after {self.recover_interval} sec interval")
-                ev_quit.wait(self.recover_interval)
+                if not self._backoff(ev_quit):
+                    draining = True
+                    break
                 continue
 
             except pika.exceptions.AMQPChannelError as e:
                 self.logger.error(f"channel error: {e}", exc_info=True)
-                self.logger.info(f"retrying after {self.recover_interval} sec interval")
-                ev_quit.wait(self.recover_interval)
+                if not self._backoff(ev_quit):
+                    draining = True
+                    break
                 continue
 
             except (pika.exceptions.AMQPConnectionError,
                     pika.exceptions.AMQPHeartbeatTimeout) as e:
                 self.logger.error(f"connection error: {e}", exc_info=True)
-                self.logger.info(f"retrying after {self.recover_interval} sec interval")
-                ev_quit.wait(self.recover_interval)
+                if not self._backoff(ev_quit):
+                    draining = True
+                    break
                 continue
 
             except Exception as e:
                 self.logger.error(f"unhandled connection error: {e}",
                                   exc_info=True)
+                if not self._backoff(ev_quit):
+                    draining = True
+                    break
 
         self.logger.info("Shutting down...")
+        if draining and connection is not None and connection.is_open:
+            try:
+                self.drain(connection, ev_quit)
+
+            except Exception as e:
+                self.logger.error(f"error draining jobs: {e}", exc_info=True)
+
         ev_quit.set()
         for t in self.threads:
-            t.join()
+            if draining:
+                # don't wait past the drain deadline for a hung job
+                t.join(timeout=max(0.0, self.drain_deadline - time.time()))
+            else:
+                t.join()
+
+        if self.tracer is not None:
+            self.tracer.stop()
+        if self.dedup is not None:
+            self.dedup.stop()
+        if self.spool is not None:
+            self.spool.close()
 
-        connection.close()
+        if connection is not None and connection.is_open:
+            connection.close()
@@ -5,20 +5,42 @@ Create queues and process wayward jobs.
 See tutorial document.
 
 Usage:
-  $ ds_hub -f HUB_CFG [--dlx]
+  $ ds_hub -f HUB_CFG [--plan | --migrate]
+                      [--dlx [--once] [--dry-run] [--archive FILE] [--rate N]]
 
 Where:
   - HUB_CFG is the realm configuration YAML file
 
+The queues in HUB_CFG are reconciled with the broker (see
+datasink/reconcile.py): missing queues are declared and bindings added or
+removed as needed, and the changes are printed.  With --plan nothing is
+changed.  A queue declared with other arguments (e.g. after changing its
+'queue_type', 'queue_mode' or limits) is only recreated with --migrate,
+which moves its messages through a temporary queue.
+
+With --dlx the hub stays around to reprocess dead letters from the backlog
+queue in batches, according to the 'dlx_rules' in HUB_CFG (see
+datasink/reprocess.py): matching jobs are republished to their original
+exchange and routing key and the rest are archived to a gzipped JSON
+lines file.  With --once it stops when the backlog is empty; with
+--dry-run it only reports what it would do.  A summary by reason, queue
+and action is printed at the end.
+
 Example:
   $ ./ds_hub.py -f hub.yml
+  $ ./ds_hub.py -f hub.yml --plan
+  $ ./ds_hub.py -f hub.yml --dlx --once --dry-run
 """
 
 import sys
+import logging
 from argparse import ArgumentParser
 
-from datasink.initialize import (read_config, configure_exchange, handle_dlx,
-                                 setup_queue, example_dlx_cb)
+from datasink.initialize import read_config, configure_exchange
+from datasink.reconcile import Reconciler
+from datasink.mgmt import ManagementAPI
+from datasink.reprocess import BacklogReprocessor
+from datasink import metrics, log
 
 
 def main(options, args):
@@ -34,32 +56,67 @@ def main(options, args):
 
     # and finally set up datasink queues
     print("configuring queues")
-
-    queues = config.get('queues', [])
-    if len(queues) > 0:
-        for name, dct in queues.items():
-            enabled = dct.get('enabled', False)
-            print(f"configuring {name} enabled={enabled}")
-            setup_queue(channel, name, dct, config, bind=enabled)
-
-    print("queues configured.")
+    logger = log.simple_logger('ds_hub', level=logging.INFO)
+    reconciler = Reconciler(logger, connection, config,
+                            mgmt=ManagementAPI.from_config(config))
+    changes = reconciler.plan()
+    for change in changes:
+        print(f"  {change}")
+    if len(changes) == 0:
+        print("queues are up to date.")
+    elif options.plan:
+        print("(not applied)")
+        return
+    else:
+        reconciler.apply(changes, migrate=options.migrate)
+        if not options.migrate and any([change.kind == 'migrate'
+                                        for change in changes]):
+            print("NOTE: some queues need to be migrated; use --migrate")
+        print("queues configured.")
 
     if options.do_dlx:
-        print("[*] Waiting for dead letters. To exit press Ctrl+C")
+        metrics.start_from_config(config, logger)
+        reproc = BacklogReprocessor(logger, channel, config,
+                                    dry_run=options.dry_run,
+                                    archive_path=options.archive,
+                                    rate=options.rate)
+        if not (options.once or options.dry_run):
+            print("[*] Waiting for dead letters. To exit press Ctrl+C")
         try:
-            handle_dlx(channel, config, example_dlx_cb)
+            reproc.run(once=options.once)
 
         except KeyboardInterrupt:
             print("Caught keyboard interrupt, exiting hub...")
 
+        finally:
+            print(reproc.format_summary())
+
 
 if __name__ == "__main__":
 
     argprs = ArgumentParser("configure datasink hub")
 
+    argprs.add_argument("--plan", dest="plan", action="store_true",
+                        default=False,
+                        help="Only show what would be changed in the queues")
+    argprs.add_argument("--migrate", dest="migrate", action="store_true",
+                        default=False,
+                        help="Recreate queues whose arguments have changed")
     argprs.add_argument("--dlx", dest="do_dlx", action="store_true",
                         default=False,
                         help="Stick around to handle wayward jobs")
+    argprs.add_argument("--once", dest="once", action="store_true",
+                        default=False,
+                        help="With --dlx, exit when the backlog is empty")
+    argprs.add_argument("--dry-run", dest="dry_run", action="store_true",
+                        default=False,
+                        help="With --dlx, only report what would be done")
+    argprs.add_argument("--archive", dest="archive", default=None,
+                        metavar="FILE",
+                        help="With --dlx, archive dead letters to FILE")
+    argprs.add_argument("--rate", dest="rate", type=float, default=None,
+                        metavar="N",
+                        help="With --dlx, republish at most N jobs/sec")
     argprs.add_argument("-f", "--config", dest="configfile",
                         help="Specify the configuration file for this realm")
 
@@ -6,6 +6,7 @@ See tutorial document.
 
 Usage:
   $ ./ds_queue.py -f HUB_CFG -a <action> -n NAME [-t <topic>]
+  $ ./ds_queue.py -f HUB_CFG -a stats|watch [-n NAME] [-i SEC] [--json]
 
 Where:
   - HUB_CFG is the realm configuration YAML file
@@ -16,15 +17,89 @@ Where:
   - TOPIC is a dotted topic (e.g. "foo", "foo.bar", "foo.bar.baz") which can
     include wild cards (specified as #) for any component(s).
 
+The stats action samples every queue in HUB_CFG and the backlog (or just
+NAME) twice, -i SEC apart, and prints the depth, consumers, rates and
+estimated drain time of each, as a table or as JSON; watch does so every
+SEC seconds until interrupted.  Alerts (see 'alert_depth' and
+'alert_drain_sec' in hub.yml) are printed to stderr, and stats exits with
+status 1 if there were any.  The management API is used if 'mgmt_url' is
+set, which also gives ingress and egress rates.
+
 Example:
   $ ./ds_queue.py -f hub.yml -a disable -n ins2
+  $ ./ds_queue.py -f hub.yml -a watch -i 1
 """
 
 import sys
+import json
+import time
+import logging
 from argparse import ArgumentParser
 
+import pika
+
 from datasink.initialize import (read_config, configure_exchange,
-                                 setup_queue, default_topic)
+                                 setup_queue, default_topic,
+                                 shard_queue_names, bind_topic)
+from datasink.queuestats import QueueMonitor, format_table
+from datasink.mgmt import ManagementAPI
+from datasink import metrics, log
+
+
+def show_stats(options, config):
+    logger = log.simple_logger('ds_queue', level=logging.WARNING)
+    mgmt = ManagementAPI.from_config(config)
+    connection = None
+    if mgmt is None:
+        # NOTE: stats only look (QueueMonitor uses passive declares), so
+        # don't use configure_exchange(), which declares the topology
+        auth = pika.PlainCredentials(username=config['realm_username'],
+                                     password=config['realm_password'])
+        params = pika.ConnectionParameters(host=config['realm_host'],
+                                           port=config.get('realm_port', 5672),
+                                           # we don't service the connection
+                                           # while sleeping between samples
+                                           heartbeat=0,
+                                           credentials=auth)
+        connection = pika.BlockingConnection(params)
+    queue_names = None
+    if options.name is not None:
+        num_shards = config['queues'].get(options.name, {}).get('shards', 1)
+        queue_names = shard_queue_names(options.name, num_shards)
+    monitor = QueueMonitor(logger, config, connection=connection, mgmt=mgmt,
+                           queue_names=queue_names)
+
+    if options.action == 'watch':
+        metrics.start_from_config(config, logger)
+
+    # rates need two samples
+    monitor.update()
+    num_alerts = 0
+    try:
+        while True:
+            time.sleep(options.interval)
+            stats = monitor.update()
+            if options.json:
+                print(json.dumps(dict(time=time.time(), queues=stats)),
+                      flush=True)
+            else:
+                print(time.strftime("%Y-%m-%d %H:%M:%S"))
+                print(format_table(stats), flush=True)
+            alerts = monitor.check_alerts(stats)
+            for alert in alerts:
+                print(f"ALERT {alert}", file=sys.stderr, flush=True)
+            num_alerts += len(alerts)
+            if options.action == 'stats':
+                break
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        monitor.close()
+        if connection is not None:
+            connection.close()
+    return 1 if num_alerts > 0 else 0
 
 
 def main(options, args):
@@ -33,6 +108,9 @@ def main(options, args):
     configfile = options.configfile
     config = read_config(configfile)
 
+    if options.action in ('stats', 'watch'):
+        return show_stats(options, config)
+
     # then configure the exchange
     connection, channel = configure_exchange(config)
 
@@ -43,6 +121,7 @@ def main(options, args):
 
     q_cfg = config['queues'][queue_name]
     action = options.action
+    num_shards = q_cfg.get('shards', 1)
 
     if action == 'create':
         enabled = q_cfg.get('enabled', False)
@@ -50,12 +129,14 @@ def main(options, args):
         setup_queue(channel, queue_name, q_cfg, config, bind=enabled)
 
     elif action == 'purge':
-        print(f"purging {queue_name} ...")
-        channel.queue_purge(queue_name)
+        for name in shard_queue_names(queue_name, num_shards):
+            print(f"purging {name} ...")
+            channel.queue_purge(name)
 
     elif action == 'delete':
-        print(f"deleting {queue_name} ...")
-        channel.queue_delete(queue_name, if_unused=False, if_empty=True)
+        for name in shard_queue_names(queue_name, num_shards):
+            print(f"deleting {name} ...")
+            channel.queue_delete(name, if_unused=False, if_empty=True)
 
     elif action == 'enable':
         if options.topic is None:
@@ -63,8 +144,7 @@ def main(options, args):
         else:
             topic = options.topic
         print(f"configuring {queue_name} enabled=True")
-        channel.queue_bind(queue_name, exchange=config['realm'],
-                           routing_key=topic)
+        bind_topic(channel, queue_name, topic, config, num_shards=num_shards)
 
     elif action == 'disable':
         if options.topic is None:
@@ -72,8 +152,8 @@ def main(options, args):
         else:
             topic = options.topic
         print(f"configuring {queue_name} enabled=False")
-        channel.queue_unbind(queue_name, exchange=config['realm'],
-                             routing_key=topic)
+        bind_topic(channel, queue_name, topic, config, num_shards=num_shards,
+                   unbind=True)
 
     else:
         raise ValueError(f"sorry, I don't know how to do action '{action}'")
@@ -84,7 +164,7 @@ if __name__ == "__main__":
     argprs = ArgumentParser("configure a sink queue")
 
     argprs.add_argument("-a", "--action", dest="action",
-                        help="create|purge|delete|enable|disable")
+                        help="create|purge|delete|enable|disable|stats|watch")
     argprs.add_argument("-f", "--config", dest="configfile",
                         help="Specify the configuration file for this realm")
     argprs.add_argument("-n", "--name", dest="name", default=None,
@@ -93,13 +173,19 @@ if __name__ == "__main__":
     argprs.add_argument("-t", "--topic", dest="topic", default=None,
                         metavar="TOPIC",
                         help="Dot separated topic")
+    argprs.add_argument("-i", "--interval", dest="interval", type=float,
+                        default=5.0, metavar="SEC",
+                        help="With stats|watch, sample every SEC seconds")
+    argprs.add_argument("--json", dest="json", action="store_true",
+                        default=False,
+                        help="With stats|watch, print JSON lines")
 
     (options, args) = argprs.parse_known_args(sys.argv[1:])
 
     if options.configfile is None:
         argprs.error("Please specify a config file with -f")
 
-    if options.name is None:
+    if options.name is None and options.action not in ('stats', 'watch'):
         argprs.error("Please specify a sink name with -n")
 
-    main(options, args)
+    sys.exit(main(options, args))